@@ -1,25 +1,249 @@
-import json
-import time
+import os
+import random
+import itertools
+import weakref
+from collections import OrderedDict
 import traceback
-from typing import Union, Dict, List, Any, Optional
+from typing import (Union, Dict, List, Any, Optional, AsyncIterator,
+                    AsyncIterable, Iterable, Callable, Awaitable, IO,
+                    Sequence, Tuple, Set, AsyncGenerator)
 import asyncio
 import asyncpg
 import asyncpg.protocol
 import asyncpg.pool
 import asyncpg.transaction
 import asyncpg.prepared_stmt
+import asyncpg.connection
+import asyncpg.exceptions
 from aioapp.app import Component
 from aioapp.error import PrepareError
 from aioapp.misc import mask_url_pwd
-from aioapp.tracer import (Span, CLIENT, SPAN_TYPE, SPAN_KIND)
+from aioapp.tracer import Span
+from .tracing import (InstrumentationPolicy, SPAN_TYPE_POSTGRES,  # noqa
+                      SPAN_KIND_POSTRGES_ACQUIRE, SPAN_KIND_POSTRGES_QUERY,
+                      ARGS_FULL, ARGS_TRUNCATE, ARGS_HASH, ARGS_NONE)
+from .deadline import (Deadline, DeadlineExceededError,  # noqa
+                       effective_timeout, remaining)
+from .routing import Endpoint, ReplicaBalancer
+from .cache import ResultCache
+from .coalesce import ReadCoalescer, Flight  # noqa
+from .loader import BatchLoader, LOADER_MAX_BATCH_SIZE
+from .limiter import (Limiter, PRIORITY_LOW, PRIORITY_NORMAL,  # noqa
+                      PRIORITY_HIGH, PRIORITY_AGING)
+from .bulkhead import Bulkheads, Bulkhead, BulkheadTimeoutError  # noqa
+from .sizing import (AdaptivePoolSizer, ConnectionBudget,  # noqa
+                     SizingDecision)
+from .metrics import (PoolStats, Histogram, MetricsSink,  # noqa
+                      LogHistogram, QueryStats, QUERY_STATS_OTHER)
+from .health import (HealthChecker, HealthStatus, UnhealthyError,  # noqa
+                     HEALTHY, DEGRADED, UNHEALTHY)
+from .explain import (ExplainSampler, PlanStore, CapturedPlan,  # noqa
+                      plan_fingerprint)
+from .listener import (PostgresListener, Subscription, Notification,  # noqa
+                       ListenerOverflowError, OVERFLOW_DROP_NEW,
+                       OVERFLOW_DROP_OLD, OVERFLOW_ERROR)
+from .jsoncodec import (JsonType, JsonCodec, UjsonCodec, OrjsonCodec,  # noqa
+                        get_json_codec, available_json_codecs)
 
-SPAN_TYPE_POSTGRES = 'postgres'
-SPAN_KIND_POSTRGES_ACQUIRE = 'acquire'
-SPAN_KIND_POSTRGES_QUERY = 'query'
+QUERY_ITER_PREFETCH = 100
+COPY_ITER_QUEUE_SIZE = 16
+EXECUTE_MANY_BATCH_SIZE = 1000
+DRAIN_LOG_INTERVAL = 1.0
+XACT_MAX_RETRIES = 5
+XACT_RETRY_BACKOFF = 0.01
+XACT_RETRY_MAX_BACKOFF = 1.0
+# serialization_failure, deadlock_detected
+XACT_RETRY_SQLSTATES = ('40001', '40P01')
+ISOLATION_LEVELS = ('read_committed', 'repeatable_read', 'serializable')
 
 __version__ = '0.0.1b5'
 
-JsonType = Union[None, int, float, str, bool, List[Any], Dict[str, Any]]
+CopySource = Union[str, 'os.PathLike', IO[bytes], AsyncIterable[bytes]]
+CopyOutput = Union[str, 'os.PathLike', IO[bytes],
+                   Callable[[bytes], Awaitable[None]]]
+
+
+def _status_rows(status: Optional[str]) -> Optional[int]:
+    """
+    Extracts the row count from a command status string such as
+    'INSERT 0 5', 'UPDATE 3' or 'COPY 100'
+    """
+    if not status:
+        return None
+    try:
+        return int(status.rsplit(' ', 1)[-1])
+    except ValueError:
+        return None
+
+
+def _record_size(record: asyncpg.protocol.Record) -> int:
+    size = 0
+    for value in record.values():
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        elif value is not None:
+            size += 8
+    return size
+
+
+def _result_size(res: Any) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Rows returned or affected by a call and the approximate size of the
+    decoded rows, extrapolated from the first one to stay cheap
+    """
+    if res is None:
+        # query_one without a row
+        return 0, 0
+    if isinstance(res, str):
+        return _status_rows(res), None
+    if isinstance(res, asyncpg.protocol.Record):
+        return 1, _record_size(res)
+    if isinstance(res, list):
+        if not res:
+            return 0, 0
+        if isinstance(res[0], asyncpg.protocol.Record):
+            return len(res), _record_size(res[0]) * len(res)
+    return None, None
+
+
+class _CountingReader:
+    def __init__(self, f: IO[bytes]) -> None:
+        self._f = f
+        self.bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self.bytes += len(data)
+        return data
+
+
+class _CountingWriter:
+    def __init__(self, f: IO[bytes]) -> None:
+        self._f = f
+        self.bytes = 0
+
+    def write(self, data: bytes) -> int:
+        self.bytes += len(data)
+        return self._f.write(data)
+
+
+class _CountingIterable:
+    def __init__(self, source: AsyncIterable[bytes]) -> None:
+        self._source = source
+        self.bytes = 0
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for data in self._source:
+            self.bytes += len(data)
+            yield data
+
+
+class _CountingCallback:
+    def __init__(self, callback: Callable[[bytes], Awaitable[None]]) -> None:
+        self._callback = callback
+        self.bytes = 0
+
+    async def __call__(self, data: bytes) -> None:
+        self.bytes += len(data)
+        await self._callback(data)
+
+
+# errors meaning the server or the network is in trouble rather than the
+# query, these count against a replica's health. Timeouts of queries and
+# expired deadlines say nothing about the server
+_CONNECTION_ERRORS = (OSError,
+                      asyncpg.exceptions.PostgresConnectionError,
+                      asyncpg.exceptions.CannotConnectNowError)
+
+
+class DrainingError(Exception):
+    """
+    Raised on acquiring a connection from a component that is stopping
+    """
+
+
+def _isolation_level(isolation_level: Optional[str]) -> str:
+    isolation = (isolation_level or 'read_committed').lower()
+    isolation = isolation.replace(' ', '_')
+    if isolation not in ISOLATION_LEVELS:
+        raise UserWarning('Unknown isolation level %r' % isolation_level)
+    return isolation
+
+
+def _begin_statement(isolation: str, readonly: bool,
+                     deferrable: bool) -> str:
+    parts = ['BEGIN ISOLATION LEVEL', isolation.replace('_', ' ').upper()]
+    if readonly:
+        parts.append('READ ONLY')
+    if deferrable:
+        parts.append('DEFERRABLE')
+    return ' '.join(parts)
+
+
+def _raw_connection(conn: Any) -> asyncpg.connection.Connection:
+    # PoolConnectionProxy wraps the physical connection which outlives
+    # the proxy across pool acquires
+    return getattr(conn, '_con', None) or conn
+
+
+def _release_statement(conn: asyncpg.connection.Connection,
+                       state: Any) -> None:
+    # the statement is closed on the server once nothing references it
+    state.detach()
+    conn._maybe_gc_stmt(state)
+
+
+class StatementCache:
+    """
+    LRU registry of prepared statements of one physical connection keyed
+    by query id.
+
+    It keeps the low-level statement states, not PreparedStatement
+    objects: asyncpg refuses to use a PreparedStatement after its
+    connection went back to the pool, so every acquire binds a new one to
+    the cached state. States do not reference the connection, the cache
+    does not keep it alive. Each cached state holds a reference so asyncpg
+    does not close the statement while it is cached
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._items: 'OrderedDict[str, Tuple[str, Any]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, conn: asyncpg.connection.Connection, id: str,
+            query: str) -> Optional[asyncpg.prepared_stmt.PreparedStatement]:
+        item = self._items.get(id)
+        if item is None or item[0] != query:
+            return None
+        if item[1].closed:
+            self.discard(conn, id)
+            return None
+        self._items.move_to_end(id)
+        return asyncpg.prepared_stmt.PreparedStatement(conn, query, item[1])
+
+    def put(self, conn: asyncpg.connection.Connection, id: str, query: str,
+            stmt: asyncpg.prepared_stmt.PreparedStatement) -> int:
+        """
+        Stores the statement and returns the number of evicted entries
+        """
+        self.discard(conn, id)
+        state = stmt._state
+        state.attach()
+        self._items[id] = (query, state)
+        evicted = 0
+        while len(self._items) > self.max_size:
+            _, (_, old) = self._items.popitem(last=False)
+            _release_statement(conn, old)
+            evicted += 1
+        return evicted
+
+    def discard(self, conn: asyncpg.connection.Connection, id: str) -> None:
+        item = self._items.pop(id, None)
+        if item is not None:
+            _release_statement(conn, item[1])
 
 
 class PostgresTracerConfig:
@@ -43,6 +267,10 @@ class PostgresTracerConfig:
             ctx.tag('error.message', str(err))
             ctx.annotate(traceback.format_exc())
 
+    def on_query_batch(self, ctx: 'Span', batch_no: int,
+                       rows: List[asyncpg.protocol.Record]) -> None:
+        ctx.annotate('Batch %d: %d rows' % (batch_no, len(rows)))
+
     def on_xact_begin_start(self, ctx: 'Span', isolation_level: str = None,
                             readonly: bool = False,
                             deferrable: bool = False) -> None:
@@ -72,7 +300,76 @@ class Postgres(Component):
                  pool_max_queries: int = 50000,
                  pool_max_inactive_connection_lifetime: float = 300.0,
                  connect_max_attempts: int = 10,
-                 connect_retry_delay: float = 1.0) -> None:
+                 connect_retry_delay: float = 1.0,
+                 prepared_cache_size: int = 0,
+                 json_codec: Union[str, JsonCodec] = 'json',
+                 replica_urls: Optional[List[str]] = None,
+                 replica_eject_failures: int = 3,
+                 replica_eject_time: float = 30.0,
+                 result_cache: Optional[ResultCache] = None,
+                 stop_timeout: float = 60.0,
+                 stop_cancel_timeout: float = 5.0,
+                 instrumentation: Optional[InstrumentationPolicy] = None,
+                 coalescer: Optional[ReadCoalescer] = None,
+                 sizer: Optional[AdaptivePoolSizer] = None,
+                 warmup_query: Optional[str] = None,
+                 warmup_timeout: float = 30.0,
+                 bulkheads: Optional[Bulkheads] = None,
+                 priority_aging: float = PRIORITY_AGING,
+                 explain: Optional[ExplainSampler] = None,
+                 query_stats: Optional[QueryStats] = None,
+                 health_checker: Optional[HealthChecker] = None
+                 ) -> None:
+        """
+        prepared_cache_size: when positive, query_one, query_all, execute
+        and Connection.prepare keep up to this many prepared statements per
+        physical connection keyed by query id, so they survive returning
+        the connection to the pool
+        json_codec: codec for json and jsonb values, a JsonCodec instance
+        or one of 'json', 'ujson', 'orjson', 'auto'
+        replica_urls: read replicas, each gets a pool of the same size as
+        the primary. Reads requested with readonly=True go to the replica
+        with the best latency/queue score, a replica failing
+        replica_eject_failures times in a row is skipped for
+        replica_eject_time seconds and reads fall back to the primary when
+        no replica is available
+        result_cache: caches query_one/query_all results of the query ids
+        it has a TTL for, hits are served without acquiring a connection
+        stop_timeout: on stop new acquires fail with DrainingError and
+        connections in use get this many seconds to be released, then
+        their running queries are cancelled on the server, the callers
+        get QueryCanceledError, and they get stop_cancel_timeout more
+        seconds before the connections are terminated
+        instrumentation: what goes into spans, see InstrumentationPolicy
+        coalescer: identical query_one/query_all calls running at the same
+        time share one execution, see ReadCoalescer
+        sizer: adapts the number of primary connections in use to the
+        acquire wait between sizer.min_size and sizer.max_size, which
+        replace pool_min_size and pool_max_size for the primary pool, see
+        AdaptivePoolSizer
+        warmup_query: run on every connection of the warm-up, see start()
+        warmup_timeout: time limit of the warm-up, the component starts
+        anyway once it has passed
+        bulkheads: concurrency limits by query id or id prefix, waited
+        for before the pool acquire, see Bulkheads. Calls made with
+        connection(id=...), xact(id=...) and the query helpers are
+        subject to them
+        priority_aging: connection(), xact() and the query helpers take a
+        `priority`, waiters for a primary connection with a higher one
+        are served first. Every priority_aging seconds of waiting count as
+        one priority level so low priority work is not starved
+        explain: captures the plans of slow query_one, query_all and
+        execute calls on a dedicated connection, see ExplainSampler
+        query_stats: options of the statistics by query id, which are
+        always collected, see QueryStats and query_stats()
+        health_checker: how health() and health_status() judge the
+        component without taking a connection from the pool, see
+        HealthChecker
+
+        Acquire and query timeouts are shortened to the deadline set by the
+        caller with `Deadline`, queries running out of time or whose task
+        is cancelled are cancelled on the server
+        """
         super(Postgres, self).__init__()
         self.url = url
         self.pool_min_size = pool_min_size
@@ -83,52 +380,202 @@ class Postgres(Component):
         self.connect_max_attempts = connect_max_attempts
         self.connect_retry_delay = connect_retry_delay
         self._pool: asyncpg.pool.Pool = None
-        self._connections: List['Connection'] = []
+        self._connections: Set['Connection'] = set()
+        self.stop_timeout = stop_timeout
+        self.stop_cancel_timeout = stop_cancel_timeout
+        self._draining = False
+        self._drained: Optional[asyncio.Event] = None
+        self.instrumentation = instrumentation or InstrumentationPolicy()
+        self.prepared_cache_size = prepared_cache_size
+        self.json_codec = get_json_codec(json_codec)
+        self._replicas = [Endpoint('replica%d' % i, replica_url,
+                                   eject_failures=replica_eject_failures,
+                                   eject_time=replica_eject_time)
+                          for i, replica_url in enumerate(replica_urls or [])]
+        self._balancer = ReplicaBalancer(self._replicas)
+        self.result_cache = result_cache
+        self.coalescer = coalescer
+        self._loaders: Dict[str, BatchLoader] = {}
+        self.sizer = sizer
+        self._limiter: Optional[Limiter] = None
+        self._sizer_task: Optional[asyncio.Future] = None
+        self.warmup_query = warmup_query
+        self.warmup_timeout = warmup_timeout
+        self._hot_statements: Dict[str, str] = OrderedDict()
+        self.warmup_info: Dict[str, Any] = {}
+        self.bulkheads = bulkheads
+        self.priority_aging = priority_aging
+        self.explain = explain
+        self._query_stats = query_stats or QueryStats()
+        self._slow_log_task: Optional[asyncio.Future] = None
+        self.health_checker = health_checker or HealthChecker()
+        self._stats = PoolStats()
+        self._stmt_caches: 'weakref.WeakKeyDictionary[Any, StatementCache]' \
+            = weakref.WeakKeyDictionary()
+        self._stmt_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                                  'invalidations': 0}
 
     @property
     def pool(self) -> asyncpg.pool.Pool:
         return self._pool
 
+    def _statement_cache(self, conn: Any) -> Optional[StatementCache]:
+        if self.prepared_cache_size <= 0:
+            return None
+        raw = _raw_connection(conn)
+        cache = self._stmt_caches.get(raw)
+        if cache is None:
+            cache = StatementCache(self.prepared_cache_size)
+            self._stmt_caches[raw] = cache
+        return cache
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the pool metrics: acquire wait histogram, connections
+        in use/idle, waiters and connection churn
+        """
+        snapshot = self._stats.snapshot()
+        if self.sizer is not None:
+            snapshot['sizing'] = self.sizer.snapshot()
+        if self.bulkheads is not None:
+            snapshot['bulkheads'] = self.bulkheads.snapshot()
+        if self.explain is not None:
+            snapshot['explain'] = self.explain.snapshot()
+        return snapshot
+
+    def export_stats(self, sink: MetricsSink, prefix: str = 'postgres',
+                     labels: Dict[str, str] = None) -> None:
+        """
+        Pushes the pool metrics to sink(name, value, labels) in
+        prometheus naming conventions
+        """
+        self._stats.export(sink, prefix=prefix, labels=labels)
+        if self.sizer is not None:
+            self.sizer.export(sink, prefix=prefix, labels=labels)
+        if self.bulkheads is not None:
+            self.bulkheads.export(sink, prefix=prefix, labels=labels)
+        if self.explain is not None:
+            self.explain.export(sink, prefix=prefix, labels=labels)
+        self._query_stats.export(sink, prefix=prefix, labels=labels)
+
+    def query_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Snapshot of the statistics by query id: calls, errors, rows
+        returned or affected, approximate result bytes and latency
+        quantiles
+        """
+        return self._query_stats.snapshot()
+
+    def statement_cache_info(self) -> Dict[str, int]:
+        """
+        Returns hit/miss/eviction/invalidation counters of the prepared
+        statement cache and the number of currently cached statements
+        """
+        info = dict(self._stmt_cache_stats)
+        info['size'] = sum(len(c) for c in list(self._stmt_caches.values()))
+        return info
+
     @property
     def _masked_url(self) -> Optional[str]:
         if self.url is not None:
             return mask_url_pwd(self.url)
 
-    async def _connect(self) -> None:
-        if self.app is None:
-            raise UserWarning('Unattached component')
-
-        self.app.log_info("Connecting to %s" % self._masked_url)
-        self._pool: asyncpg.pool.Pool = await asyncpg.create_pool(
-            dsn=self.url,
-            max_size=self.pool_max_size,
-            min_size=self.pool_min_size,
+    async def _create_pool(self, url: str, min_size: int = None,
+                           max_size: int = None) -> asyncpg.pool.Pool:
+        return await asyncpg.create_pool(
+            dsn=url,
+            max_size=max_size or self.pool_max_size,
+            min_size=min_size or self.pool_min_size,
             max_queries=self.pool_max_queries,
             max_inactive_connection_lifetime=(
                 self.pool_max_inactive_connection_lifetime),
-            init=Postgres._conn_init,
+            init=self._conn_init,
             loop=self.loop
         )
+
+    async def _connect(self) -> None:
+        if self.app is None:
+            raise UserWarning('Unattached component')
+
+        self.app.log_info("Connecting to %s" % self._masked_url)
+        if self.bulkheads is not None:
+            self.bulkheads.attach(self.loop, self.priority_aging)
+        # waiters queue on the limiter in front of the pool in priority
+        # order, asyncpg's own queue is FIFO
+        sizer = self.sizer
+        if sizer is None:
+            self._pool = await self._create_pool(self.url)
+            self._limiter = Limiter(self.pool_max_size, self.loop,
+                                    aging=self.priority_aging)
+        else:
+            # the pool is created with the hard bounds, the limiter sets
+            # how many connections may be in use
+            self._pool = await self._create_pool(
+                self.url, min_size=sizer.min_size, max_size=sizer.max_size)
+            self._limiter = Limiter(sizer.min_size, self.loop,
+                                    aging=self.priority_aging)
+            sizer.attach(self._limiter, self.loop.time())
         self.app.log_info("Connected to %s" % self._masked_url)
 
-    @staticmethod
-    async def _conn_init(conn: asyncpg.pool.PoolConnectionProxy) -> None:
-        def _json_encoder(value: JsonType) -> str:
-            return json.dumps(value)
+    async def _connect_replica(self, endpoint: Endpoint) -> None:
+        masked_url = mask_url_pwd(endpoint.url)
+        endpoint.connecting = True
+        try:
+            self.app.log_info("Connecting to %s" % masked_url)
+            endpoint.pool = await self._create_pool(endpoint.url)
+            self.app.log_info("Connected to %s" % masked_url)
+        except Exception as e:
+            self.app.log_err("Could not connect to replica %s: %s"
+                             "" % (masked_url, e))
+            endpoint.ejected_until = self.loop.time() + endpoint.eject_time
+        finally:
+            endpoint.connecting = False
+
+    def _route(self, readonly: bool) -> Optional[Endpoint]:
+        """
+        Returns the replica to serve a read or None for the primary
+        """
+        if not readonly or not self._replicas:
+            return None
+        now = self.loop.time()
+        for endpoint in self._replicas:
+            if (endpoint.pool is None and not endpoint.connecting and
+                    now >= endpoint.ejected_until):
+                asyncio.ensure_future(self._connect_replica(endpoint),
+                                      loop=self.loop)
+        return self._balancer.choose(now)
+
+    def _replica_failed(self, endpoint: Endpoint) -> None:
+        if endpoint.fail(self.loop.time()):
+            self.app.log_err("Replica %s is ejected for %ss"
+                             "" % (endpoint.name, endpoint.eject_time))
+
+    async def _conn_init(self,
+                         conn: asyncpg.pool.PoolConnectionProxy) -> None:
+        self._stats.connection_created()
+        weakref.finalize(_raw_connection(conn), self._stats.connection_closed)
+        await self._set_json_codecs(conn)
 
-        def _json_decoder(value: str) -> JsonType:
-            return json.loads(value)
+    async def _set_json_codecs(self, conn: Any) -> None:
+        codec = self.json_codec
 
+        def _json_decoder(value: bytes) -> JsonType:
+            return codec.loads(value)
+
+        # json is sent as plain text in binary format as well, binary
+        # format hands the decoder bytes that can be parsed without
+        # decoding them to str first
         await conn.set_type_codec(
-            'json', encoder=_json_encoder, decoder=_json_decoder,
-            schema='pg_catalog'
+            'json', encoder=codec.dumps, decoder=_json_decoder,
+            schema='pg_catalog', format='binary'
         )
 
         def _jsonb_encoder(value: JsonType) -> bytes:
-            return b'\x01' + json.dumps(value).encode('utf-8')
+            return b'\x01' + codec.dumps(value)
 
         def _jsonb_decoder(value: bytes) -> JsonType:
-            return json.loads(value[1:].decode('utf-8'))
+            # skip the jsonb version byte without copying the document
+            return codec.loads(memoryview(value)[1:])
 
         # Example was got from https://github.com/MagicStack/asyncpg/issues/140
         await conn.set_type_codec(
@@ -146,132 +593,870 @@ class Postgres(Component):
         for i in range(self.connect_max_attempts):
             try:
                 await self._connect()
+                if self._replicas:
+                    await asyncio.gather(
+                        *[self._connect_replica(endpoint)
+                          for endpoint in self._replicas], loop=self.loop)
                 return
             except Exception as e:
                 self.app.log_err(str(e))
                 await asyncio.sleep(self.connect_retry_delay)
         raise PrepareError("Could not connect to %s" % self._masked_url)
 
+    def register_statement(self, id: str, query: str) -> None:
+        """
+        Registers a hot statement to prepare on every connection during the
+        warm-up, so the first requests do not pay for parsing and planning
+        it. With prepared_cache_size set they go to the statement cache of
+        the component, otherwise to asyncpg's statement cache used by
+        query_one, query_all and execute with arguments
+        """
+        self._hot_statements[id] = query
+
     async def start(self) -> None:
-        pass
+        """
+        Warms the pool up when hot statements or a warm-up query are set,
+        the component serves requests at steady-state latency once this
+        returns
+        """
+        await self._warmup()
+        if self.sizer is not None:
+            self._sizer_task = asyncio.ensure_future(
+                self._resize_loop(self.sizer), loop=self.loop)
+        if self.explain is not None:
+            self.explain.attach(self)
+        if self._query_stats.slow_log_interval:
+            self._slow_log_task = asyncio.ensure_future(
+                self._slow_log_loop(self._query_stats), loop=self.loop)
+
+    async def _warmup(self) -> None:
+        """
+        Holds the minimum number of pool connections at once, so each of
+        them is open, then prepares the hot statements and runs the
+        warm-up query on all of them concurrently. Failures are logged,
+        they do not prevent the start
+        """
+        if self._pool is None or not (self._hot_statements or
+                                      self.warmup_query):
+            return
+        size = (self.sizer.min_size if self.sizer is not None
+                else self.pool_min_size)
+        started = self.loop.time()
+        timings = {'acquire': 0.0, 'prepare': 0.0, 'query': 0.0}
+        held = 0
+        all_held = asyncio.Event(loop=self.loop)
+
+        async def _warm_one() -> None:
+            nonlocal held
+            try:
+                async with self.connection(None) as conn:
+                    held += 1
+                    if held == size:
+                        all_held.set()
+                    timings['acquire'] = max(timings['acquire'],
+                                             self.loop.time() - started)
+                    await all_held.wait()
+                    start = self.loop.time()
+                    for id, query in self._hot_statements.items():
+                        await conn._warm_statement(id, query)
+                    timings['prepare'] = max(timings['prepare'],
+                                             self.loop.time() - start)
+                    if self.warmup_query:
+                        start = self.loop.time()
+                        await conn.execute(None, 'warmup',
+                                           self.warmup_query)
+                        timings['query'] = max(timings['query'],
+                                               self.loop.time() - start)
+            finally:
+                # do not keep the others waiting for a failed acquire
+                all_held.set()
+
+        tasks = [asyncio.ensure_future(_warm_one(), loop=self.loop)
+                 for _ in range(size)]
+        done, pending = await asyncio.wait(tasks, timeout=self.warmup_timeout,
+                                           loop=self.loop)
+        for task in pending:
+            task.cancel()
+        errors = [task.exception() for task in done if task.exception()]
+        if errors:
+            self.app.log_err("Warm-up of %s failed: %r"
+                             "" % (self._masked_url, errors[0]))
+        self.warmup_info = dict(
+            timings, total=self.loop.time() - started, connections=size,
+            statements=len(self._hot_statements),
+            failed=len(errors) + len(pending))
+        self.app.log_info(
+            "Warmed up %d connections to %s in %.3fs (acquire %.3fs, "
+            "prepare %.3fs, query %.3fs, failed %d)"
+            "" % (size, self._masked_url, self.warmup_info['total'],
+                  timings['acquire'], timings['prepare'], timings['query'],
+                  self.warmup_info['failed']))
+
+    async def _resize_loop(self, sizer: AdaptivePoolSizer) -> None:
+        while True:
+            await asyncio.sleep(sizer.interval, loop=self.loop)
+            try:
+                decision = sizer.tick(self.loop.time())
+            except Exception as e:
+                self.app.log_err(str(e))
+                continue
+            if decision is not None:
+                self.app.log_info(
+                    "Pool of %s resized from %d to %d (%s)"
+                    "" % (self._masked_url, decision.old, decision.new,
+                          decision.reason))
+
+    async def _slow_log_loop(self, stats: QueryStats) -> None:
+        while True:
+            await asyncio.sleep(stats.slow_log_interval, loop=self.loop)
+            slow = stats.take_slow()
+            if slow:
+                self.app.log_info(
+                    "Slow queries to %s in the last %ss: %s"
+                    "" % (self._masked_url, stats.slow_log_interval,
+                          ', '.join('%s (%d, max %.3fs)' % item
+                                    for item in slow)))
 
     async def stop(self) -> None:
         if self.app is None:
             raise UserWarning('Unattached component')
 
-        stop_timeout = 60
-        stop_start = time.time()
-
-        xact_locks = [conn._xact_lock.acquire() for conn in self._connections
-                      if conn._xact_lock is not None]
-        if len(xact_locks) > 0:
-            await asyncio.wait(xact_locks, loop=self.loop,
-                               timeout=max(
-                                   stop_timeout - stop_start + stop_start,
-                                   0.001))
-
-        conn_locks = [conn._lock.acquire() for conn in self._connections
-                      if conn._lock is not None]
-        if len(conn_locks):
-            await asyncio.wait(conn_locks, loop=self.loop,
-                               timeout=max(
-                                   stop_timeout - stop_start + stop_start,
-                                   0.001))
+        self._draining = True
+        for task in (self._sizer_task, self._slow_log_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._sizer_task = self._slow_log_task = None
+        if self.explain is not None:
+            await self.explain.detach()
+        await self.health_checker.detach()
+        deadline = self.loop.time() + self.stop_timeout
+        if self._connections:
+            await self._drain(deadline)
 
+        pools = []
         if self.pool:
-            self.app.log_info("Disconnecting from %s" % self._masked_url)
-            await self.pool.close()
+            pools.append((self._masked_url, self.pool))
+        for endpoint in self._replicas:
+            if endpoint.pool is not None:
+                pools.append((mask_url_pwd(endpoint.url), endpoint.pool))
+                endpoint.pool = None
+        for masked_url, pool in pools:
+            self.app.log_info("Disconnecting from %s" % masked_url)
+            try:
+                await asyncio.wait_for(
+                    pool.close(),
+                    max(deadline + self.stop_cancel_timeout -
+                        self.loop.time(), 0.001),
+                    loop=self.loop)
+            except asyncio.TimeoutError:
+                self.app.log_err("Terminating connections to %s"
+                                 "" % masked_url)
+                pool.terminate()
+        if self.sizer is not None:
+            self.sizer.detach()
+
+    async def _wait_drained(self, timeout: float) -> None:
+        self._drained = asyncio.Event(loop=self.loop)
+        if not self._connections:
+            return
+        try:
+            await asyncio.wait_for(self._drained.wait(), max(timeout, 0),
+                                   loop=self.loop)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _drain(self, deadline: float) -> None:
+        while self._connections:
+            left = deadline - self.loop.time()
+            if left <= 0:
+                break
+            self.app.log_info("Draining %s: %d connections in use, %.1fs "
+                              "left" % (self._masked_url,
+                                        len(self._connections), left))
+            await self._wait_drained(min(left, DRAIN_LOG_INTERVAL))
+
+        if not self._connections:
+            self.app.log_info("Drained %s" % self._masked_url)
+            return
+
+        self.app.log_err("Drain deadline of %s exceeded, cancelling the "
+                         "queries of %d connections in use"
+                         "" % (self._masked_url, len(self._connections)))
+        by_url: Dict[str, List[int]] = {}
+        for conn in list(self._connections):
+            url = (conn._endpoint.url if conn._endpoint is not None
+                   else self.url)
+            by_url.setdefault(url, []).append(
+                _raw_connection(conn._conn).get_server_pid())
+        await asyncio.gather(*[self._cancel_queries(url, pids)
+                               for url, pids in by_url.items()],
+                             loop=self.loop)
+        await self._wait_drained(self.stop_cancel_timeout)
+        if self._connections:
+            self.app.log_err("%d connections to %s were not released, "
+                             "terminating them"
+                             "" % (len(self._connections), self._masked_url))
+            for conn in list(self._connections):
+                _raw_connection(conn._conn).terminate()
+
+    async def _cancel_queries(self, url: str, pids: List[int]) -> None:
+        """
+        Cancels the queries running on the server processes from a
+        separate connection, the callers get QueryCanceledError and their
+        tasks go on
+        """
+        try:
+            conn = await asyncpg.connect(dsn=url,
+                                         timeout=self.stop_cancel_timeout,
+                                         loop=self.loop)
+        except Exception as e:
+            self.app.log_err("Could not cancel queries on %s: %s"
+                             "" % (mask_url_pwd(url), e))
+            return
+        try:
+            await conn.execute('SELECT pg_cancel_backend(pid) '
+                               'FROM unnest($1::int[]) AS pid', pids,
+                               timeout=self.stop_cancel_timeout)
+        except Exception as e:
+            self.app.log_err("Could not cancel queries on %s: %s"
+                             "" % (mask_url_pwd(url), e))
+        finally:
+            conn.terminate()
 
     def connection(self, ctx: Span,
                    acquire_timeout=None,
-                   tracer_config: Optional[PostgresTracerConfig] = None
+                   tracer_config: Optional[PostgresTracerConfig] = None,
+                   readonly: bool = False, id: Optional[str] = None,
+                   priority: int = PRIORITY_NORMAL
                    ) -> 'ConnectionContextManager':
+        """
+        Acquires a connection, `id` is the query id or class the
+        connection is used for, it selects the bulkhead. Waiters with a
+        higher `priority` get connections first
+        """
         return ConnectionContextManager(self, ctx,
                                         acquire_timeout=acquire_timeout,
-                                        tracer_config=tracer_config)
+                                        tracer_config=tracer_config,
+                                        readonly=readonly, id=id,
+                                        priority=priority)
+
+    def xact(self, ctx: Span,
+             isolation_level: str = None,
+             readonly: bool = False, deferrable: bool = False,
+             acquire_timeout=None,
+             tracer_config: Optional[PostgresTracerConfig] = None,
+             id: Optional[str] = None, priority: int = PRIORITY_NORMAL
+             ) -> 'ConnectionXactContextManager':
+        """
+        Acquires a connection and starts a transaction on it. Read-only
+        transactions are routed to a replica when replicas are configured
+        """
+        return ConnectionXactContextManager(
+            self, ctx, isolation_level=isolation_level, readonly=readonly,
+            deferrable=deferrable, acquire_timeout=acquire_timeout,
+            tracer_config=tracer_config, id=id, priority=priority)
+
+    async def run_in_xact(self, ctx: Span,
+                          fn: Callable[['Connection'], Awaitable[Any]],
+                          isolation_level: str = 'serializable',
+                          readonly: bool = False, deferrable: bool = False,
+                          max_retries: int = XACT_MAX_RETRIES,
+                          backoff: float = XACT_RETRY_BACKOFF,
+                          max_backoff: float = XACT_RETRY_MAX_BACKOFF,
+                          id: str = 'run_in_xact',
+                          acquire_timeout=None,
+                          tracer_config: Optional[
+                              PostgresTracerConfig] = None,
+                          priority: int = PRIORITY_NORMAL) -> Any:
+        """
+        Runs `fn(conn)` in a transaction and returns its result. On a
+        serialization failure or a deadlock the transaction is retried up
+        to `max_retries` times on a freshly acquired connection, waiting
+        a random time up to backoff * 2 ** retry (capped by max_backoff)
+        in between. fn must be safe to run again.
+
+        Every attempt gets its own span, retries are counted in stats()
+        """
+        stats = self._stats
+        attempt = 0
+        while True:
+            attempt += 1
+            stats.xact_attempts += 1
+            span = self.instrumentation.new_span(
+                ctx, "db:xact:%s" % id, id, SPAN_KIND_POSTRGES_QUERY, None)
+            try:
+                if span is not None:
+                    span.tag('attempt', str(attempt))
+                    span.start()
+                async with self.xact(span or ctx,
+                                     isolation_level=isolation_level,
+                                     readonly=readonly,
+                                     deferrable=deferrable,
+                                     acquire_timeout=acquire_timeout,
+                                     tracer_config=tracer_config,
+                                     id=id, priority=priority) as conn:
+                    res = await fn(conn)
+            except asyncpg.exceptions.PostgresError as err:
+                if span is not None:
+                    span.finish(exception=err)
+                if getattr(err, 'sqlstate', None) not in \
+                        XACT_RETRY_SQLSTATES:
+                    raise
+                if attempt > max_retries:
+                    stats.xact_retries_exhausted += 1
+                    raise
+                delay = random.uniform(  # nosec
+                    0, min(max_backoff, backoff * 2 ** (attempt - 1)))
+                left = remaining()
+                if left is not None and left <= delay:
+                    stats.xact_retries_exhausted += 1
+                    raise
+                stats.xact_retries += 1
+                await asyncio.sleep(delay, loop=self.loop)
+                continue
+            except Exception as err:
+                if span is not None:
+                    span.finish(exception=err)
+                raise
+            if span is not None:
+                span.finish()
+            return res
 
     async def query_one(self, ctx: Span, id: str, query: str,
                         *args: Any, timeout: float = None,
-                        tracer_config: Optional[PostgresTracerConfig] = None
+                        tracer_config: Optional[PostgresTracerConfig] = None,
+                        readonly: bool = False,
+                        priority: int = PRIORITY_NORMAL
                         ) -> asyncpg.protocol.Record:
-        async with self.connection(ctx,
-                                   tracer_config=tracer_config) as conn:
-            return await conn.query_one(ctx, id, query, *args,
-                                        timeout=timeout,
-                                        tracer_config=tracer_config)
+        return await self._read(ctx, 'query_one', id, query, args,
+                                timeout, tracer_config, readonly, priority)
 
     async def query_all(self, ctx: Span, id: str, query: str,
                         *args: Any, timeout: float = None,
-                        tracer_config: Optional[PostgresTracerConfig] = None
+                        tracer_config: Optional[PostgresTracerConfig] = None,
+                        readonly: bool = False,
+                        priority: int = PRIORITY_NORMAL
                         ) -> List[asyncpg.protocol.Record]:
-        async with self.connection(ctx,
-                                   tracer_config=tracer_config) as conn:
-            return await conn.query_all(ctx, id, query, *args,
-                                        timeout=timeout,
-                                        tracer_config=tracer_config)
+        return await self._read(ctx, 'query_all', id, query, args,
+                                timeout, tracer_config, readonly, priority)
+
+    async def _read(self, ctx: Span, method: str, id: str, query: str,
+                    args: tuple, timeout: Optional[float],
+                    tracer_config: Optional[PostgresTracerConfig],
+                    readonly: bool, priority: int = PRIORITY_NORMAL) -> Any:
+        cache = self.result_cache
+        ttl = cache.ttl_for(id) if cache is not None else None
+        key = None
+        if cache is not None and ttl is not None:
+            key = (method, id, query, args)
+            try:
+                hit, res = cache.get(key, self.loop.time())
+            except TypeError:
+                # unhashable arguments are never cached
+                key = None
+            else:
+                if hit:
+                    self._trace_cache_hit(ctx, id)
+                    return list(res) if method == 'query_all' else res
+        coalescer = self.coalescer
+        if coalescer is not None and coalescer.enabled(id):
+            try:
+                flight = coalescer.get((method, id, query, args, readonly))
+            except TypeError:
+                # unhashable arguments are never coalesced
+                pass
+            else:
+                res = await self._coalesced(
+                    ctx, coalescer, flight, method, id, query, args,
+                    timeout, tracer_config, readonly, priority, key, ttl)
+                return list(res) if method == 'query_all' else res
+        return await self._fetch(ctx, method, id, query, args, timeout,
+                                 tracer_config, readonly, priority, key, ttl)
+
+    async def _fetch(self, ctx: Span, method: str, id: str, query: str,
+                     args: tuple, timeout: Optional[float],
+                     tracer_config: Optional[PostgresTracerConfig],
+                     readonly: bool, priority: int, key: Any,
+                     ttl: Optional[float]) -> Any:
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   readonly=readonly, id=id,
+                                   priority=priority) as conn:
+            res = await getattr(conn, method)(ctx, id, query, *args,
+                                              timeout=timeout,
+                                              tracer_config=tracer_config)
+        cache = self.result_cache
+        if cache is not None and ttl is not None and key is not None:
+            cache.put(key, id,
+                      list(res) if method == 'query_all' else res,
+                      ttl, self.loop.time())
+        return res
+
+    async def _coalesced(self, ctx: Span, coalescer: ReadCoalescer,
+                         flight: Optional[Flight], method: str, id: str,
+                         query: str, args: tuple, timeout: Optional[float],
+                         tracer_config: Optional[PostgresTracerConfig],
+                         readonly: bool, priority: int, key: Any,
+                         ttl: Optional[float]) -> Any:
+        """
+        Every caller gets its own span tagged with the flight id, the
+        acquire and query spans of the shared execution are children of
+        the span of the caller that started it
+        """
+        span = self.instrumentation.new_span(
+            ctx, "db:coalesced:%s" % id, id, SPAN_KIND_POSTRGES_QUERY, None)
+        try:
+            if span is not None:
+                span.tag('coalesced', 'follower' if flight else 'leader')
+                span.start()
+            if flight is None:
+                flight = coalescer.start(
+                    (method, id, query, args, readonly),
+                    self._fetch(span or ctx, method, id, query, args,
+                                timeout, tracer_config, readonly, priority,
+                                key, ttl),
+                    self.loop)
+            if span is not None:
+                span.tag('flight', str(flight.id))
+            res = await flight.wait(effective_timeout(timeout))
+        except asyncio.CancelledError:
+            if span is not None:
+                span.finish()
+            raise
+        except Exception as err:
+            if span is not None:
+                span.finish(exception=err)
+            raise
+        if span is not None:
+            span.finish()
+        return res
+
+    def _trace_cache_hit(self, ctx: Span, id: str) -> None:
+        span = self.instrumentation.new_span(
+            ctx, "db:%s" % id, id, SPAN_KIND_POSTRGES_QUERY, 'cache')
+        if span is None:
+            return
+        span.tag('cache', 'hit')
+        span.start()
+        span.finish()
+
+    def invalidate_cache(self, id: Optional[str] = None,
+                         prefix: Optional[str] = None) -> int:
+        """
+        Drops cached results of the query id or of the query ids starting
+        with prefix, everything when called without arguments
+        """
+        if self.result_cache is None:
+            return 0
+        return self.result_cache.invalidate(id=id, prefix=prefix)
+
+    def register_loader(self, id: str, query: str, key_column: str = 'id',
+                        max_batch_size: int = LOADER_MAX_BATCH_SIZE,
+                        window: float = 0.0, timeout: float = None,
+                        readonly: bool = False) -> BatchLoader:
+        """
+        Registers a batched loader for point lookups by key, the query
+        takes the array of keys as $1 and returns rows having the key in
+        `key_column`, see BatchLoader
+        """
+        loader = BatchLoader(self, id, query, key_column=key_column,
+                             max_batch_size=max_batch_size, window=window,
+                             timeout=timeout, readonly=readonly)
+        self._loaders[id] = loader
+        return loader
+
+    def _loader(self, id: str) -> BatchLoader:
+        loader = self._loaders.get(id)
+        if loader is None:
+            raise UserWarning('No loader registered for %r' % id)
+        return loader
+
+    async def load(self, ctx: Span, id: str, key: Any
+                   ) -> Optional[asyncpg.protocol.Record]:
+        """
+        Returns the row of the key through the loader registered for the
+        query id, None when there is no such row
+        """
+        return await self._loader(id).load(ctx, key)
+
+    async def load_many(self, ctx: Span, id: str, keys: Iterable[Any]
+                        ) -> List[Optional[asyncpg.protocol.Record]]:
+        return await self._loader(id).load_many(ctx, keys)
 
     async def execute(self, ctx: Span, id: str, query: str,
                       *args: Any, timeout: float = None,
-                      tracer_config: Optional[PostgresTracerConfig] = None
+                      tracer_config: Optional[PostgresTracerConfig] = None,
+                      priority: int = PRIORITY_NORMAL
                       ) -> str:
-        async with self.connection(ctx,
-                                   tracer_config=tracer_config) as conn:
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   id=id, priority=priority) as conn:
             return await conn.execute(ctx, id, query, *args,
                                       timeout=timeout,
                                       tracer_config=tracer_config)
 
+    async def xact_batch(self, ctx: Span, id: str,
+                         statements: Sequence[Tuple[str, Sequence[Any]]],
+                         isolation_level: str = None,
+                         readonly: bool = False, deferrable: bool = False,
+                         timeout: float = None,
+                         tracer_config: Optional[
+                             PostgresTracerConfig] = None,
+                         priority: int = PRIORITY_NORMAL) -> List[str]:
+        """
+        Runs the statements in one transaction on a single connection and
+        returns their command statuses, see Connection.xact_batch
+        """
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   readonly=readonly, id=id,
+                                   priority=priority) as conn:
+            return await conn.xact_batch(
+                ctx, id, statements, isolation_level=isolation_level,
+                readonly=readonly, deferrable=deferrable, timeout=timeout,
+                tracer_config=tracer_config)
+
+    async def execute_many(self, ctx: Span, id: str, query: str,
+                           args_iter: Iterable[Sequence[Any]],
+                           batch_size: int = EXECUTE_MANY_BATCH_SIZE,
+                           timeout: float = None,
+                           tracer_config: Optional[
+                               PostgresTracerConfig] = None
+                           ) -> int:
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   id=id) as conn:
+            return await conn.execute_many(ctx, id, query, args_iter,
+                                           batch_size=batch_size,
+                                           timeout=timeout,
+                                           tracer_config=tracer_config)
+
+    async def query_stream(self, ctx: Span, id: str, query: str,
+                           *args: Any, prefetch: int = QUERY_ITER_PREFETCH,
+                           batches: bool = False, timeout: float = None,
+                           tracer_config: Optional[
+                               PostgresTracerConfig] = None,
+                           readonly: bool = False,
+                           priority: int = PRIORITY_NORMAL
+                           ) -> AsyncIterator[Any]:
+        """
+        Acquires a connection and streams the result of the query through
+        a server-side cursor. The connection is held until the iterator is
+        exhausted or closed, so break out of it with `aclose()` rather than
+        abandoning it.
+        """
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   readonly=readonly, id=id,
+                                   priority=priority) as conn:
+            async for item in conn.query_iter(ctx, id, query, *args,
+                                              prefetch=prefetch,
+                                              batches=batches,
+                                              timeout=timeout,
+                                              tracer_config=tracer_config):
+                yield item
+
+    async def copy_records_to_table(self, ctx: Span, id: str,
+                                    table_name: str, *,
+                                    records: Iterable[Any],
+                                    columns: Optional[List[str]] = None,
+                                    schema_name: Optional[str] = None,
+                                    timeout: float = None,
+                                    tracer_config: Optional[
+                                        PostgresTracerConfig] = None
+                                    ) -> str:
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   id=id) as conn:
+            return await conn.copy_records_to_table(
+                ctx, id, table_name, records=records, columns=columns,
+                schema_name=schema_name, timeout=timeout,
+                tracer_config=tracer_config)
+
+    async def copy_to_table(self, ctx: Span, id: str, table_name: str, *,
+                            source: CopySource,
+                            columns: Optional[List[str]] = None,
+                            schema_name: Optional[str] = None,
+                            timeout: float = None,
+                            tracer_config: Optional[
+                                PostgresTracerConfig] = None,
+                            **options: Any) -> str:
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   id=id) as conn:
+            return await conn.copy_to_table(
+                ctx, id, table_name, source=source, columns=columns,
+                schema_name=schema_name, timeout=timeout,
+                tracer_config=tracer_config, **options)
+
+    async def copy_from_query(self, ctx: Span, id: str, query: str,
+                              *args: Any, output: CopyOutput,
+                              timeout: float = None,
+                              tracer_config: Optional[
+                                  PostgresTracerConfig] = None,
+                              **options: Any) -> str:
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   id=id) as conn:
+            return await conn.copy_from_query(
+                ctx, id, query, *args, output=output, timeout=timeout,
+                tracer_config=tracer_config, **options)
+
+    async def copy_from_query_iter(self, ctx: Span, id: str, query: str,
+                                   *args: Any,
+                                   queue_size: int = COPY_ITER_QUEUE_SIZE,
+                                   timeout: float = None,
+                                   tracer_config: Optional[
+                                       PostgresTracerConfig] = None,
+                                   **options: Any) -> AsyncIterator[bytes]:
+        async with self.connection(ctx, tracer_config=tracer_config,
+                                   id=id) as conn:
+            async for data in conn.copy_from_query_iter(
+                    ctx, id, query, *args, queue_size=queue_size,
+                    timeout=timeout, tracer_config=tracer_config,
+                    **options):
+                yield data
+
+    async def health_status(self, ctx: Span = None) -> HealthStatus:
+        """
+        Returns HealthStatus(status, reasons, time) with the status
+        HEALTHY, DEGRADED or UNHEALTHY, cached for a short time. It does
+        not wait for a pool connection, see HealthChecker
+        """
+        return await self.health_checker.check(self)
+
     async def health(self, ctx: Span):
-        async with self.connection(ctx) as conn:
-            await conn.execute(ctx, 'test', 'SELECT 1')
+        """
+        Raises UnhealthyError when the component is unhealthy, a degraded
+        component is still healthy for the application
+        """
+        status = await self.health_status(ctx)
+        if status.status == UNHEALTHY:
+            raise UnhealthyError(status)
 
 
 class ConnectionContextManager:
     def __init__(self, db: Postgres, ctx: Span,
                  acquire_timeout: float = None,
-                 tracer_config: Optional[PostgresTracerConfig] = None) -> None:
+                 tracer_config: Optional[PostgresTracerConfig] = None,
+                 readonly: bool = False, id: Optional[str] = None,
+                 priority: int = PRIORITY_NORMAL) -> None:
         self._db = db
         self._conn = None
+        self._id = id
+        self._priority = priority
         self._ctx = ctx
         self._acquire_timeout = acquire_timeout
         self._tracer_config = tracer_config
+        self._readonly = readonly
+        self._pool: asyncpg.pool.Pool = None
+        self._endpoint: Optional[Endpoint] = None
         self._pg_conn: Optional['Connection'] = None
+        self._acquire_time: Optional[float] = None
+        self._limiter: Optional[Limiter] = None
+        self._bulkhead: Optional[Bulkhead] = None
+
+    async def _pool_acquire(self, pool: asyncpg.pool.Pool,
+                            limiter: Optional[Limiter] = None
+                            ) -> asyncpg.pool.PoolConnectionProxy:
+        stats = self._db._stats
+        loop = self._db.loop
+        acquire_timeout = self._acquire_timeout
+        if acquire_timeout is not None and self._acquire_time is not None:
+            # the bulkhead wait and a failed replica acquire count against
+            # the acquire timeout
+            acquire_timeout -= self._acquire_time
+            if acquire_timeout <= 0:
+                # already counted by the acquire that used the time up
+                raise asyncio.TimeoutError()
+        timeout = effective_timeout(acquire_timeout)
+        by_deadline = timeout is not None and (acquire_timeout is None or
+                                               timeout < acquire_timeout)
+        stats.waiting += 1
+        start = loop.time()
+        try:
+            if limiter is not None:
+                await limiter.acquire(timeout, self._priority)
+                if timeout is not None:
+                    timeout -= loop.time() - start
+            acquired = False
+            try:
+                conn = await pool.acquire(timeout=timeout)
+                acquired = True
+            finally:
+                if limiter is not None and not acquired:
+                    limiter.release()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError as err:
+            stats.acquire_timeouts += 1
+            if by_deadline:
+                # the wait was cut short by the deadline of the caller
+                raise DeadlineExceededError('Deadline exceeded') from err
+            raise
+        except Exception:
+            stats.acquire_errors += 1
+            raise
+        finally:
+            stats.waiting -= 1
+            waited = loop.time() - start
+            self._acquire_time = (self._acquire_time or 0) + waited
+        self._limiter = limiter
+        stats.observe_acquire_wait(waited, self._priority)
+        stats.acquires += 1
+        stats.in_use += 1
+        return conn
+
+    async def _acquire_replica(self, endpoint: Endpoint) -> None:
+        endpoint.inflight += 1
+        try:
+            self._conn = await self._pool_acquire(endpoint.pool)
+        except DeadlineExceededError:
+            endpoint.inflight -= 1
+            raise
+        except (asyncio.TimeoutError,) + _CONNECTION_ERRORS:
+            # the replica could not hand out a connection
+            endpoint.inflight -= 1
+            self._db._replica_failed(endpoint)
+            return
+        self._pool = endpoint.pool
+        self._endpoint = endpoint
+
+    async def _acquire_bulkhead(self, span: Optional[Span]) -> None:
+        bulkheads = self._db.bulkheads
+        if bulkheads is None:
+            return
+        bulkhead = bulkheads.get(self._id)
+        if bulkhead is None:
+            return
+        self._acquire_time = await bulkhead.acquire(
+            effective_timeout(self._acquire_timeout), self._priority)
+        self._bulkhead = bulkhead
+        if span:
+            span.tag('bulkhead', bulkhead.name)
+            span.tag('bulkhead_wait', '%.6f' % self._acquire_time)
 
     async def __aenter__(self) -> 'Connection':
+        if self._db._draining:
+            raise DrainingError('Postgres component is stopping')
+        policy = self._db.instrumentation
         span = None
-        if self._ctx:
-            span = self._ctx.new_child()
+        if not policy.fold_acquire:
+            span = policy.new_span(self._ctx, "db:Acquire", 'Acquire',
+                                   SPAN_KIND_POSTRGES_ACQUIRE, None)
         try:
             if span:
-                span.kind(CLIENT)
-                span.name("db:Acquire")
-                span.metrics_tag(SPAN_TYPE, SPAN_TYPE_POSTGRES)
-                span.metrics_tag(SPAN_KIND, SPAN_KIND_POSTRGES_ACQUIRE)
-                span.metrics_tag('query_id', 'Acquire')
-                span.remote_endpoint("postgres")
                 span.start()
                 if self._tracer_config:
                     self._tracer_config.on_acquire_start(span)
-            self._conn = await self._db._pool.acquire(
-                timeout=self._acquire_timeout)
+            # an expired deadline fails here, not against an endpoint
+            effective_timeout(self._acquire_timeout)
+            await self._acquire_bulkhead(span)
+            endpoint = self._db._route(self._readonly)
+            if endpoint is not None:
+                await self._acquire_replica(endpoint)
+            if self._conn is None:
+                # primary, or fallback when the replica failed
+                self._conn = await self._pool_acquire(self._db._pool,
+                                                      self._db._limiter)
+                self._pool = self._db._pool
+            if self._db._draining:
+                # the acquire was queued before stop() began
+                await self._release(None)
+                raise DrainingError('Postgres component is stopping')
             if span:
+                span.tag('endpoint', self._endpoint.name
+                         if self._endpoint else 'primary')
                 if self._tracer_config:
                     self._tracer_config.on_acquire_end(span, None)
                 span.finish()
         except Exception as err:
+            if span is None and policy.fold_acquire:
+                # failures stay visible with folded acquire spans
+                span = policy.new_span(self._ctx, "db:Acquire", 'Acquire',
+                                       SPAN_KIND_POSTRGES_ACQUIRE, None)
+                if span:
+                    span.start()
             if span:
                 if self._tracer_config:
                     self._tracer_config.on_acquire_end(span, err)
                 span.finish(exception=err)
+            if self._bulkhead is not None and self._conn is None:
+                self._bulkhead.release()
+                self._bulkhead = None
             raise
-        self._pg_conn = Connection(self._db, self._conn)
-        self._db._connections.append(self._pg_conn)
+        self._pg_conn = Connection(self._db, self._conn, self._endpoint)
+        if policy.fold_acquire:
+            self._pg_conn._acquire_time = self._acquire_time
+        self._db._connections.add(self._pg_conn)
         return self._pg_conn
 
     async def __aexit__(self, exc_type: type, exc: BaseException,
                         tb: type) -> bool:
+        try:
+            if self._pg_conn is not None:
+                # an iterator left with break still holds a cursor and
+                # maybe a transaction, closed while the connection is ours
+                await self._pg_conn._close_iterators()
+        finally:
+            await self._release(exc)
+        return False
+
+    async def _release(self, exc: Optional[BaseException]) -> None:
         if self._pg_conn is not None:
-            self._db._connections.remove(self._pg_conn)
-        await self._db._pool.release(self._conn)
+            self._db._connections.discard(self._pg_conn)
+            if (self._db._drained is not None and
+                    not self._db._connections):
+                self._db._drained.set()
+        try:
+            await self._pool.release(self._conn)
+        finally:
+            if self._limiter is not None:
+                self._limiter.release()
+            if self._bulkhead is not None:
+                self._bulkhead.release()
+            self._db._stats.in_use -= 1
+            if self._endpoint is not None:
+                self._endpoint.inflight -= 1
+                if isinstance(exc, _CONNECTION_ERRORS):
+                    self._db._replica_failed(self._endpoint)
+
+
+class ConnectionXactContextManager:
+    def __init__(self, db: Postgres, ctx: Span,
+                 isolation_level: str = None,
+                 readonly: bool = False, deferrable: bool = False,
+                 acquire_timeout: float = None,
+                 tracer_config: Optional[PostgresTracerConfig] = None,
+                 id: Optional[str] = None,
+                 priority: int = PRIORITY_NORMAL) -> None:
+        self._conn_cm = ConnectionContextManager(
+            db, ctx, acquire_timeout=acquire_timeout,
+            tracer_config=tracer_config, readonly=readonly, id=id,
+            priority=priority)
+        self._ctx = ctx
+        self._isolation_level = isolation_level
+        self._readonly = readonly
+        self._deferrable = deferrable
+        self._tracer_config = tracer_config
+        self._xact_cm: Optional['TransactionContextManager'] = None
+
+    async def __aenter__(self) -> 'Connection':
+        conn = await self._conn_cm.__aenter__()
+        try:
+            self._xact_cm = conn.xact(self._ctx, self._isolation_level,
+                                      self._readonly, self._deferrable,
+                                      self._tracer_config)
+            await self._xact_cm.__aenter__()
+        except BaseException as err:
+            await self._conn_cm.__aexit__(type(err), err,
+                                          err.__traceback__)  # type: ignore
+            raise
+        return conn
+
+    async def __aexit__(self, exc_type: type, exc: BaseException,
+                        tb: type) -> bool:
+        try:
+            if self._xact_cm is not None:
+                await self._xact_cm.__aexit__(exc_type, exc, tb)
+        finally:
+            await self._conn_cm.__aexit__(exc_type, exc, tb)
         return False
 
 
@@ -304,17 +1489,10 @@ class TransactionContextManager:
         self._conn._in_transaction = True
 
         with await self._conn._lock:
-            span = None
-            if self._ctx:
-                span = self._ctx.new_child()
+            span = self._conn._new_span(self._ctx, "db:BeginTransaction",
+                                        'BeginTransaction')
             try:
                 if span:
-                    span.kind(CLIENT)
-                    span.name("db:BeginTransaction")
-                    span.metrics_tag(SPAN_TYPE, SPAN_TYPE_POSTGRES)
-                    span.metrics_tag(SPAN_KIND, SPAN_KIND_POSTRGES_QUERY)
-                    span.metrics_tag('query_id', 'BeginTransaction')
-                    span.remote_endpoint("postgres")
                     span.annotate(
                         'Isolation Level: %r\n'
                         'Readonly: %r\n'
@@ -348,20 +1526,12 @@ class TransactionContextManager:
     async def __aexit__(self, exc_type: type, exc: BaseException,
                         tb: type) -> bool:
         with await self._conn._lock:
-            span = None
-            if self._ctx:
-                span = self._ctx.new_child()
+            span = self._conn._new_span(
+                self._ctx,
+                "db:Rollback" if exc_type is not None else "db:Commit",
+                'Commit')
             try:
                 if span:
-                    span.kind(CLIENT)
-                    if exc_type is not None:
-                        span.name("db:Rollback")
-                    else:
-                        span.name("db:Commit")
-                    span.metrics_tag(SPAN_TYPE, SPAN_TYPE_POSTGRES)
-                    span.metrics_tag(SPAN_KIND, SPAN_KIND_POSTRGES_QUERY)
-                    span.metrics_tag('query_id', 'Commit')
-                    span.remote_endpoint("postgres")
                     span.start()
                     if self._tracer_config:
                         self._tracer_config.on_xact_finish_start(
@@ -390,17 +1560,30 @@ class TransactionContextManager:
 
 class Connection:
     def __init__(self, db: Postgres,
-                 conn: asyncpg.pool.PoolConnectionProxy) -> None:
+                 conn: asyncpg.pool.PoolConnectionProxy,
+                 endpoint: Optional[Endpoint] = None) -> None:
         self._db = db
         self._conn = conn
+        self._endpoint = endpoint
         self._lock = asyncio.Lock(loop=db.loop)
         self._xact_lock = asyncio.Lock(loop=db.loop)
         self._in_transaction = False
+        # acquire wait to tag on the first span when acquire spans are
+        # folded into query spans
+        self._acquire_time: Optional[float] = None
+        # iterators the caller may abandon, closed before the release
+        self._iterators: 'weakref.WeakSet[Any]' = weakref.WeakSet()
 
     @property
     def in_transaction(self) -> bool:
         return self._in_transaction
 
+    @property
+    def endpoint_name(self) -> str:
+        if self._endpoint is None:
+            return 'primary'
+        return self._endpoint.name
+
     def xact(self, ctx: Span,
              isolation_level: str = None,
              readonly: bool = False, deferrable: bool = False,
@@ -411,143 +1594,632 @@ class Connection:
                                          self._xact_lock,
                                          tracer_config)
 
+    def _new_span(self, ctx: Span, name: str,
+                  query_id: str) -> Optional[Span]:
+        span = self._db.instrumentation.new_span(
+            ctx, name, query_id, SPAN_KIND_POSTRGES_QUERY,
+            self.endpoint_name)
+        if span is not None and self._acquire_time is not None:
+            span.tag('acquire_time', '%.6f' % self._acquire_time)
+            self._acquire_time = None
+        return span
+
+    def _trace_start(self, ctx: Span, id: str, query: str, args: tuple,
+                     timeout: Optional[float],
+                     tracer_config: Optional[PostgresTracerConfig],
+                     name: str = None, query_id: str = None,
+                     annotation: Union[str, Sequence[str], None] = None
+                     ) -> Optional[Span]:
+        """
+        Starts the span of a database call. Arguments are annotated
+        according to the instrumentation policy unless an annotation (or
+        a list of them) is given
+        """
+        span = self._new_span(ctx, name or "db:%s" % id, query_id or id)
+        if span is not None:
+            if isinstance(annotation, str):
+                span.annotate(annotation)
+            elif annotation is not None:
+                for text in annotation:
+                    span.annotate(text)
+            elif args:
+                self._db.instrumentation.annotate_args(span, args)
+            span.start()
+            if tracer_config:
+                tracer_config.on_query_start(span, id, query, args, timeout)
+        return span
+
+    def _trace_finish(self, span: Optional[Span], query_id: str,
+                      elapsed: float,
+                      tracer_config: Optional[PostgresTracerConfig],
+                      err: Optional[Exception], res: Any = None,
+                      on_success: Callable[[Span, Any], None] = None,
+                      result_size: Optional[Tuple[Optional[int],
+                                                  Optional[int]]] = None
+                      ) -> None:
+        """
+        Counts the call in the query stats and finishes its span, rows
+        and size are taken from the result unless `result_size` is given
+        """
+        stats = self._db._query_stats
+        if err is not None:
+            stats.observe(query_id, elapsed, True, None, None)
+            if span is not None:
+                if tracer_config:
+                    tracer_config.on_query_end(span, err, None)
+                span.finish(exception=err)
+            return
+        rows, size = result_size or _result_size(res)
+        stats.observe(query_id, elapsed, False, rows, size)
+        if span is not None:
+            if on_success is not None:
+                on_success(span, res)
+            if tracer_config:
+                tracer_config.on_query_end(span, None, res)
+            span.finish()
+
+    async def _traced(self, ctx: Span, id: str, query: str, args: tuple,
+                      timeout: Optional[float],
+                      tracer_config: Optional[PostgresTracerConfig],
+                      call: Callable[[], Awaitable[Any]],
+                      name: str = None, query_id: str = None,
+                      annotation: Union[str, Sequence[str], None] = None,
+                      on_success: Callable[[Span, Any], None] = None,
+                      explain: bool = False,
+                      result_size: Optional[Tuple[Optional[int],
+                                                  Optional[int]]] = None
+                      ) -> Any:
+        """
+        Runs one database call inside its span with the tracer hooks, the
+        caller holds the connection lock. Every call is counted in the
+        query stats, with `explain` its duration also goes to the
+        ExplainSampler of the component. `result_size` is passed to
+        _trace_finish
+        """
+        loop = self._db.loop
+        start = loop.time()
+        span = self._trace_start(ctx, id, query, args, timeout,
+                                 tracer_config, name=name,
+                                 query_id=query_id, annotation=annotation)
+        try:
+            res = await call()
+        except Exception as err:
+            self._trace_finish(span, query_id or id, loop.time() - start,
+                               tracer_config, err)
+            raise
+        elapsed = loop.time() - start
+        self._trace_finish(span, query_id or id, elapsed, tracer_config,
+                           None, res, on_success, result_size=result_size)
+        if explain and self._db.explain is not None:
+            self._db.explain.observe(ctx, id, query, args, elapsed)
+        return res
+
     async def execute(self, ctx: Span, id: str,
                       query: str, *args: Any, timeout: float = None,
                       tracer_config: Optional[
                           PostgresTracerConfig] = None) -> str:
+        timeout = effective_timeout(timeout)
         with await self._lock:
-            span = None
-            if ctx:
-                span = ctx.new_child()
+            if args:
+                return await self._traced(
+                    ctx, id, query, args, timeout, tracer_config,
+                    lambda: self._run(
+                        id, query, timeout,
+                        lambda: self._conn.execute(query, *args,
+                                                   timeout=timeout),
+                        lambda stmt: self._stmt_execute(stmt, args,
+                                                        timeout)),
+                    explain=True)
+            # simple query protocol allows several statements and can't
+            # be prepared
+            return await self._traced(
+                ctx, id, query, args, timeout, tracer_config,
+                lambda: self._conn.execute(query, timeout=timeout),
+                explain=True)
 
+    async def _cached_statement(self, cache: StatementCache, id: str,
+                                query: str, timeout: Optional[float]
+                                ) -> asyncpg.prepared_stmt.PreparedStatement:
+        stats = self._db._stmt_cache_stats
+        raw = _raw_connection(self._conn)
+        stmt = cache.get(raw, id, query)
+        if stmt is not None:
+            stats['hits'] += 1
+            return stmt
+        stats['misses'] += 1
+        stmt = await self._conn.prepare(query, timeout=timeout)
+        stats['evictions'] += cache.put(raw, id, query, stmt)
+        return stmt
+
+    async def _run(self, id: str, query: str, timeout: Optional[float],
+                   direct: Callable[[], Awaitable[Any]],
+                   prepared: Callable[[Any], Awaitable[Any]]) -> Any:
+        endpoint = self._endpoint
+        if endpoint is None:
+            return await self._run_query(id, query, timeout, direct,
+                                         prepared)
+        # replica latency feeds the balancer
+        start = self._db.loop.time()
+        res = await self._run_query(id, query, timeout, direct, prepared)
+        endpoint.observe(self._db.loop.time() - start)
+        return res
+
+    async def _run_query(self, id: str, query: str,
+                         timeout: Optional[float],
+                         direct: Callable[[], Awaitable[Any]],
+                         prepared: Callable[[Any], Awaitable[Any]]) -> Any:
+        cache = self._db._statement_cache(self._conn)
+        if cache is None:
+            return await direct()
+        for attempt in range(2):
+            stmt = await self._cached_statement(cache, id, query, timeout)
             try:
-                if span:
-                    span.kind(CLIENT)
-                    span.name("db:%s" % id)
-                    span.metrics_tag(SPAN_TYPE, SPAN_TYPE_POSTGRES)
-                    span.metrics_tag(SPAN_KIND, SPAN_KIND_POSTRGES_QUERY)
-                    span.metrics_tag('query_id', id)
-                    span.remote_endpoint("postgres")
-                    span.annotate(repr(args))
-                    span.start()
-                    if tracer_config:
-                        tracer_config.on_query_start(span, id, query, args,
-                                                     timeout)
-                res = await                self._conn.execute(query, *args,
-                                                              timeout=timeout)
-                if span:
-                    if tracer_config:
-                        tracer_config.on_query_end(span, None, res)
-                    span.finish()
-            except Exception as err:
-                if span:
-                    if tracer_config:
-                        tracer_config.on_query_end(span, err, None)
-                    span.finish(exception=err)
-                raise
+                return await prepared(stmt)
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                # the schema changed under the cached statement, the
+                # statement can be re-prepared unless we are inside a
+                # transaction which is already aborted by the error
+                cache.discard(_raw_connection(self._conn), id)
+                self._db._stmt_cache_stats['invalidations'] += 1
+                if attempt or self._in_transaction:
+                    raise
 
-            return res
+    async def execute_many(self, ctx: Span, id: str, query: str,
+                           args_iter: Iterable[Sequence[Any]],
+                           batch_size: int = EXECUTE_MANY_BATCH_SIZE,
+                           timeout: float = None,
+                           tracer_config: Optional[
+                               PostgresTracerConfig] = None
+                           ) -> int:
+        """
+        Executes the query for every argument tuple of `args_iter`. The
+        tuples are sent in pipelined batches of at most `batch_size`, one
+        span per batch; `timeout` applies to each batch. Returns the number
+        of argument tuples executed.
+
+        Batches are not atomic, run inside `xact` for all-or-nothing.
+        """
+        if batch_size < 1:
+            raise UserWarning('batch_size must be positive')
+        it = iter(args_iter)
+        total = 0
+        with await self._lock:
+            while True:
+                batch = list(itertools.islice(it, batch_size))
+                if not batch:
+                    break
+                batch_timeout = effective_timeout(timeout)
+                await self._traced(
+                    ctx, id, query, tuple(batch), batch_timeout,
+                    tracer_config,
+                    lambda: self._conn.executemany(query, batch,
+                                                   timeout=batch_timeout),
+                    on_success=lambda span, res: span.tag(
+                        'rows', str(len(batch))),
+                    result_size=(len(batch), None))
+                total += len(batch)
+        return total
+
+    async def xact_batch(self, ctx: Span, id: str,
+                         statements: Sequence[Tuple[str, Sequence[Any]]],
+                         isolation_level: str = None,
+                         readonly: bool = False, deferrable: bool = False,
+                         timeout: float = None,
+                         tracer_config: Optional[
+                             PostgresTracerConfig] = None) -> List[str]:
+        """
+        Runs the (query, args) statements in one transaction, rolled back
+        on the first error, under a single span annotated with every
+        statement, and returns the command status of every statement.
+        `timeout` applies to the whole batch.
+
+        The statements run one after the other between BEGIN and COMMIT,
+        N + 2 round-trips like xact(), but the connection lock is taken
+        once and the batch is traced as one call.
+        """
+        if not statements:
+            return []
+        if self._in_transaction:
+            raise UserWarning('Transaction already started')
+        isolation = _isolation_level(isolation_level)
+        begin = _begin_statement(isolation, readonly, deferrable)
+        batch = [(query, tuple(args)) for query, args in statements]
+        timeout = effective_timeout(timeout)
+        policy = self._db.instrumentation
+        annotations = [begin]
+        for i, (query, args) in enumerate(batch, 1):
+            text = 'Statement %d: %s' % (i, query)
+            formatted = policy.format_args(args) if args else None
+            if formatted is not None:
+                text += '\nArgs: %s' % formatted
+            annotations.append(text)
+
+        def _on_success(span: Span, res: List[str]) -> None:
+            span.tag('statements', str(len(batch)))
+
+        async def _run_batch() -> List[str]:
+            return await self._xact_batch_run(
+                batch, isolation, readonly, deferrable, timeout)
+
+        with await self._xact_lock:
+            with await self._lock:
+                self._in_transaction = True
+                try:
+                    return await self._traced(
+                        ctx, id, begin, (), timeout, tracer_config,
+                        _run_batch,
+                        name="db:xact_batch:%s" % id,
+                        annotation=annotations, on_success=_on_success)
+                finally:
+                    self._in_transaction = False
+
+    async def _xact_batch_run(self, batch: List[Tuple[str, tuple]],
+                              isolation: str,
+                              readonly: bool, deferrable: bool,
+                              timeout: Optional[float]) -> List[str]:
+        loop = self._db.loop
+        end = None if timeout is None else loop.time() + timeout
+        tr = self._conn.transaction(isolation=isolation, readonly=readonly,
+                                    deferrable=deferrable)
+        await tr.start()
+        statuses = []
+        try:
+            for query, args in batch:
+                left = None
+                if end is not None:
+                    left = end - loop.time()
+                    if left <= 0:
+                        raise asyncio.TimeoutError()
+                statuses.append(
+                    await self._conn.execute(query, *args, timeout=left))
+        except Exception:
+            await tr.rollback()
+            raise
+        await tr.commit()
+        return statuses
+
+    @staticmethod
+    async def _stmt_execute(stmt: asyncpg.prepared_stmt.PreparedStatement,
+                            args: tuple, timeout: Optional[float]) -> str:
+        await stmt.fetch(*args, timeout=timeout)
+        return stmt.get_statusmsg()
 
     async def query_one(self, ctx: Span, id: str,
                         query: str, *args: Any,
                         timeout: float = None,
                         tracer_config: Optional[PostgresTracerConfig] = None
                         ) -> asyncpg.protocol.Record:
+        timeout = effective_timeout(timeout)
         with await self._lock:
-            span = None
-            if ctx:
-                span = ctx.new_child()
-            try:
-                if span:
-                    span.kind(CLIENT)
-                    span.name("db:%s" % id)
-                    span.metrics_tag(SPAN_TYPE, SPAN_TYPE_POSTGRES)
-                    span.metrics_tag(SPAN_KIND, SPAN_KIND_POSTRGES_QUERY)
-                    span.metrics_tag('query_id', id)
-                    span.remote_endpoint("postgres")
-                    span.annotate(repr(args))
-                    span.start()
-                    if tracer_config:
-                        tracer_config.on_query_start(span, id, query, args,
-                                                     timeout)
-                res = await                self._conn.fetchrow(query, *args,
-                                                               timeout=timeout)
-                if span:
-                    if tracer_config:
-                        tracer_config.on_query_end(span, None, res)
-                    span.finish()
-            except Exception as err:
-                if span:
-                    if tracer_config:
-                        tracer_config.on_query_end(span, err, None)
-                    span.finish(exception=err)
-                raise
-            return res
+            return await self._traced(
+                ctx, id, query, args, timeout, tracer_config,
+                lambda: self._run(
+                    id, query, timeout,
+                    lambda: self._conn.fetchrow(query, *args,
+                                                timeout=timeout),
+                    lambda stmt: stmt.fetchrow(*args, timeout=timeout)),
+                explain=True)
 
     async def query_all(self, ctx: Span, id: str,
                         query: str, *args: Any, timeout: float = None,
                         tracer_config: Optional[PostgresTracerConfig] = None
                         ) -> List[asyncpg.protocol.Record]:
+        timeout = effective_timeout(timeout)
         with await self._lock:
-            span = None
-            if ctx:
-                span = ctx.new_child()
-            try:
-                if span:
-                    span.kind(CLIENT)
-                    span.name("db:%s" % id)
-                    span.metrics_tag(SPAN_TYPE, SPAN_TYPE_POSTGRES)
-                    span.metrics_tag(SPAN_KIND, SPAN_KIND_POSTRGES_QUERY)
-                    span.metrics_tag('query_id', id)
-                    span.remote_endpoint("postgres")
-                    span.annotate(repr(args))
-                    span.start()
-                    if tracer_config:
-                        tracer_config.on_query_start(span, id, query, args,
-                                                     timeout)
-                res = await                self._conn.fetch(query, *args,
-                                                            timeout=timeout)
-                if span:
-                    if tracer_config:
-                        tracer_config.on_query_end(span, None, res)
-                    span.finish()
-            except Exception as err:
-                if span:
-                    if tracer_config:
-                        tracer_config.on_query_end(span, err, None)
-                    span.finish(exception=err)
-                raise
-            return res
+            return await self._traced(
+                ctx, id, query, args, timeout, tracer_config,
+                lambda: self._run(
+                    id, query, timeout,
+                    lambda: self._conn.fetch(query, *args, timeout=timeout),
+                    lambda stmt: stmt.fetch(*args, timeout=timeout)),
+                explain=True)
 
     async def prepare(self, ctx: Span, id: str,
                       query: str, timeout: float = None,
                       tracer_config: Optional[PostgresTracerConfig] = None
                       ) -> List[asyncpg.prepared_stmt.PreparedStatement]:
+        timeout = effective_timeout(timeout)
+        cache = self._db._statement_cache(self._conn)
         with await self._lock:
-            span = None
-            if ctx:
-                span = ctx.new_child()
+            if cache is not None:
+                return await self._traced(
+                    ctx, id, query, (), timeout, tracer_config,
+                    lambda: self._cached_statement(cache, id, query,
+                                                   timeout),
+                    name="db:prepare:%s" % id, query_id='prepare:%s' % id,
+                    annotation=query)
+            return await self._traced(
+                ctx, id, query, (), timeout, tracer_config,
+                lambda: self._conn.prepare(query, timeout=timeout),
+                name="db:prepare:%s" % id, query_id='prepare:%s' % id,
+                annotation=query)
+
+    async def _warm_statement(self, id: str, query: str) -> None:
+        """
+        Prepares the statement where the query helpers look for it:
+        Connection.prepare bypasses asyncpg's statement cache, so without
+        a cache of our own the statement goes to asyncpg's through the
+        lookup fetch and execute use
+        """
+        if self._db._statement_cache(self._conn) is not None:
+            await self.prepare(None, id, query)
+            return
+        with await self._lock:
+            await _raw_connection(self._conn)._get_statement(query, None)
+
+    def _track(self, it: AsyncGenerator[Any, None]
+               ) -> AsyncGenerator[Any, None]:
+        self._iterators.add(it)
+        return it
+
+    async def _close_iterators(self) -> None:
+        for it in list(self._iterators):
             try:
-                if span:
-                    span.kind(CLIENT)
-                    span.name("db:prepare:%s" % id)
-                    span.metrics_tag(SPAN_TYPE, SPAN_TYPE_POSTGRES)
-                    span.metrics_tag(SPAN_KIND, SPAN_KIND_POSTRGES_QUERY)
-                    span.metrics_tag('query_id', 'prepare:%s' % id)
-                    span.remote_endpoint("postgres")
-                    span.start()
-                    if tracer_config:
-                        tracer_config.on_query_start(span, id, query, (),
-                                                     timeout)
-                res = await self._conn.prepare(query, timeout=timeout)
-                if span:
-                    if tracer_config:
-                        tracer_config.on_query_end(span, None, res)
-                    span.finish()
+                await it.aclose()
             except Exception as err:
-                if span:
-                    if tracer_config:
-                        tracer_config.on_query_end(span, err, None)
-                    span.finish(exception=err)
+                self._db.app.log_err('Could not close the iterator: %r'
+                                     '' % err)
+        self._iterators.clear()
+
+    def query_iter(self, ctx: Span, id: str,
+                   query: str, *args: Any,
+                   prefetch: int = QUERY_ITER_PREFETCH,
+                   batches: bool = False, timeout: float = None,
+                   tracer_config: Optional[PostgresTracerConfig] = None
+                   ) -> AsyncGenerator[Any, None]:
+        """
+        Iterates over the result of the query using a server-side cursor,
+        fetching `prefetch` rows per round-trip. Yields records or, when
+        `batches` is true, lists of up to `prefetch` records.
+
+        Cursors only live inside a transaction, so if the connection is not
+        in one already an implicit transaction is opened for the lifetime
+        of the iterator.
+
+        Until it is exhausted or closed the iterator holds the connection,
+        other calls on it wait. Stop early with `aclose()` to use the
+        connection again; an iterator left with `break` is closed, its
+        transaction rolled back, when the connection is released.
+
+        The span and the query stats cover the whole iteration, the
+        consumer's time included, with the rows fetched.
+        """
+        return self._track(self._query_iter(
+            ctx, id, query, *args, prefetch=prefetch, batches=batches,
+            timeout=timeout, tracer_config=tracer_config))
+
+    async def _query_iter(self, ctx: Span, id: str,
+                          query: str, *args: Any,
+                          prefetch: int, batches: bool,
+                          timeout: Optional[float],
+                          tracer_config: Optional[PostgresTracerConfig]
+                          ) -> AsyncGenerator[Any, None]:
+        if prefetch < 1:
+            raise UserWarning('prefetch must be positive')
+        timeout = effective_timeout(timeout)
+        loop = self._db.loop
+
+        def _on_success(span: Span, total: int) -> None:
+            span.tag('rows', str(total))
+
+        with await self._lock:
+            start = loop.time()
+            span = self._trace_start(ctx, id, query, args, timeout,
+                                     tracer_config)
+            tr = None
+            finished = False
+            total = 0
+            size = 0
+            try:
+                if not self._in_transaction:
+                    tr = self._conn.transaction()
+                    await tr.start()
+                cur = await self._conn.cursor(query, *args, timeout=timeout)
+                batch_no = 0
+                while True:
+                    rows = await cur.fetch(
+                        prefetch, timeout=effective_timeout(timeout))
+                    if not rows:
+                        break
+                    batch_no += 1
+                    total += len(rows)
+                    size += _result_size(rows)[1] or 0
+                    if span and tracer_config:
+                        tracer_config.on_query_batch(span, batch_no, rows)
+                    if batches:
+                        yield rows
+                    else:
+                        for row in rows:
+                            yield row
+                    if len(rows) < prefetch:
+                        break
+                if tr is not None:
+                    await tr.commit()
+                    tr = None
+                finished = True
+                self._trace_finish(span, id, loop.time() - start,
+                                   tracer_config, None, total, _on_success,
+                                   result_size=(total, size))
+            except Exception as err:
+                finished = True
+                if tr is not None:
+                    await tr.rollback()
+                    tr = None
+                self._trace_finish(span, id, loop.time() - start,
+                                   tracer_config, err)
                 raise
-            return res
+            finally:
+                # the consumer stopped iterating early (aclose/cancel)
+                if not finished:
+                    if tr is not None:
+                        await tr.rollback()
+                    self._trace_finish(span, id, loop.time() - start,
+                                       tracer_config, None, total,
+                                       _on_success,
+                                       result_size=(total, size))
+
+    async def _copy(self, ctx: Span, id: str, query: str,
+                    call: Callable[[], Awaitable[str]],
+                    timeout: Optional[float],
+                    tracer_config: Optional[PostgresTracerConfig],
+                    counter: Any = None) -> str:
+        def _on_success(span: Span, res: str) -> None:
+            rows = _status_rows(res)
+            if rows is not None:
+                span.tag('rows', str(rows))
+            if counter is not None:
+                span.tag('bytes', str(counter.bytes))
+
+        with await self._lock:
+            return await self._traced(ctx, id, query, (), timeout,
+                                      tracer_config, call,
+                                      annotation=query,
+                                      on_success=_on_success)
+
+    async def copy_records_to_table(self, ctx: Span, id: str,
+                                    table_name: str, *,
+                                    records: Iterable[Any],
+                                    columns: Optional[List[str]] = None,
+                                    schema_name: Optional[str] = None,
+                                    timeout: float = None,
+                                    tracer_config: Optional[
+                                        PostgresTracerConfig] = None
+                                    ) -> str:
+        """
+        Bulk loads `records` (an iterable of tuples) into the table using
+        binary COPY
+        """
+        timeout = effective_timeout(timeout)
+        return await self._copy(
+            ctx, id, 'COPY %s FROM STDIN' % table_name,
+            lambda: self._conn.copy_records_to_table(
+                table_name, records=records, columns=columns,
+                schema_name=schema_name, timeout=timeout),
+            timeout, tracer_config)
+
+    async def copy_to_table(self, ctx: Span, id: str, table_name: str, *,
+                            source: CopySource,
+                            columns: Optional[List[str]] = None,
+                            schema_name: Optional[str] = None,
+                            timeout: float = None,
+                            tracer_config: Optional[
+                                PostgresTracerConfig] = None,
+                            **options: Any) -> str:
+        """
+        Bulk loads data into the table from a file path, a file-like object
+        or an async iterable of bytes. Extra keyword arguments (format,
+        delimiter, header, ...) are passed to asyncpg as COPY options
+        """
+        timeout = effective_timeout(timeout)
+        f = None
+        counter: Any
+        if isinstance(source, (str, bytes, os.PathLike)):
+            f = await self._db.loop.run_in_executor(None, open, source, 'rb')
+            counter = _CountingReader(f)
+        elif hasattr(source, 'read'):
+            counter = _CountingReader(source)  # type: ignore
+        else:
+            counter = _CountingIterable(source)  # type: ignore
+        try:
+            return await self._copy(
+                ctx, id, 'COPY %s FROM STDIN' % table_name,
+                lambda: self._conn.copy_to_table(
+                    table_name, source=counter, columns=columns,
+                    schema_name=schema_name, timeout=timeout, **options),
+                timeout, tracer_config, counter)
+        finally:
+            if f is not None:
+                f.close()
+
+    async def copy_from_query(self, ctx: Span, id: str, query: str,
+                              *args: Any, output: CopyOutput,
+                              timeout: float = None,
+                              tracer_config: Optional[
+                                  PostgresTracerConfig] = None,
+                              **options: Any) -> str:
+        """
+        Exports the result of the query with COPY TO STDOUT into a file
+        path, a file-like object or a coroutine function called with each
+        chunk of data
+        """
+        timeout = effective_timeout(timeout)
+        f = None
+        counter: Any
+        if isinstance(output, (str, bytes, os.PathLike)):
+            f = await self._db.loop.run_in_executor(None, open, output, 'wb')
+            counter = _CountingWriter(f)
+        elif hasattr(output, 'write'):
+            counter = _CountingWriter(output)  # type: ignore
+        else:
+            counter = _CountingCallback(output)  # type: ignore
+        try:
+            return await self._copy(
+                ctx, id, query,
+                lambda: self._conn.copy_from_query(
+                    query, *args, output=counter, timeout=timeout,
+                    **options),
+                timeout, tracer_config, counter)
+        finally:
+            if f is not None:
+                f.close()
+
+    def copy_from_query_iter(self, ctx: Span, id: str, query: str,
+                             *args: Any,
+                             queue_size: int = COPY_ITER_QUEUE_SIZE,
+                             timeout: float = None,
+                             tracer_config: Optional[
+                                 PostgresTracerConfig] = None,
+                             **options: Any) -> AsyncGenerator[bytes, None]:
+        """
+        Exports the result of the query with COPY TO STDOUT and yields the
+        data chunks. At most `queue_size` chunks are buffered, the COPY
+        stream is paused while the consumer is behind. Like query_iter,
+        it holds the connection until it is exhausted or closed.
+        """
+        return self._track(self._copy_from_query_iter(
+            ctx, id, query, *args, queue_size=queue_size, timeout=timeout,
+            tracer_config=tracer_config, **options))
+
+    async def _copy_from_query_iter(self, ctx: Span, id: str, query: str,
+                                    *args: Any, queue_size: int,
+                                    timeout: Optional[float],
+                                    tracer_config: Optional[
+                                        PostgresTracerConfig],
+                                    **options: Any
+                                    ) -> AsyncGenerator[bytes, None]:
+        loop = self._db.loop
+        # resolved here as the deadline of a task-local context is not
+        # seen by the copy task
+        timeout = effective_timeout(timeout)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size, loop=loop)
+        task = asyncio.ensure_future(
+            self.copy_from_query(ctx, id, query, *args, output=queue.put,
+                                 timeout=timeout,
+                                 tracer_config=tracer_config, **options),
+            loop=loop)
+        try:
+            while True:
+                getter = asyncio.ensure_future(queue.get(), loop=loop)
+                await asyncio.wait([getter, task], loop=loop,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                    continue
+                getter.cancel()
+                while not queue.empty():
+                    yield queue.get_nowait()
+                task.result()
+                return
+        finally:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+
+# needs Postgres, so it is imported last
+from .sharded import (ShardedPostgres, ShardedResult,  # noqa
+                      ShardedPostgresError, ShardResult, ShardingStrategy,
+                      HashStrategy, RangeStrategy, LookupStrategy)
@@ -0,0 +1,126 @@
+import asyncio
+from typing import Dict, Any, Optional
+from .limiter import Limiter, PRIORITY_NORMAL, PRIORITY_AGING
+from .metrics import Histogram, MetricsSink, ACQUIRE_WAIT_BUCKETS
+
+
+class BulkheadTimeoutError(asyncio.TimeoutError):
+    """
+    Raised when a call waited for its bulkhead longer than the acquire
+    timeout
+    """
+
+
+class Bulkhead:
+    """
+    Limits how many connections the query ids of one class may hold at
+    once, calls over the limit queue by priority before pool.acquire,
+    with the same aging as the waiters for a pool connection
+    """
+
+    def __init__(self, name: str, limit: int,
+                 loop: asyncio.AbstractEventLoop,
+                 aging: float = PRIORITY_AGING) -> None:
+        self.name = name
+        self.limiter = Limiter(limit, loop, aging=aging)
+        self.wait = Histogram(ACQUIRE_WAIT_BUCKETS)
+        self.acquires = 0
+        self.timeouts = 0
+        self._loop = loop
+
+    async def acquire(self, timeout: Optional[float],
+                      priority: int = PRIORITY_NORMAL) -> float:
+        """
+        Takes a slot, returns the time waited for it
+        """
+        start = self._loop.time()
+        try:
+            await self.limiter.acquire(timeout, priority)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise BulkheadTimeoutError(
+                'Bulkhead %r is full (%d in use)'
+                '' % (self.name, self.limiter.in_use))
+        waited = self._loop.time() - start
+        self.wait.observe(waited)
+        self.acquires += 1
+        return waited
+
+    def release(self) -> None:
+        self.limiter.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'limit': self.limiter.limit,
+            'in_use': self.limiter.in_use,
+            'waiting': self.limiter.waiting,
+            'acquires': self.acquires,
+            'timeouts': self.timeouts,
+            'wait': self.wait.snapshot(),
+        }
+
+    def export(self, sink: MetricsSink, prefix: str,
+               labels: Dict[str, str]) -> None:
+        labels = dict(labels, bulkhead=self.name)
+        sink(prefix + '_bulkhead_acquires_total', self.acquires, labels)
+        sink(prefix + '_bulkhead_timeouts_total', self.timeouts, labels)
+        sink(prefix + '_bulkhead_in_use', self.limiter.in_use, labels)
+        sink(prefix + '_bulkhead_waiting', self.limiter.waiting, labels)
+        self.wait.export(sink, prefix + '_bulkhead_wait_seconds', labels)
+
+
+class Bulkheads:
+    """
+    Concurrency limits by query id: {'report:*': 3, 'export_all': 1}.
+    A key ending with '*' covers every id starting with the rest of it,
+    an exact id wins over prefixes and a longer prefix over a shorter
+    one. All ids matching one key share its limit, ids matching no key
+    are not limited.
+    """
+
+    def __init__(self, limits: Dict[str, int]) -> None:
+        for pattern, limit in limits.items():
+            if limit < 1:
+                raise UserWarning('Limit of bulkhead %r must be positive'
+                                  '' % pattern)
+        self.limits = dict(limits)
+        self._prefixes = sorted(
+            ((pattern[:-1], pattern) for pattern in limits
+             if pattern.endswith('*')),
+            key=lambda item: len(item[0]), reverse=True)
+        self._bulkheads: Dict[str, Bulkhead] = {}
+        # query id -> bulkhead or None, ids are a finite set of constants
+        self._resolved: Dict[str, Optional[Bulkhead]] = {}
+
+    def attach(self, loop: asyncio.AbstractEventLoop,
+               aging: float = PRIORITY_AGING) -> None:
+        self._bulkheads = {pattern: Bulkhead(pattern, limit, loop, aging)
+                           for pattern, limit in self.limits.items()}
+        self._resolved.clear()
+
+    def get(self, id: Optional[str]) -> Optional[Bulkhead]:
+        if id is None or not self._bulkheads:
+            return None
+        try:
+            return self._resolved[id]
+        except KeyError:
+            pass
+        bulkhead: Optional[Bulkhead] = None
+        if id in self.limits and not id.endswith('*'):
+            bulkhead = self._bulkheads[id]
+        else:
+            for prefix, pattern in self._prefixes:
+                if id.startswith(prefix):
+                    bulkhead = self._bulkheads[pattern]
+                    break
+        self._resolved[id] = bulkhead
+        return bulkhead
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {pattern: bulkhead.snapshot()
+                for pattern, bulkhead in self._bulkheads.items()}
+
+    def export(self, sink: MetricsSink, prefix: str = 'postgres',
+               labels: Dict[str, str] = None) -> None:
+        for bulkhead in self._bulkheads.values():
+            bulkhead.export(sink, prefix, labels or {})
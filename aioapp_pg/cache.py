@@ -0,0 +1,131 @@
+import sys
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Hashable, Tuple, Set
+
+RESULT_CACHE_MAX_ENTRIES = 10000
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# bookkeeping overhead of one cached entry, bytes
+_ENTRY_OVERHEAD = 200
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Approximate memory footprint of a query result: a record, a list of
+    records or None
+    """
+    if value is None:
+        return 0
+    if isinstance(value, list):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    try:
+        fields = value.values()
+    except AttributeError:
+        return sys.getsizeof(value)
+    return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in fields)
+
+
+class ResultCache:
+    """
+    In-process LRU cache of query results with per-query-id TTL, bounded
+    by number of entries and approximate size in bytes.
+
+    Only the query ids with a TTL (in `ttls` or `default_ttl`) are cached.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+                 max_bytes: int = RESULT_CACHE_MAX_BYTES,
+                 default_ttl: Optional[float] = None,
+                 ttls: Optional[Dict[str, float]] = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttls = dict(ttls or {})
+        # key -> (expires_at, size, id, value)
+        self._items: 'OrderedDict[Hashable, Tuple[float, int, str, Any]]' \
+            = OrderedDict()
+        self._by_id: Dict[str, Set[Hashable]] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def ttl_for(self, id: str) -> Optional[float]:
+        return self.ttls.get(id, self.default_ttl)
+
+    def get(self, key: Hashable, now: float) -> Tuple[bool, Any]:
+        """
+        Returns (True, value) on a hit and (False, None) on a miss. Raises
+        TypeError when the key is not hashable
+        """
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return False, None
+        if item[0] <= now:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return False, None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return True, item[3]
+
+    def put(self, key: Hashable, id: str, value: Any, ttl: float,
+            now: float) -> None:
+        size = estimate_size(value) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        if key in self._items:
+            self._remove(key)
+        self._items[key] = (now + ttl, size, id, value)
+        self._by_id.setdefault(id, set()).add(key)
+        self._bytes += size
+        while (len(self._items) > self.max_entries or
+               self._bytes > self.max_bytes):
+            self._remove(next(iter(self._items)))
+            self.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, id, _ = self._items.pop(key)
+        self._bytes -= size
+        keys = self._by_id[id]
+        keys.discard(key)
+        if not keys:
+            del self._by_id[id]
+
+    def invalidate(self, id: Optional[str] = None,
+                   prefix: Optional[str] = None) -> int:
+        """
+        Drops the entries of the query id, of every query id starting with
+        the prefix or, with no arguments, all entries. Returns the number
+        of dropped entries
+        """
+        if id is None and prefix is None:
+            count = len(self._items)
+            self._items.clear()
+            self._by_id.clear()
+            self._bytes = 0
+            return count
+        ids = []
+        if id is not None and id in self._by_id:
+            ids.append(id)
+        if prefix is not None:
+            ids.extend(i for i in self._by_id
+                       if i.startswith(prefix) and i != id)
+        count = 0
+        for i in ids:
+            for key in list(self._by_id.get(i, ())):
+                self._remove(key)
+                count += 1
+        return count
+
+    def info(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._items),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
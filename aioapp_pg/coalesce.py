@@ -0,0 +1,95 @@
+import asyncio
+import itertools
+from typing import Dict, Any, Optional, Hashable, Iterable, Awaitable
+from .deadline import ensure_future_without_deadline
+
+
+class Flight:
+    """
+    One shared execution of a read, awaited by the caller that started
+    it and by every identical read arriving while it runs
+    """
+
+    def __init__(self, id: int, task: 'asyncio.Future[Any]',
+                 loop: asyncio.AbstractEventLoop) -> None:
+        self.id = id
+        self.task = task
+        self.waiters = 0
+        self._loop = loop
+
+    async def wait(self, timeout: Optional[float]) -> Any:
+        """
+        Waits for the shared result. A waiter giving up (timeout or
+        cancellation) does not affect the others, the execution is
+        cancelled when the last waiter is gone
+        """
+        self.waiters += 1
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(self.task, loop=self._loop), timeout,
+                loop=self._loop)
+        finally:
+            self.waiters -= 1
+            if not self.waiters and not self.task.done():
+                self.task.cancel()
+
+
+class ReadCoalescer:
+    """
+    Single-flight for query_one/query_all: while a read is running, calls
+    with the same query id, query, arguments and routing wait for its
+    result instead of acquiring their own connections. Nothing is kept
+    once the read completes, so results are never stale.
+
+    ids: coalesce only these query ids, all reads when None
+    """
+
+    def __init__(self, ids: Optional[Iterable[str]] = None) -> None:
+        self.ids = set(ids) if ids is not None else None
+        self._flights: Dict[Hashable, Flight] = {}
+        self._flight_ids = itertools.count(1)
+        self.flights = 0
+        self.coalesced = 0
+
+    def enabled(self, id: str) -> bool:
+        return self.ids is None or id in self.ids
+
+    def get(self, key: Hashable) -> Optional[Flight]:
+        """
+        Returns the running flight of the key. Raises TypeError when the
+        key is not hashable
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        return flight
+
+    def start(self, key: Hashable, coro: Awaitable[Any],
+              loop: asyncio.AbstractEventLoop) -> Flight:
+        """
+        Runs the read as a separate task, so the result is delivered to
+        the other waiters even if the caller that started it goes away.
+        The task does not inherit the deadline of that caller, every
+        waiter bounds its own wait with Flight.wait
+        """
+        task = ensure_future_without_deadline(coro, loop)
+        flight = Flight(next(self._flight_ids), task, loop)
+        self._flights[key] = flight
+        self.flights += 1
+
+        def _done(fut: 'asyncio.Future[Any]') -> None:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if not fut.cancelled():
+                # retrieved here in case every waiter has gone
+                fut.exception()
+
+        task.add_done_callback(_done)
+        return flight
+
+    def info(self) -> Dict[str, int]:
+        return {
+            'in_flight': len(self._flights),
+            'flights': self.flights,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,156 @@
+import time
+import asyncio
+import weakref
+from typing import Optional, Any, List, Awaitable
+
+try:
+    import contextvars
+except ImportError:  # python 3.6
+    contextvars = None  # type: ignore
+
+if contextvars is not None:
+    _deadline_var: Any = contextvars.ContextVar('aioapp_pg_deadline',
+                                                default=None)
+else:
+    _deadline_var = None
+    # without contextvars the deadline is local to the task that set it
+    _task_deadlines: 'weakref.WeakKeyDictionary[Any, Optional[float]]' = \
+        weakref.WeakKeyDictionary()
+
+
+class DeadlineExceededError(asyncio.TimeoutError):
+    """
+    Raised when the deadline of the caller has passed before a database
+    call was started or while it was waiting for a connection
+    """
+
+
+def _task() -> Any:
+    current_task = getattr(asyncio, 'current_task', None)
+    if current_task is None:
+        current_task = asyncio.Task.current_task  # type: ignore
+    return current_task()
+
+
+def get_deadline() -> Optional[float]:
+    """
+    Deadline of the current context as a time.monotonic() value, None when
+    there is no deadline
+    """
+    if _deadline_var is not None:
+        return _deadline_var.get()
+    task = _task()
+    if task is None:
+        return None
+    return _task_deadlines.get(task)
+
+
+def _set_deadline(deadline: Optional[float]) -> Any:
+    if _deadline_var is not None:
+        return _deadline_var.set(deadline)
+    task = _task()
+    if task is None:
+        raise RuntimeError('Deadline can only be set inside a task')
+    prev = _task_deadlines.get(task)
+    _task_deadlines[task] = deadline
+    return prev
+
+
+def _reset_deadline(token: Any) -> None:
+    if _deadline_var is not None:
+        _deadline_var.reset(token)
+        return
+    task = _task()
+    if token is None:
+        _task_deadlines.pop(task, None)
+    else:
+        _task_deadlines[task] = token
+
+
+def ensure_future_without_deadline(coro: Awaitable[Any],
+                                   loop: asyncio.AbstractEventLoop
+                                   ) -> 'asyncio.Future[Any]':
+    """
+    Runs the coroutine as a task without the deadline of the current
+    context, for work shared by callers having their own deadlines; each
+    of them has to bound its own wait for the result
+    """
+    if _deadline_var is None:
+        # the deadlines of the tasks are not inherited
+        return asyncio.ensure_future(coro, loop=loop)
+    context = contextvars.copy_context()
+    context.run(_deadline_var.set, None)
+    return context.run(asyncio.ensure_future, coro, loop=loop)
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left until the deadline of the current context, None when
+    there is no deadline
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def effective_timeout(timeout: Optional[float]) -> Optional[float]:
+    """
+    The smaller of the explicit timeout and the time left until the
+    deadline. Raises DeadlineExceededError when the deadline has passed
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceededError('Deadline exceeded')
+    if timeout is None or left < timeout:
+        return left
+    return timeout
+
+
+class Deadline:
+    """
+    Sets the deadline for the database calls made inside the block, e.g.
+    from the budget of the incoming request:
+
+        with Deadline(timeout=request_timeout - elapsed):
+            await db.query_one(ctx, 'get_user', ...)
+
+    Pool acquires and queries get the smaller of their own timeout and
+    the time left. A query running out of time is cancelled on the
+    server. A nested deadline can only shorten the outer one.
+
+    The deadline is a context variable, so tasks started inside the block
+    inherit it. On python 3.6 without contextvars it is local to the
+    current task.
+    """
+
+    def __init__(self, timeout: Optional[float] = None,
+                 deadline: Optional[float] = None) -> None:
+        """
+        timeout: seconds from now
+        deadline: absolute time.monotonic() value
+        """
+        if timeout is not None:
+            at = time.monotonic() + timeout
+            deadline = at if deadline is None else min(deadline, at)
+        if deadline is None:
+            raise UserWarning('timeout or deadline is required')
+        self.deadline = deadline
+        self._tokens: List[Any] = []
+
+    def __enter__(self) -> 'Deadline':
+        outer = get_deadline()
+        deadline = self.deadline
+        if outer is not None and outer < deadline:
+            deadline = outer
+        self._tokens.append(_set_deadline(deadline))
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        _reset_deadline(self._tokens.pop())
+
+    @property
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import deque, namedtuple
+from typing import Dict, List, Any, Optional, Deque, Iterable, Callable
+import asyncpg
+import asyncpg.connection
+from aioapp.misc import mask_url_pwd
+from aioapp.tracer import Span
+from .tracing import SPAN_KIND_POSTRGES_QUERY
+from .metrics import MetricsSink
+
+EXPLAIN_HISTORY = 10
+EXPLAIN_QUEUE_SIZE = 16
+
+# plan node attributes that make its shape, estimates and timings change
+# from run to run and are left out of the fingerprint
+PLAN_SHAPE_KEYS = ('Node Type', 'Parent Relationship', 'Join Type',
+                   'Strategy', 'Relation Name', 'Index Name',
+                   'Scan Direction')
+
+_EXPLAINABLE = ('select', 'with', 'values', 'table', 'insert', 'update',
+                'delete')
+
+# time is the unix time of the capture, elapsed the duration of the
+# execution that triggered it
+CapturedPlan = namedtuple('CapturedPlan', ['time', 'id', 'elapsed',
+                                           'analyze', 'fingerprint',
+                                           'plan'])
+
+
+def plan_fingerprint(plan: Any) -> str:
+    """
+    Digest of the shape of an EXPLAIN (FORMAT JSON) plan: node types, join
+    strategies, relations and indexes, not costs, rows or timings
+    """
+    if isinstance(plan, list):
+        plan = plan[0]
+    parts: List[str] = []
+
+    def _walk(node: Dict[str, Any], depth: int) -> None:
+        parts.append('%d:%s' % (depth, '|'.join(
+            str(node.get(key, '')) for key in PLAN_SHAPE_KEYS)))
+        for child in node.get('Plans', ()):
+            _walk(child, depth + 1)
+
+    _walk(plan['Plan'], 0)
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()[:16]
+
+
+def _explainable(query: str, args: tuple) -> bool:
+    words = query.split(None, 1)
+    if not words or words[0].lower() not in _EXPLAINABLE:
+        return False
+    # without arguments execute() may send several statements
+    return bool(args) or ';' not in query.rstrip().rstrip(';')
+
+
+class PlanStore:
+    """
+    Last `size` captured plans of every query id. A plan whose fingerprint
+    differs from the previous one of its id counts as a plan change
+    """
+
+    def __init__(self, size: int = EXPLAIN_HISTORY) -> None:
+        if size < 1:
+            raise UserWarning('size must be positive')
+        self.size = size
+        self._plans: Dict[str, Deque[CapturedPlan]] = {}
+        self.changes: Dict[str, int] = {}
+
+    def add(self, plan: CapturedPlan) -> Optional[CapturedPlan]:
+        """
+        Stores the plan, returns the previous plan of the id when the new
+        one has a different shape
+        """
+        plans = self._plans.get(plan.id)
+        if plans is None:
+            plans = self._plans[plan.id] = deque(maxlen=self.size)
+        previous = plans[-1] if plans else None
+        plans.append(plan)
+        if previous is not None and \
+                previous.fingerprint != plan.fingerprint:
+            self.changes[plan.id] = self.changes.get(plan.id, 0) + 1
+            return previous
+        return None
+
+    def plans(self, id: str) -> List[CapturedPlan]:
+        return list(self._plans.get(id, ()))
+
+    def last(self, id: str) -> Optional[CapturedPlan]:
+        plans = self._plans.get(id)
+        return plans[-1] if plans else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {id: {'plans': len(plans),
+                     'fingerprint': plans[-1].fingerprint,
+                     'changes': self.changes.get(id, 0)}
+                for id, plans in self._plans.items() if plans}
+
+
+class ExplainSampler:
+    """
+    Captures the plans of slow query_one, query_all and execute calls.
+
+    An execution of an id slower than its threshold in `thresholds` (or
+    `default_threshold` for other ids, None to only watch the listed ones),
+    or picked with probability `sample_rate`, is queued and run again as
+    EXPLAIN (FORMAT JSON) with the same arguments on a dedicated
+    connection, off the request path. Ids in `analyze_ids` get
+    EXPLAIN (ANALYZE, BUFFERS) instead, in a read only transaction that is
+    rolled back; list only ids that are safe to run twice.
+
+    At most one plan is captured every `min_interval` seconds and one per
+    id every `id_interval` seconds, at most `queue_size` wait for the
+    connection and the others are dropped. Plans go to `store` and to an
+    explain span under the span of the call, `on_plan_change(old, new)` is
+    called when the shape of the plan of an id changes.
+    """
+
+    def __init__(self, thresholds: Optional[Dict[str, float]] = None,
+                 default_threshold: Optional[float] = None,
+                 sample_rate: float = 0.0,
+                 analyze_ids: Iterable[str] = (),
+                 min_interval: float = 1.0, id_interval: float = 60.0,
+                 queue_size: int = EXPLAIN_QUEUE_SIZE,
+                 timeout: float = 30.0,
+                 store: Optional[PlanStore] = None,
+                 on_plan_change: Optional[
+                     Callable[[CapturedPlan, CapturedPlan], None]] = None
+                 ) -> None:
+        if not 0.0 <= sample_rate <= 1.0:
+            raise UserWarning('sample_rate must be between 0 and 1')
+        self.thresholds = dict(thresholds or {})
+        self.default_threshold = default_threshold
+        self.sample_rate = sample_rate
+        self.analyze_ids = frozenset(analyze_ids)
+        self.min_interval = min_interval
+        self.id_interval = id_interval
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.store = store or PlanStore()
+        self.on_plan_change = on_plan_change
+        self.captured = 0
+        self.dropped = 0
+        self.errors = 0
+        self._db: Any = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Future] = None
+        self._conn: Optional[asyncpg.connection.Connection] = None
+        self._next_at = 0.0
+        self._id_next_at: Dict[str, float] = {}
+
+    def attach(self, db: Any) -> None:
+        self._db = db
+        self._queue = asyncio.Queue(self.queue_size, loop=db.loop)
+        self._task = asyncio.ensure_future(self._worker(), loop=db.loop)
+
+    async def detach(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._close()
+        self._queue = None
+        self._db = None
+
+    def observe(self, ctx: Optional[Span], id: str, query: str,
+                args: tuple, elapsed: float) -> None:
+        """
+        Called after every execution, queues the capture of its plan
+        """
+        queue = self._queue
+        if queue is None:
+            return
+        threshold = self.thresholds.get(id, self.default_threshold)
+        if threshold is None or elapsed < threshold:
+            if not self.sample_rate or random.random() >= self.sample_rate:
+                return
+        now = self._db.loop.time()
+        if now < self._next_at or now < self._id_next_at.get(id, 0.0):
+            return
+        if not _explainable(query, args):
+            return
+        if queue.full():
+            self.dropped += 1
+            return
+        self._next_at = now + self.min_interval
+        self._id_next_at[id] = now + self.id_interval
+        queue.put_nowait((ctx, id, query, args, elapsed))
+
+    async def _worker(self) -> None:
+        while True:
+            item = await self._queue.get()  # type: ignore
+            try:
+                await self._capture(*item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                self.errors += 1
+                self._db.app.log_err('Could not explain %s: %r'
+                                     '' % (item[1], err))
+                if self._conn is not None and self._conn.is_closed():
+                    self._conn = None
+
+    async def _connection(self) -> asyncpg.connection.Connection:
+        if self._conn is None:
+            db = self._db
+            conn = await asyncpg.connect(dsn=db.url, loop=db.loop,
+                                         timeout=self.timeout)
+            await db._set_json_codecs(conn)
+            db.app.log_info('Explain connection to %s opened'
+                            '' % mask_url_pwd(db.url))
+            self._conn = conn
+        return self._conn
+
+    async def _close(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                await asyncio.wait_for(conn.close(), self.timeout,
+                                       loop=self._db.loop)
+            except Exception:
+                conn.terminate()
+
+    async def _explain(self, query: str, args: tuple,
+                       analyze: bool) -> Any:
+        conn = await self._connection()
+        if not analyze:
+            return await conn.fetchval(
+                'EXPLAIN (FORMAT JSON) ' + query, *args,
+                timeout=self.timeout)
+        tr = conn.transaction(readonly=True)
+        await tr.start()
+        try:
+            return await conn.fetchval(
+                'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, *args,
+                timeout=self.timeout)
+        finally:
+            await tr.rollback()
+
+    async def _capture(self, ctx: Optional[Span], id: str, query: str,
+                       args: tuple, elapsed: float) -> None:
+        analyze = id in self.analyze_ids
+        span = self._db.instrumentation.new_span(
+            ctx, "db:explain:%s" % id, 'explain:%s' % id,
+            SPAN_KIND_POSTRGES_QUERY, None)
+        if span is not None:
+            span.tag('elapsed', '%.6f' % elapsed)
+            span.tag('analyze', str(analyze).lower())
+            span.start()
+        try:
+            plan = await self._explain(query, args, analyze)
+            if isinstance(plan, (str, bytes)):
+                plan = json.loads(plan)
+            captured = CapturedPlan(time.time(), id, elapsed, analyze,
+                                    plan_fingerprint(plan), plan)
+        except Exception as err:
+            if span is not None:
+                span.finish(exception=err)
+            raise
+        self.captured += 1
+        previous = self.store.add(captured)
+        if span is not None:
+            span.tag('fingerprint', captured.fingerprint)
+            span.tag('plan_changed', str(previous is not None).lower())
+            span.annotate(json.dumps(plan))
+            span.finish()
+        if previous is not None:
+            self._db.app.log_info(
+                'Plan of %s changed: %s -> %s'
+                '' % (id, previous.fingerprint, captured.fingerprint))
+            if self.on_plan_change is not None:
+                self.on_plan_change(previous, captured)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'captured': self.captured,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'plans': self.store.snapshot(),
+        }
+
+    def export(self, sink: MetricsSink, prefix: str = 'postgres',
+               labels: Dict[str, str] = None) -> None:
+        labels = labels or {}
+        sink(prefix + '_explain_captured_total', self.captured, labels)
+        sink(prefix + '_explain_dropped_total', self.dropped, labels)
+        sink(prefix + '_explain_errors_total', self.errors, labels)
+        for id, changes in self.store.changes.items():
+            sink(prefix + '_plan_changes_total', changes,
+                 dict(labels, query_id=id))
@@ -0,0 +1,163 @@
+import asyncio
+from collections import namedtuple
+from typing import List, Any, Optional
+import asyncpg
+import asyncpg.connection
+from .metrics import Histogram
+
+HEALTHY = 'healthy'
+DEGRADED = 'degraded'
+UNHEALTHY = 'unhealthy'
+
+# time is the loop time of the check
+HealthStatus = namedtuple('HealthStatus', ['status', 'reasons', 'time'])
+
+
+class UnhealthyError(ConnectionError):
+    """
+    Raised by Postgres.health when the component is unhealthy
+    """
+
+    def __init__(self, status: HealthStatus) -> None:
+        super(UnhealthyError, self).__init__('; '.join(status.reasons))
+        self.status = status
+
+
+class _Sample:
+    __slots__ = ('time', 'calls', 'errors', 'acquire_errors',
+                 'acquire_timeouts', 'acquire_wait')
+
+    def __init__(self, db: Any, now: float) -> None:
+        stats = db._stats
+        self.time = now
+        self.calls, self.errors = db._query_stats.totals()
+        self.acquire_errors = stats.acquire_errors
+        self.acquire_timeouts = stats.acquire_timeouts
+        self.acquire_wait = list(stats.acquire_wait.counts)
+
+
+class HealthChecker:
+    """
+    Health of a Postgres component that does not use the pool: a probe
+    query on a dedicated connection kept open for it, and passive signals
+    of the traffic over the last `window` to 2 * `window` seconds.
+
+    The component is unhealthy when it is not connected, stopping or the
+    probe fails within `probe_timeout` (`probe=False` disables the probe).
+    It is degraded when connections could not be opened, acquires timed
+    out, the p99 acquire wait exceeded `acquire_wait`, the share of failed
+    calls exceeded `error_ratio` over at least `min_calls` calls, or a
+    replica is ejected.
+
+    The status is cached for `cache_ttl` seconds and concurrent callers
+    share one check
+    """
+
+    def __init__(self, cache_ttl: float = 1.0, probe: bool = True,
+                 probe_timeout: float = 1.0, window: float = 10.0,
+                 acquire_wait: float = 0.5, error_ratio: float = 0.1,
+                 min_calls: int = 20) -> None:
+        self.cache_ttl = cache_ttl
+        self.probe = probe
+        self.probe_timeout = probe_timeout
+        self.window = window
+        self.acquire_wait = acquire_wait
+        self.error_ratio = error_ratio
+        self.min_calls = min_calls
+        self._status: Optional[HealthStatus] = None
+        self._pending: Optional[asyncio.Future] = None
+        self._base: Optional[_Sample] = None
+        self._conn: Optional[asyncpg.connection.Connection] = None
+
+    async def check(self, db: Any) -> HealthStatus:
+        status = self._status
+        if status is not None and \
+                db.loop.time() - status.time < self.cache_ttl:
+            return status
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._check(db),
+                                                  loop=db.loop)
+        return await asyncio.shield(self._pending, loop=db.loop)
+
+    async def detach(self) -> None:
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        self._status = None
+        self._base = None
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.terminate()
+
+    async def _check(self, db: Any) -> HealthStatus:
+        try:
+            unhealthy: List[str] = []
+            degraded: List[str] = []
+            if db._draining:
+                unhealthy.append('stopping')
+            elif db.pool is None:
+                unhealthy.append('not connected')
+            else:
+                if self.probe:
+                    error = await self._probe(db)
+                    if error is not None:
+                        unhealthy.append('probe failed: %s' % error)
+                self._passive(db, degraded)
+            if unhealthy:
+                status = HealthStatus(UNHEALTHY, unhealthy + degraded,
+                                      db.loop.time())
+            elif degraded:
+                status = HealthStatus(DEGRADED, degraded, db.loop.time())
+            else:
+                status = HealthStatus(HEALTHY, [], db.loop.time())
+            self._status = status
+            return status
+        finally:
+            self._pending = None
+
+    async def _probe(self, db: Any) -> Optional[str]:
+        try:
+            if self._conn is None or self._conn.is_closed():
+                self._conn = await asyncpg.connect(
+                    dsn=db.url, timeout=self.probe_timeout, loop=db.loop)
+            await self._conn.fetchval('SELECT 1',
+                                      timeout=self.probe_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            conn, self._conn = self._conn, None
+            if conn is not None:
+                conn.terminate()
+            return repr(err)
+        return None
+
+    def _passive(self, db: Any, reasons: List[str]) -> None:
+        now = db.loop.time()
+        sample = _Sample(db, now)
+        base = self._base
+        if base is None or now - base.time >= self.window:
+            # the next checks compare with this sample, or with the
+            # previous one until it is at least a window old
+            self._base = sample
+        if base is None:
+            base = sample
+        errors = sample.acquire_errors - base.acquire_errors
+        if errors:
+            reasons.append('%d connection errors' % errors)
+        timeouts = sample.acquire_timeouts - base.acquire_timeouts
+        if timeouts:
+            reasons.append('%d acquire timeouts' % timeouts)
+        wait = Histogram(db._stats.acquire_wait.bounds)
+        wait.counts = [a - b for a, b in zip(sample.acquire_wait,
+                                             base.acquire_wait)]
+        wait.count = sum(wait.counts)
+        p99 = wait.quantile(0.99)
+        if p99 > self.acquire_wait:
+            reasons.append('acquire wait p99 %.3fs' % p99)
+        calls = sample.calls - base.calls
+        failed = sample.errors - base.errors
+        if calls >= self.min_calls and failed > self.error_ratio * calls:
+            reasons.append('%d of %d calls failed' % (failed, calls))
+        for endpoint in db._replicas:
+            if now < endpoint.ejected_until:
+                reasons.append('replica %s ejected' % endpoint.name)
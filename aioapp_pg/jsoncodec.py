@@ -0,0 +1,80 @@
+import json
+from typing import Union, Dict, List, Any, Optional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None  # type: ignore
+
+JsonType = Union[None, int, float, str, bool, List[Any], Dict[str, Any]]
+JsonData = Union[bytes, memoryview]
+
+
+class JsonCodec:
+    """
+    Serializes values for the json and jsonb columns. `loads` receives the
+    raw document as bytes or as a memoryview over the wire buffer and
+    should parse it without copying when the library allows it
+    """
+    name = 'json'
+
+    def dumps(self, value: JsonType) -> bytes:
+        return json.dumps(value).encode('utf-8')
+
+    def loads(self, data: JsonData) -> JsonType:
+        return json.loads(str(data, 'utf-8'))
+
+
+class UjsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def dumps(self, value: JsonType) -> bytes:
+        return ujson.dumps(value).encode('utf-8')
+
+    def loads(self, data: JsonData) -> JsonType:
+        return ujson.loads(str(data, 'utf-8'))
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def dumps(self, value: JsonType) -> bytes:
+        return orjson.dumps(value)
+
+    def loads(self, data: JsonData) -> JsonType:
+        # orjson parses buffers directly
+        return orjson.loads(data)
+
+
+def available_json_codecs() -> Dict[str, JsonCodec]:
+    codecs: Dict[str, JsonCodec] = {'json': JsonCodec()}
+    if ujson is not None:
+        codecs['ujson'] = UjsonCodec()
+    if orjson is not None:
+        codecs['orjson'] = OrjsonCodec()
+    return codecs
+
+
+def get_json_codec(codec: Optional[Union[str, JsonCodec]]) -> JsonCodec:
+    """
+    Resolves a codec by name: 'json', 'ujson', 'orjson' or 'auto' for the
+    fastest installed one. A library that is not installed falls back to
+    the stdlib codec
+    """
+    if isinstance(codec, JsonCodec):
+        return codec
+    codecs = available_json_codecs()
+    if codec is None or codec == 'json':
+        return codecs['json']
+    if codec == 'auto':
+        for name in ('orjson', 'ujson', 'json'):
+            if name in codecs:
+                return codecs[name]
+    if codec not in ('ujson', 'orjson'):
+        raise UserWarning('Unknown json codec %r' % codec)
+    return codecs.get(codec, codecs['json'])
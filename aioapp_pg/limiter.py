@@ -0,0 +1,149 @@
+import asyncio
+from collections import deque
+from typing import Dict, Any, Optional, Deque, Tuple
+
+PRIORITY_LOW = -1
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+
+# seconds of waiting worth one priority level
+PRIORITY_AGING = 1.0
+
+
+class Limiter:
+    """
+    Semaphore with a limit that can be changed while it is in use.
+    Lowering the limit does not take slots away, it only delays the next
+    waiters until enough slots are released.
+
+    Waiters with a higher priority are served first, in FIFO order within
+    a priority. Every `aging` seconds of waiting count as one priority
+    level, so low priority work is not starved under sustained load.
+
+    The peaks of waiting time, waiters and slots in use are kept until
+    `take_window()` so a controller can look at what happened between
+    two of its ticks.
+    """
+
+    def __init__(self, limit: int, loop: asyncio.AbstractEventLoop,
+                 aging: float = PRIORITY_AGING) -> None:
+        if limit < 1:
+            raise UserWarning('limit must be positive')
+        self._limit = limit
+        self._loop = loop
+        self.aging = aging
+        self._in_use = 0
+        # priority -> (future, enqueued at)
+        self._queues: Dict[int, Deque[Tuple[asyncio.Future, float]]] = {}
+        self._waiting = 0
+        self._window_max_wait = 0.0
+        self._window_peak_waiters = 0
+        self._window_peak_in_use = 0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def resize(self, limit: int) -> None:
+        if limit < 1:
+            raise UserWarning('limit must be positive')
+        self._limit = limit
+        self._wake()
+
+    async def acquire(self, timeout: Optional[float] = None,
+                      priority: int = PRIORITY_NORMAL) -> None:
+        if self._in_use < self._limit and not self._waiting:
+            self._take()
+            return
+        fut = self._loop.create_future()
+        start = self._loop.time()
+        queue = self._queues.get(priority)
+        if queue is None:
+            queue = self._queues[priority] = deque()
+        queue.append((fut, start))
+        self._waiting += 1
+        if self._waiting > self._window_peak_waiters:
+            self._window_peak_waiters = self._waiting
+        try:
+            await asyncio.wait_for(fut, timeout, loop=self._loop)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            if fut.done() and not fut.cancelled():
+                # the slot was granted while the waiter was giving up
+                self.release()
+            else:
+                self._discard(queue, fut, start)
+            raise
+        finally:
+            self._window_max_wait = max(self._window_max_wait,
+                                        self._loop.time() - start)
+
+    def release(self) -> None:
+        self._in_use -= 1
+        self._wake()
+
+    def _take(self) -> None:
+        self._in_use += 1
+        if self._in_use > self._window_peak_in_use:
+            self._window_peak_in_use = self._in_use
+
+    def _discard(self, queue: Deque[Tuple[asyncio.Future, float]],
+                 fut: asyncio.Future, start: float) -> None:
+        try:
+            queue.remove((fut, start))
+        except ValueError:
+            return
+        self._waiting -= 1
+
+    def _pop_next(self) -> asyncio.Future:
+        """
+        Removes the waiter to serve next: the head of the priority queue
+        with the best aged priority, the oldest one on a tie
+        """
+        now = self._loop.time()
+        best: Optional[Deque[Tuple[asyncio.Future, float]]] = None
+        best_score = 0.0
+        best_since = 0.0
+        for priority, queue in self._queues.items():
+            if not queue:
+                continue
+            since = queue[0][1]
+            score = float(priority)
+            if self.aging > 0:
+                score += (now - since) / self.aging
+            if (best is None or score > best_score or
+                    (score == best_score and since < best_since)):
+                best, best_score, best_since = queue, score, since
+        self._waiting -= 1
+        return best.popleft()[0]  # type: ignore
+
+    def _wake(self) -> None:
+        while self._waiting and self._in_use < self._limit:
+            fut = self._pop_next()
+            if not fut.done():
+                self._take()
+                fut.set_result(None)
+
+    def _reset_window(self) -> None:
+        self._window_max_wait = 0.0
+        self._window_peak_waiters = self._waiting
+        self._window_peak_in_use = self._in_use
+
+    def take_window(self) -> Dict[str, Any]:
+        """
+        Returns the peaks since the previous call and starts a new window
+        """
+        window = {
+            'max_wait': self._window_max_wait,
+            'peak_waiters': self._window_peak_waiters,
+            'peak_in_use': self._window_peak_in_use,
+        }
+        self._reset_window()
+        return window
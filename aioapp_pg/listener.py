@@ -0,0 +1,246 @@
+import asyncio
+from collections import namedtuple
+from typing import Dict, List, Optional
+import asyncpg
+import asyncpg.connection
+from aioapp.app import Component
+from aioapp.error import PrepareError
+from aioapp.misc import mask_url_pwd
+from aioapp.tracer import Span
+
+OVERFLOW_DROP_NEW = 'drop_new'
+OVERFLOW_DROP_OLD = 'drop_old'
+OVERFLOW_ERROR = 'error'
+
+Notification = namedtuple('Notification', ['pid', 'channel', 'payload'])
+
+
+class ListenerOverflowError(Exception):
+    pass
+
+
+class Subscription:
+    """
+    Bounded queue of notifications of one channel, iterate it with
+    `async for` or call `get()`. When the queue is full new notifications
+    are handled according to the overflow policy:
+
+    drop_new - the new notification is discarded
+    drop_old - the oldest queued notification is discarded
+    error - the notification is discarded and the next `get()` raises
+    ListenerOverflowError
+    """
+
+    def __init__(self, listener: 'PostgresListener', channel: str,
+                 queue_size: int, overflow: str,
+                 loop: asyncio.AbstractEventLoop) -> None:
+        if overflow not in (OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLD,
+                            OVERFLOW_ERROR):
+            raise UserWarning('Unknown overflow policy %r' % overflow)
+        self.channel = channel
+        self.overflow = overflow
+        self.dropped = 0
+        self._listener = listener
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size,
+                                                   loop=loop)
+        self._overflowed = False
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def _deliver(self, notification: Optional[Notification]) -> None:
+        if self._closed:
+            return
+        if self._queue.full():
+            self.dropped += 1
+            if self.overflow == OVERFLOW_DROP_OLD:
+                self._queue.get_nowait()
+            else:
+                if self.overflow == OVERFLOW_ERROR:
+                    self._overflowed = True
+                return
+        self._queue.put_nowait(notification)
+
+    async def get(self) -> Optional[Notification]:
+        """
+        Waits for the next notification, returns None once the
+        subscription is closed
+        """
+        if self._overflowed:
+            self._overflowed = False
+            raise ListenerOverflowError(
+                'Notifications of channel %r were dropped' % self.channel)
+        if self._closed and self._queue.empty():
+            return None
+        return await self._queue.get()
+
+    def __aiter__(self) -> 'Subscription':
+        return self
+
+    async def __anext__(self) -> Notification:
+        notification = await self.get()
+        if notification is None:
+            raise StopAsyncIteration
+        return notification
+
+    async def close(self) -> None:
+        await self._listener._unsubscribe(self)
+
+    def _close(self) -> None:
+        if self._closed:
+            return
+        # wake up a pending get()
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+        self._closed = True
+
+
+class PostgresListener(Component):
+    """
+    Receives LISTEN/NOTIFY notifications on a dedicated connection that
+    is not taken from the Postgres pool. The connection is checked every
+    `keepalive_interval` seconds and re-established (with all channels
+    listened again) when it is lost; notifications sent while
+    disconnected are lost, `reconnects` counts the reconnections.
+    """
+
+    def __init__(self, url: str, queue_size: int = 1000,
+                 overflow: str = OVERFLOW_DROP_OLD,
+                 keepalive_interval: float = 10.0,
+                 connect_timeout: float = 10.0,
+                 connect_max_attempts: int = 10,
+                 connect_retry_delay: float = 1.0) -> None:
+        super(PostgresListener, self).__init__()
+        self.url = url
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+        self.connect_max_attempts = connect_max_attempts
+        self.connect_retry_delay = connect_retry_delay
+        self.reconnects = 0
+        self._conn: Optional[asyncpg.connection.Connection] = None
+        self._subs: Dict[str, List[Subscription]] = {}
+        self._task: Optional[asyncio.Future] = None
+
+    @property
+    def _masked_url(self) -> Optional[str]:
+        if self.url is not None:
+            return mask_url_pwd(self.url)
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None and not self._conn.is_closed()
+
+    def _on_notification(self, conn: asyncpg.connection.Connection,
+                         pid: int, channel: str, payload: str) -> None:
+        notification = Notification(pid, channel, payload)
+        for sub in self._subs.get(channel, ()):
+            sub._deliver(notification)
+
+    async def _connect(self) -> None:
+        self.app.log_info("Connecting to %s" % self._masked_url)
+        conn = await asyncpg.connect(self.url, loop=self.loop,
+                                     timeout=self.connect_timeout)
+        try:
+            for channel in list(self._subs):
+                await conn.add_listener(channel, self._on_notification)
+        except Exception:
+            await conn.close()
+            raise
+        self._conn = conn
+        self.app.log_info("Connected to %s" % self._masked_url)
+
+    async def _disconnect(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.is_closed():
+            try:
+                await asyncio.wait_for(conn.close(), self.connect_timeout,
+                                       loop=self.loop)
+            except Exception:
+                conn.terminate()
+
+    async def prepare(self) -> None:
+        if self.app is None:
+            raise UserWarning('Unattached component')
+
+        for i in range(self.connect_max_attempts):
+            try:
+                await self._connect()
+                return
+            except Exception as e:
+                self.app.log_err(str(e))
+                await asyncio.sleep(self.connect_retry_delay)
+        raise PrepareError("Could not connect to %s" % self._masked_url)
+
+    async def start(self) -> None:
+        self._task = asyncio.ensure_future(self._keepalive(), loop=self.loop)
+
+    async def _keepalive(self) -> None:
+        while True:
+            try:
+                if not self.connected:
+                    await self._disconnect()
+                    await self._connect()
+                    self.reconnects += 1
+                await asyncio.sleep(self.keepalive_interval)
+                await self._conn.execute(  # type: ignore
+                    'SELECT 1', timeout=self.keepalive_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.app.log_err("Listener connection to %s failed: %s"
+                                 "" % (self._masked_url, e))
+                await self._disconnect()
+                await asyncio.sleep(self.connect_retry_delay)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for subs in self._subs.values():
+            for sub in subs:
+                sub._close()
+        self._subs.clear()
+        if self._conn is not None:
+            self.app.log_info("Disconnecting from %s" % self._masked_url)
+        await self._disconnect()
+
+    async def health(self, ctx: Span) -> None:
+        if not self.connected:
+            raise ConnectionError('Listener is not connected to %s'
+                                  '' % self._masked_url)
+
+    async def subscribe(self, channel: str, queue_size: int = None,
+                        overflow: str = None) -> Subscription:
+        sub = Subscription(self, channel,
+                           queue_size or self.queue_size,
+                           overflow or self.overflow, self.loop)
+        subs = self._subs.setdefault(channel, [])
+        subs.append(sub)
+        if len(subs) == 1 and self.connected:
+            await self._conn.add_listener(  # type: ignore
+                channel, self._on_notification)
+        return sub
+
+    async def _unsubscribe(self, sub: Subscription) -> None:
+        sub._close()
+        subs = self._subs.get(sub.channel)
+        if not subs or sub not in subs:
+            return
+        subs.remove(sub)
+        if not subs:
+            del self._subs[sub.channel]
+            if self.connected:
+                await self._conn.remove_listener(  # type: ignore
+                    sub.channel, self._on_notification)
@@ -0,0 +1,129 @@
+import asyncio
+from typing import Dict, List, Any, Optional, Hashable, Iterable
+import asyncpg.protocol
+from aioapp.tracer import Span
+from .tracing import SPAN_KIND_POSTRGES_QUERY
+from .deadline import effective_timeout, ensure_future_without_deadline
+
+LOADER_MAX_BATCH_SIZE = 500
+
+
+class BatchLoader:
+    """
+    Batches point lookups of one query id: keys requested with `load()`
+    during one event loop iteration (or within `window` seconds) are
+    fetched with a single query taking the array of keys as $1, e.g.
+
+        SELECT * FROM users WHERE id = ANY($1::int[])
+
+    and the rows are handed back to the callers by the value of
+    `key_column`, None for keys without a row. A batch is sent as soon as
+    it has `max_batch_size` distinct keys.
+
+    The batch runs in its own task with the span of the caller that
+    opened it, a failing batch fails every caller waiting for it. The
+    task does not inherit the deadline of that caller, the query is
+    bounded by `timeout` and every caller waits at most until its own
+    deadline.
+    """
+
+    def __init__(self, db: Any, id: str, query: str,
+                 key_column: str = 'id',
+                 max_batch_size: int = LOADER_MAX_BATCH_SIZE,
+                 window: float = 0.0, timeout: Optional[float] = None,
+                 readonly: bool = False) -> None:
+        if max_batch_size < 1:
+            raise UserWarning('max_batch_size must be positive')
+        self._db = db
+        self.id = id
+        self.query = query
+        self.key_column = key_column
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.timeout = timeout
+        self.readonly = readonly
+        self._pending: Dict[Hashable, List[asyncio.Future]] = {}
+        self._ctx: Optional[Span] = None
+        self._handle: Optional[asyncio.Handle] = None
+        self.batches = 0
+        self.keys = 0
+
+    async def load(self, ctx: Span, key: Hashable
+                   ) -> Optional[asyncpg.protocol.Record]:
+        loop = self._db.loop
+        timeout = effective_timeout(None)
+        fut = loop.create_future()
+        waiters = self._pending.get(key)
+        if waiters is not None:
+            waiters.append(fut)
+        else:
+            if not self._pending:
+                self._ctx = ctx
+                if self.window > 0:
+                    self._handle = loop.call_later(self.window,
+                                                   self._dispatch)
+                else:
+                    self._handle = loop.call_soon(self._dispatch)
+            self._pending[key] = [fut]
+            if len(self._pending) >= self.max_batch_size:
+                self._dispatch()
+        # the batch goes on for the other callers when this one gives up
+        return await asyncio.wait_for(asyncio.shield(fut, loop=loop),
+                                      timeout, loop=loop)
+
+    async def load_many(self, ctx: Span, keys: Iterable[Hashable]
+                        ) -> List[Optional[asyncpg.protocol.Record]]:
+        return list(await asyncio.gather(
+            *[self.load(ctx, key) for key in keys], loop=self._db.loop))
+
+    def _dispatch(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        pending, self._pending = self._pending, {}
+        ctx, self._ctx = self._ctx, None
+        if not pending:
+            return
+        ensure_future_without_deadline(self._run(ctx, pending),
+                                       self._db.loop)
+
+    async def _run(self, ctx: Optional[Span],
+                   pending: Dict[Hashable, List[asyncio.Future]]) -> None:
+        self.batches += 1
+        self.keys += len(pending)
+        span = self._db.instrumentation.new_span(
+            ctx, "db:batch:%s" % self.id, self.id,
+            SPAN_KIND_POSTRGES_QUERY, None)
+        try:
+            if span is not None:
+                span.tag('batch_size', str(len(pending)))
+                span.start()
+            rows = await self._db.query_all(
+                span or ctx, self.id, self.query, list(pending),
+                timeout=self.timeout, readonly=self.readonly)
+        except Exception as err:
+            if span is not None:
+                span.finish(exception=err)
+            for waiters in pending.values():
+                for fut in waiters:
+                    if not fut.done():
+                        fut.set_exception(err)
+            return
+        found: Dict[Hashable, asyncpg.protocol.Record] = {}
+        for row in rows:
+            found.setdefault(row[self.key_column], row)
+        if span is not None:
+            span.tag('found', str(len(found)))
+            span.finish()
+        for key, waiters in pending.items():
+            row = found.get(key)
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_result(row)
+
+    def info(self) -> Dict[str, int]:
+        return {
+            'batches': self.batches,
+            'keys': self.keys,
+            'pending': len(self._pending),
+        }
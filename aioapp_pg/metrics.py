@@ -0,0 +1,325 @@
+import math
+from bisect import bisect_left
+from typing import Dict, List, Any, Callable, Sequence, Optional, Tuple
+
+# sink(name, value, labels), e.g. a prometheus/statsd client adapter
+MetricsSink = Callable[[str, float, Dict[str, str]], None]
+
+ACQUIRE_WAIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+QUERY_STATS_MAX_IDS = 1000
+# ids over QUERY_STATS_MAX_IDS are counted together under this one
+QUERY_STATS_OTHER = '(other)'
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, observing a value is a bisect and two
+    additions
+    """
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = tuple(bounds)
+        self.counts: List[int] = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile, the last finite
+        bound for values above it
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(self.bounds + (float('inf'),),
+                                self.counts)),
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+    def export(self, sink: MetricsSink, name: str,
+               labels: Dict[str, str]) -> None:
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            sink(name + '_bucket', cumulative, dict(labels, le=le))
+        sink(name + '_count', self.count, labels)
+        sink(name + '_sum', self.sum, labels)
+
+
+class LogHistogram:
+    """
+    HDR-style histogram: every power of two between `lowest` and
+    `lowest * 2 ** octaves` is split in `precision` linear buckets, so a
+    quantile is off by at most 1/precision of its value. Buckets are
+    allocated on first use and never exceed octaves * precision
+    """
+
+    def __init__(self, lowest: float = 0.00001, octaves: int = 24,
+                 precision: int = 16) -> None:
+        self.lowest = lowest
+        self.octaves = octaves
+        self.precision = precision
+        self._last = octaves * precision - 1
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        mantissa, exp = math.frexp(value / self.lowest)
+        if exp < 1:
+            index = 0
+        else:
+            index = min((exp - 1) * self.precision +
+                        int((mantissa - 0.5) * 2 * self.precision),
+                        self._last)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def _upper(self, index: int) -> float:
+        exp, sub = divmod(index, self.precision)
+        return self.lowest * 2 ** exp * (1 + (sub + 1) / self.precision)
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile, capped by the
+        largest value observed
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class QueryIdStats:
+    """
+    Counters of one query id, `rows` counts rows returned or affected and
+    `bytes` the approximate size of the decoded results. The slow_*
+    counters cover the current slow query log interval
+    """
+
+    __slots__ = ('calls', 'errors', 'rows', 'bytes', 'latency',
+                 'slow_calls', 'slow_max')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.bytes = 0
+        self.latency = LogHistogram()
+        self.slow_calls = 0
+        self.slow_max = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'latency': self.latency.snapshot(),
+        }
+
+
+class QueryStats:
+    """
+    Always-on statistics by query id, updated from the event loop thread
+    only like PoolStats. At most `max_ids` ids are tracked separately, the
+    others are counted under QUERY_STATS_OTHER.
+
+    Every `slow_log_interval` seconds the ids that had calls slower than
+    `slow_threshold` are logged, None disables the log
+    """
+
+    def __init__(self, max_ids: int = QUERY_STATS_MAX_IDS,
+                 slow_threshold: float = 1.0,
+                 slow_log_interval: Optional[float] = 60.0) -> None:
+        if max_ids < 1:
+            raise UserWarning('max_ids must be positive')
+        self.max_ids = max_ids
+        self.slow_threshold = slow_threshold
+        self.slow_log_interval = slow_log_interval
+        self._ids: Dict[str, QueryIdStats] = {}
+
+    def observe(self, id: str, elapsed: float, error: bool,
+                rows: Optional[int], size: Optional[int]) -> None:
+        stats = self._ids.get(id)
+        if stats is None:
+            if len(self._ids) >= self.max_ids:
+                id = QUERY_STATS_OTHER
+                stats = self._ids.get(id)
+            if stats is None:
+                stats = self._ids[id] = QueryIdStats()
+        stats.calls += 1
+        stats.latency.observe(elapsed)
+        if error:
+            stats.errors += 1
+        if rows is not None:
+            stats.rows += rows
+        if size is not None:
+            stats.bytes += size
+        if elapsed >= self.slow_threshold:
+            stats.slow_calls += 1
+            if elapsed > stats.slow_max:
+                stats.slow_max = elapsed
+
+    def totals(self) -> Tuple[int, int]:
+        """
+        Calls and errors of all ids
+        """
+        calls = errors = 0
+        for stats in self._ids.values():
+            calls += stats.calls
+            errors += stats.errors
+        return calls, errors
+
+    def take_slow(self) -> List[Tuple[str, int, float]]:
+        """
+        Returns (id, slow calls, slowest call) of the ids with slow calls
+        since the previous call, slowest first
+        """
+        slow = []
+        for id, stats in self._ids.items():
+            if stats.slow_calls:
+                slow.append((id, stats.slow_calls, stats.slow_max))
+                stats.slow_calls = 0
+                stats.slow_max = 0.0
+        slow.sort(key=lambda item: item[2], reverse=True)
+        return slow
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {id: stats.snapshot() for id, stats in self._ids.items()}
+
+    def export(self, sink: MetricsSink, prefix: str = 'postgres',
+               labels: Dict[str, str] = None) -> None:
+        labels = labels or {}
+        for id, stats in self._ids.items():
+            id_labels = dict(labels, query_id=id)
+            for name in ('calls', 'errors', 'rows', 'bytes'):
+                sink('%s_query_%s_total' % (prefix, name),
+                     getattr(stats, name), id_labels)
+            latency = stats.latency
+            sink(prefix + '_query_seconds_count', latency.count, id_labels)
+            sink(prefix + '_query_seconds_sum', latency.sum, id_labels)
+            for q in (0.5, 0.9, 0.99):
+                sink(prefix + '_query_seconds', latency.quantile(q),
+                     dict(id_labels, quantile=repr(q)))
+
+
+class PoolStats:
+    """
+    Always-on counters of the connection pool. They are plain attributes
+    updated from the event loop thread only, so no locking is needed
+    """
+
+    def __init__(self) -> None:
+        self.acquire_wait = Histogram(ACQUIRE_WAIT_BUCKETS)
+        self.acquire_wait_by_priority: Dict[int, Histogram] = {}
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.acquire_errors = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        # run_in_xact attempts and retries on serialization failures and
+        # deadlocks, exhausted counts transactions that ran out of retries
+        self.xact_attempts = 0
+        self.xact_retries = 0
+        self.xact_retries_exhausted = 0
+
+    @property
+    def connections(self) -> int:
+        return self.connections_created - self.connections_closed
+
+    @property
+    def idle(self) -> int:
+        return max(self.connections - self.in_use, 0)
+
+    def observe_acquire_wait(self, wait: float, priority: int) -> None:
+        self.acquire_wait.observe(wait)
+        hist = self.acquire_wait_by_priority.get(priority)
+        if hist is None:
+            hist = self.acquire_wait_by_priority[priority] = \
+                Histogram(ACQUIRE_WAIT_BUCKETS)
+        hist.observe(wait)
+
+    def connection_created(self) -> None:
+        self.connections_created += 1
+
+    def connection_closed(self) -> None:
+        self.connections_closed += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'acquires': self.acquires,
+            'acquire_timeouts': self.acquire_timeouts,
+            'acquire_errors': self.acquire_errors,
+            'acquire_wait': self.acquire_wait.snapshot(),
+            'acquire_wait_by_priority': {
+                priority: hist.snapshot() for priority, hist
+                in sorted(self.acquire_wait_by_priority.items())},
+            'in_use': self.in_use,
+            'idle': self.idle,
+            'waiting': self.waiting,
+            'connections': self.connections,
+            'connections_created': self.connections_created,
+            'connections_closed': self.connections_closed,
+            'xact_attempts': self.xact_attempts,
+            'xact_retries': self.xact_retries,
+            'xact_retries_exhausted': self.xact_retries_exhausted,
+        }
+
+    def export(self, sink: MetricsSink, prefix: str = 'postgres',
+               labels: Dict[str, str] = None) -> None:
+        labels = labels or {}
+        for name in ('acquires', 'acquire_timeouts', 'acquire_errors',
+                     'connections_created', 'connections_closed',
+                     'xact_attempts', 'xact_retries',
+                     'xact_retries_exhausted'):
+            sink('%s_%s_total' % (prefix, name), getattr(self, name),
+                 labels)
+        for name in ('in_use', 'idle', 'waiting', 'connections'):
+            sink('%s_%s' % (prefix, name), getattr(self, name), labels)
+        self.acquire_wait.export(sink, prefix + '_acquire_wait_seconds',
+                                 labels)
+        for priority, hist in self.acquire_wait_by_priority.items():
+            hist.export(sink, prefix + '_acquire_wait_by_priority_seconds',
+                        dict(labels, priority=str(priority)))
@@ -0,0 +1,71 @@
+from typing import List, Optional
+import asyncpg.pool
+
+REPLICA_LATENCY_DECAY = 0.2
+
+
+class Endpoint:
+    """
+    One database server of the component with its own pool and the
+    signals the balancer uses to route to it
+    """
+
+    def __init__(self, name: str, url: str, eject_failures: int = 3,
+                 eject_time: float = 30.0) -> None:
+        self.name = name
+        self.url = url
+        self.eject_failures = eject_failures
+        self.eject_time = eject_time
+        self.pool: asyncpg.pool.Pool = None
+        self.connecting = False
+        # exponentially weighted moving average of query latency, seconds
+        self.latency: Optional[float] = None
+        # acquired connections plus acquires waiting for this endpoint
+        self.inflight = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.pool is not None and now >= self.ejected_until
+
+    def observe(self, latency: float) -> None:
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += REPLICA_LATENCY_DECAY * (latency - self.latency)
+        self.failures = 0
+
+    def fail(self, now: float) -> bool:
+        """
+        Registers a connection-level failure, returns True when the
+        endpoint got ejected because of it
+        """
+        self.failures += 1
+        if self.failures < self.eject_failures:
+            return False
+        self.failures = 0
+        self.ejected_until = now + self.eject_time
+        return True
+
+    def score(self) -> float:
+        # endpoints without measurements yet get probed first
+        return (self.latency or 0.0) * (self.inflight + 1)
+
+
+class ReplicaBalancer:
+    """
+    Picks the healthy replica with the best latency/queue-length score
+    """
+
+    def __init__(self, endpoints: List[Endpoint]) -> None:
+        self.endpoints = endpoints
+
+    def choose(self, now: float) -> Optional[Endpoint]:
+        best = None
+        for endpoint in self.endpoints:
+            if not endpoint.available(now):
+                continue
+            if best is None or ((endpoint.score(), endpoint.inflight) <
+                                (best.score(), best.inflight)):
+                best = endpoint
+        return best
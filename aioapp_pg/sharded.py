@@ -0,0 +1,383 @@
+import abc
+import asyncio
+import hashlib
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from typing import (Dict, List, Any, Optional, Sequence, Tuple, Hashable,
+                    AsyncIterator)
+import asyncpg.protocol
+from aioapp.app import Component
+from aioapp.tracer import Span
+from .tracing import InstrumentationPolicy, SPAN_KIND_POSTRGES_QUERY
+from .metrics import MetricsSink
+# imported at the end of the package module, after these are defined
+from . import (Postgres, PostgresTracerConfig, ConnectionContextManager,
+               ConnectionXactContextManager)
+
+ShardResult = namedtuple('ShardResult', ['shard', 'rows', 'error'])
+
+# Postgres options holding state of one component, each shard needs its
+# own instance
+STATEFUL_OPTIONS = ('result_cache', 'coalescer', 'sizer', 'bulkheads',
+                    'explain', 'query_stats', 'health_checker')
+
+
+def _key_bytes(key: Any) -> bytes:
+    if isinstance(key, bytes):
+        return key
+    return str(key).encode('utf-8')
+
+
+class ShardingStrategy(abc.ABC):
+    """
+    Maps a shard key to the name of a shard
+    """
+
+    @abc.abstractmethod
+    def shard_for(self, key: Any, shards: Sequence[str]) -> str:
+        pass
+
+
+class HashStrategy(ShardingStrategy):
+    """
+    Jump consistent hash of a blake2b digest of the key, stable across
+    processes and python versions. Appending a shard moves only about
+    1/n of the keys, to the new shard; shards must not be reordered
+    """
+
+    def shard_for(self, key: Any, shards: Sequence[str]) -> str:
+        digest = hashlib.blake2b(_key_bytes(key), digest_size=8).digest()
+        h = int.from_bytes(digest, 'big')
+        b, j = -1, 0
+        while j < len(shards):
+            b = j
+            h = (h * 2862933555777941757 + 1) & 0xffffffffffffffff
+            j = int((b + 1) * (float(1 << 31) / float((h >> 33) + 1)))
+        return shards[b]
+
+
+class RangeStrategy(ShardingStrategy):
+    """
+    Keys below the first bound go to the first shard, keys from a bound
+    up to the next one to the shard of that bound:
+
+        RangeStrategy([('eu', 10000), ('us', 20000), ('apac', None)])
+
+    puts keys < 10000 to 'eu', [10000, 20000) to 'us' and the rest to
+    'apac'. The last bound must be None
+    """
+
+    def __init__(self, ranges: Sequence[Tuple[str, Any]]) -> None:
+        if not ranges or ranges[-1][1] is not None:
+            raise UserWarning('The last range must be open (None)')
+        self._bounds = [bound for _, bound in ranges[:-1]]
+        if self._bounds != sorted(self._bounds):
+            raise UserWarning('Range bounds must be ascending')
+        self._shards = [shard for shard, _ in ranges]
+
+    def shard_for(self, key: Any, shards: Sequence[str]) -> str:
+        return self._shards[bisect_right(self._bounds, key)]
+
+
+class LookupStrategy(ShardingStrategy):
+    """
+    Explicit key to shard table, e.g. tenants moved to dedicated shards.
+    Keys missing in the table go to the `default` shard or, when a
+    `fallback` strategy is given, are routed by it
+    """
+
+    def __init__(self, table: Dict[Hashable, str],
+                 default: Optional[str] = None,
+                 fallback: Optional[ShardingStrategy] = None) -> None:
+        self.table = table
+        self.default = default
+        self.fallback = fallback
+
+    def shard_for(self, key: Any, shards: Sequence[str]) -> str:
+        shard = self.table.get(key)
+        if shard is not None:
+            return shard
+        if self.fallback is not None:
+            return self.fallback.shard_for(key, shards)
+        if self.default is not None:
+            return self.default
+        raise KeyError('No shard for key %r' % (key,))
+
+
+class ShardedPostgresError(Exception):
+    """
+    Raised by query_all_shards with raise_on_error when some shards
+    failed, `result` holds what the others returned
+    """
+
+    def __init__(self, message: str, result: 'ShardedResult') -> None:
+        super(ShardedPostgresError, self).__init__(message)
+        self.result = result
+
+
+class ShardedResult:
+    """
+    Result of a scatter-gather read: the rows of all shards that answered
+    merged in shard order, the rows and errors by shard
+    """
+
+    def __init__(self, results: List[ShardResult]) -> None:
+        self.by_shard: Dict[str, List[asyncpg.protocol.Record]] = \
+            OrderedDict()
+        self.errors: Dict[str, BaseException] = OrderedDict()
+        for res in results:
+            if res.error is not None:
+                self.errors[res.shard] = res.error
+            else:
+                self.by_shard[res.shard] = res.rows
+        self.rows = [row for rows in self.by_shard.values() for row in rows]
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.errors)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+class ShardedPostgres(Component):
+    """
+    Several Postgres shards behind one component. Single-shard calls take
+    a shard key routed by the strategy (HashStrategy by default),
+    query_all_shards and iter_all_shards read from every shard
+    concurrently.
+
+    shards: shard name -> url, the order matters for HashStrategy
+    shard_timeout: default time limit of one shard in scatter-gather
+    reads, acquire included
+    shard_kwargs: shard name -> keyword arguments of the Postgres of that
+    shard, over the common ones
+    All other keyword arguments are passed to the Postgres of every shard.
+    Options listed in STATEFUL_OPTIONS (result_cache, coalescer, sizer...)
+    keep the state of one component, e.g. cache keys know nothing about
+    shards, so they are only accepted in shard_kwargs, one instance per
+    shard.
+    """
+
+    def __init__(self, shards: Dict[str, str],
+                 strategy: Optional[ShardingStrategy] = None,
+                 shard_timeout: Optional[float] = None,
+                 shard_kwargs: Optional[Dict[str, Dict[str, Any]]] = None,
+                 **kwargs: Any) -> None:
+        super(ShardedPostgres, self).__init__()
+        if not shards:
+            raise UserWarning('At least one shard is required')
+        shard_kwargs = shard_kwargs or {}
+        unknown = set(shard_kwargs) - set(shards)
+        if unknown:
+            raise UserWarning('shard_kwargs of unknown shards: %s'
+                              '' % ', '.join(sorted(unknown)))
+        shared = [name for name in STATEFUL_OPTIONS
+                  if kwargs.get(name) is not None]
+        if shared:
+            raise UserWarning('%s can not be shared by shards, pass an '
+                              'instance per shard in shard_kwargs'
+                              '' % ', '.join(shared))
+        seen: Dict[int, str] = {}
+        for shard, options in shard_kwargs.items():
+            for name in STATEFUL_OPTIONS:
+                value = options.get(name)
+                if value is None:
+                    continue
+                if id(value) in seen:
+                    raise UserWarning('Shards %s and %s share the same %s'
+                                      '' % (seen[id(value)], shard, name))
+                seen[id(value)] = shard
+        self.strategy = strategy or HashStrategy()
+        self.shard_timeout = shard_timeout
+        self.instrumentation = (kwargs.get('instrumentation') or
+                                InstrumentationPolicy())
+        self.shards: Dict[str, Postgres] = OrderedDict(
+            (name, Postgres(url, **dict(kwargs,
+                                        **shard_kwargs.get(name, {}))))
+            for name, url in shards.items())
+        self._names = list(self.shards)
+
+    def _attach(self) -> None:
+        # shards are not registered in the application, they share the
+        # app and the loop of this component
+        for db in self.shards.values():
+            db.app = self.app
+            db.loop = self.loop
+
+    async def _each(self, method: str) -> None:
+        await asyncio.gather(*[getattr(db, method)()
+                               for db in self.shards.values()],
+                             loop=self.loop)
+
+    async def prepare(self) -> None:
+        if self.app is None:
+            raise UserWarning('Unattached component')
+        self._attach()
+        await self._each('prepare')
+
+    async def start(self) -> None:
+        await self._each('start')
+
+    async def stop(self) -> None:
+        if self.app is None:
+            raise UserWarning('Unattached component')
+        await self._each('stop')
+
+    async def shard_health(self, ctx: Span) -> Dict[str, Optional[str]]:
+        """
+        Health of every shard: None when healthy, the error otherwise
+        """
+        results = await asyncio.gather(
+            *[db.health(ctx) for db in self.shards.values()],
+            loop=self.loop, return_exceptions=True)
+        return OrderedDict(
+            (name, None if not isinstance(res, BaseException)
+             else repr(res))
+            for name, res in zip(self._names, results))
+
+    async def health(self, ctx: Span) -> None:
+        health = await self.shard_health(ctx)
+        failed = ['%s: %s' % (name, err) for name, err in health.items()
+                  if err is not None]
+        if failed:
+            raise ConnectionError('Unhealthy shards: %s' % '; '.join(failed))
+
+    def shard_name(self, key: Any) -> str:
+        name = self.strategy.shard_for(key, self._names)
+        if name not in self.shards:
+            raise KeyError('Unknown shard %r for key %r' % (name, key))
+        return name
+
+    def shard(self, key: Any) -> Postgres:
+        return self.shards[self.shard_name(key)]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return OrderedDict((name, db.stats())
+                           for name, db in self.shards.items())
+
+    def query_stats(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        return OrderedDict((name, db.query_stats())
+                           for name, db in self.shards.items())
+
+    def export_stats(self, sink: MetricsSink, prefix: str = 'postgres',
+                     labels: Dict[str, str] = None) -> None:
+        for name, db in self.shards.items():
+            db.export_stats(sink, prefix=prefix,
+                            labels=dict(labels or {}, shard=name))
+
+    def connection(self, ctx: Span, key: Any,
+                   **kwargs: Any) -> ConnectionContextManager:
+        return self.shard(key).connection(ctx, **kwargs)
+
+    def xact(self, ctx: Span, key: Any,
+             **kwargs: Any) -> ConnectionXactContextManager:
+        return self.shard(key).xact(ctx, **kwargs)
+
+    async def execute(self, ctx: Span, key: Any, id: str, query: str,
+                      *args: Any, **kwargs: Any) -> str:
+        return await self.shard(key).execute(ctx, id, query, *args,
+                                             **kwargs)
+
+    async def query_one(self, ctx: Span, key: Any, id: str, query: str,
+                        *args: Any, **kwargs: Any
+                        ) -> asyncpg.protocol.Record:
+        return await self.shard(key).query_one(ctx, id, query, *args,
+                                               **kwargs)
+
+    async def query_all(self, ctx: Span, key: Any, id: str, query: str,
+                        *args: Any, **kwargs: Any
+                        ) -> List[asyncpg.protocol.Record]:
+        return await self.shard(key).query_all(ctx, id, query, *args,
+                                               **kwargs)
+
+    async def _shard_query_all(self, ctx: Span, name: str, id: str,
+                               query: str, args: tuple,
+                               timeout: Optional[float],
+                               shard_timeout: Optional[float],
+                               tracer_config: Optional[PostgresTracerConfig],
+                               readonly: bool) -> ShardResult:
+        try:
+            rows = await asyncio.wait_for(
+                self.shards[name].query_all(
+                    ctx, id, query, *args, timeout=timeout,
+                    tracer_config=tracer_config, readonly=readonly),
+                shard_timeout, loop=self.loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            return ShardResult(name, None, err)
+        return ShardResult(name, rows, None)
+
+    async def iter_all_shards(self, ctx: Span, id: str, query: str,
+                              *args: Any, timeout: float = None,
+                              shard_timeout: float = None,
+                              shards: Optional[Sequence[str]] = None,
+                              tracer_config: Optional[
+                                  PostgresTracerConfig] = None,
+                              readonly: bool = False
+                              ) -> AsyncIterator[ShardResult]:
+        """
+        Runs the query on every shard (or the given ones) concurrently and
+        yields a ShardResult(shard, rows, error) per shard as soon as it
+        completes. A shard failing or exceeding shard_timeout yields its
+        error, it does not stop the others
+        """
+        if shard_timeout is None:
+            shard_timeout = self.shard_timeout
+        tasks = [asyncio.ensure_future(
+            self._shard_query_all(ctx, name, id, query, args, timeout,
+                                  shard_timeout, tracer_config, readonly),
+            loop=self.loop) for name in (shards or self._names)]
+        try:
+            for fut in asyncio.as_completed(tasks, loop=self.loop):
+                yield await fut
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def query_all_shards(self, ctx: Span, id: str, query: str,
+                               *args: Any, timeout: float = None,
+                               shard_timeout: float = None,
+                               shards: Optional[Sequence[str]] = None,
+                               raise_on_error: bool = False,
+                               tracer_config: Optional[
+                                   PostgresTracerConfig] = None,
+                               readonly: bool = False) -> ShardedResult:
+        """
+        Scatter-gather read, returns a ShardedResult with the merged rows
+        and the errors of the failed shards (`partial` is true then).
+        With raise_on_error a partial result raises ShardedPostgresError
+        """
+        span = self.instrumentation.new_span(
+            ctx, "db:shards:%s" % id, id, SPAN_KIND_POSTRGES_QUERY, None)
+        if span is not None:
+            span.start()
+        results = []
+        try:
+            async for res in self.iter_all_shards(
+                    span or ctx, id, query, *args, timeout=timeout,
+                    shard_timeout=shard_timeout, shards=shards,
+                    tracer_config=tracer_config, readonly=readonly):
+                results.append(res)
+        except Exception as err:
+            if span is not None:
+                span.finish(exception=err)
+            raise
+        order = {name: i for i, name in enumerate(self._names)}
+        results.sort(key=lambda res: order[res.shard])
+        result = ShardedResult(results)
+        if span is not None:
+            span.tag('shards', str(len(results)))
+            span.tag('failed', str(len(result.errors)))
+            for name, error in result.errors.items():
+                span.annotate('Shard %s failed: %r' % (name, error))
+            span.finish()
+        if raise_on_error and result.partial:
+            raise ShardedPostgresError(
+                'Shards failed: %s' % ', '.join(result.errors), result)
+        return result
@@ -0,0 +1,156 @@
+from collections import deque, namedtuple
+from typing import Dict, Any, Optional, Deque, List
+from .limiter import Limiter
+from .metrics import MetricsSink
+
+SIZING_HISTORY = 100
+
+SizingDecision = namedtuple('SizingDecision',
+                            ['time', 'old', 'new', 'reason'])
+
+
+class ConnectionBudget:
+    """
+    Number of connections the pools of a process may use together, share
+    one instance between the AdaptivePoolSizers of all Postgres components
+    connecting to the same server. The min_size of every pool is always
+    granted, even over the budget
+    """
+
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self._held: Dict[int, int] = {}
+
+    @property
+    def held(self) -> int:
+        return sum(self._held.values())
+
+    def request(self, owner: Any, size: int) -> int:
+        """
+        Sets the share of the owner to at most `size` connections, returns
+        the granted share
+        """
+        others = self.held - self._held.get(id(owner), 0)
+        granted = min(size, max(self.total - others, 0))
+        self._held[id(owner)] = granted
+        return granted
+
+    def release(self, owner: Any) -> None:
+        self._held.pop(id(owner), None)
+
+
+class AdaptivePoolSizer:
+    """
+    Adjusts how many connections of the pool may be in use between
+    min_size and max_size.
+
+    Every `interval` seconds the limit grows by `grow_step` when, since
+    the previous check, an acquire waited longer than `target_wait` or
+    more than `target_waiters` callers queued. It shrinks by
+    `shrink_step` when nothing had to wait for `cooldown` seconds and the
+    peak usage stayed below the limit, connections above the limit are
+    closed by the pool once idle for max_inactive_connection_lifetime.
+
+    The last decisions are kept in `history` with their reasons.
+    """
+
+    def __init__(self, min_size: int = 2, max_size: int = 50,
+                 target_wait: float = 0.005, target_waiters: int = 0,
+                 grow_step: int = 2, shrink_step: int = 1,
+                 interval: float = 1.0, cooldown: float = 30.0,
+                 budget: Optional[ConnectionBudget] = None) -> None:
+        if not 1 <= min_size <= max_size:
+            raise UserWarning('1 <= min_size <= max_size is required')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_wait = target_wait
+        self.target_waiters = target_waiters
+        self.grow_step = grow_step
+        self.shrink_step = shrink_step
+        self.interval = interval
+        self.cooldown = cooldown
+        self.budget = budget
+        self.limiter: Optional[Limiter] = None
+        self.resizes = 0
+        self.history: Deque[SizingDecision] = deque(maxlen=SIZING_HISTORY)
+        self._last_pressure = 0.0
+
+    def attach(self, limiter: Limiter, now: float) -> None:
+        self.limiter = limiter
+        self._last_pressure = now
+        if self.budget is not None:
+            self.budget.request(self, self.min_size)
+
+    def detach(self) -> None:
+        if self.budget is not None:
+            self.budget.release(self)
+        self.limiter = None
+
+    @property
+    def limit(self) -> int:
+        if self.limiter is None:
+            return self.min_size
+        return self.limiter.limit
+
+    def tick(self, now: float) -> Optional[SizingDecision]:
+        """
+        Looks at the limiter window and resizes it, returns the decision
+        when the limit has changed
+        """
+        limiter = self.limiter
+        if limiter is None:
+            return None
+        window = limiter.take_window()
+        old = limiter.limit
+        waiters = max(window['peak_waiters'], limiter.waiting)
+        reasons: List[str] = []
+        if window['max_wait'] > self.target_wait:
+            reasons.append('acquire wait %.4fs > %.4fs'
+                           '' % (window['max_wait'], self.target_wait))
+        if waiters > self.target_waiters:
+            reasons.append('%d waiters > %d' % (waiters,
+                                                self.target_waiters))
+        if reasons:
+            self._last_pressure = now
+            new = min(old + self.grow_step, self.max_size)
+            if self.budget is not None:
+                new = max(self.budget.request(self, new), self.min_size)
+            reason = 'grow: ' + ', '.join(reasons)
+            if new < old + self.grow_step and new != old:
+                reason += ', capped by %s' % (
+                    'max_size' if new == self.max_size else 'budget')
+        elif now - self._last_pressure < self.cooldown:
+            return None
+        elif window['peak_in_use'] < old:
+            new = max(old - self.shrink_step, window['peak_in_use'],
+                      self.min_size)
+            reason = ('shrink: peak in use %d, no waits for %.0fs'
+                      '' % (window['peak_in_use'], self.cooldown))
+            # shrinking again needs another quiet cooldown
+            self._last_pressure = now
+            if self.budget is not None:
+                self.budget.request(self, new)
+        else:
+            return None
+        if new == old:
+            return None
+        limiter.resize(new)
+        self.resizes += 1
+        decision = SizingDecision(now, old, new, reason)
+        self.history.append(decision)
+        return decision
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'limit': self.limit,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'resizes': self.resizes,
+            'history': [d._asdict() for d in self.history],
+        }
+
+    def export(self, sink: MetricsSink, prefix: str = 'postgres',
+               labels: Dict[str, str] = None) -> None:
+        labels = labels or {}
+        sink(prefix + '_pool_limit', self.limit, labels)
+        sink(prefix + '_pool_resizes_total', self.resizes, labels)
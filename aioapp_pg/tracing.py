@@ -0,0 +1,93 @@
+import reprlib
+import hashlib
+from typing import Optional, Any
+from aioapp.tracer import (Span, CLIENT, SPAN_TYPE, SPAN_KIND)
+
+SPAN_TYPE_POSTGRES = 'postgres'
+SPAN_KIND_POSTRGES_ACQUIRE = 'acquire'
+SPAN_KIND_POSTRGES_QUERY = 'query'
+
+ARGS_FULL = 'full'
+ARGS_TRUNCATE = 'truncate'
+ARGS_HASH = 'hash'
+ARGS_NONE = 'none'
+
+
+def is_sampled(ctx: Span) -> bool:
+    # unknown sampling decision is treated as sampled
+    return (getattr(ctx, 'sampled', None) is not False or
+            bool(getattr(ctx, 'debug', False)))
+
+
+class InstrumentationPolicy:
+    """
+    Controls what the component puts into spans.
+
+    trace_unsampled: create child spans for unsampled parents too, by
+    default an unsampled parent gets no database spans at all and the
+    tracer hooks are not called
+    args_annotation: how query arguments are annotated: 'full' (repr),
+    'truncate' (repr bounded by args_max_length, large containers and
+    strings are abbreviated without formatting them completely), 'hash'
+    (digest of the repr, groups identical arguments) or 'none'
+    fold_acquire: do not create acquire spans, the acquire wait time is
+    tagged on the first query span of the connection instead
+    """
+
+    def __init__(self, trace_unsampled: bool = False,
+                 args_annotation: str = ARGS_TRUNCATE,
+                 args_max_length: int = 256,
+                 fold_acquire: bool = False) -> None:
+        if args_annotation not in (ARGS_FULL, ARGS_TRUNCATE, ARGS_HASH,
+                                   ARGS_NONE):
+            raise UserWarning('Unknown args annotation %r' % args_annotation)
+        self.trace_unsampled = trace_unsampled
+        self.args_annotation = args_annotation
+        self.args_max_length = args_max_length
+        self.fold_acquire = fold_acquire
+        self._repr = reprlib.Repr()
+        self._repr.maxstring = args_max_length
+        self._repr.maxother = args_max_length
+        self._repr.maxlong = args_max_length
+        self._repr.maxlist = self._repr.maxtuple = 20
+        self._repr.maxdict = self._repr.maxset = 20
+
+    def new_span(self, ctx: Optional[Span], name: str, query_id: str,
+                 kind: str, endpoint: Optional[str]) -> Optional[Span]:
+        """
+        Returns a configured but not started child span of ctx, or None
+        when nothing should be traced
+        """
+        if not ctx:
+            return None
+        if not self.trace_unsampled and not is_sampled(ctx):
+            return None
+        span = ctx.new_child()
+        span.kind(CLIENT)
+        span.name(name)
+        span.metrics_tag(SPAN_TYPE, SPAN_TYPE_POSTGRES)
+        span.metrics_tag(SPAN_KIND, kind)
+        span.metrics_tag('query_id', query_id)
+        span.remote_endpoint("postgres")
+        if endpoint is not None:
+            span.tag('endpoint', endpoint)
+        return span
+
+    def format_args(self, args: Any) -> Optional[str]:
+        if self.args_annotation == ARGS_NONE:
+            return None
+        if self.args_annotation == ARGS_TRUNCATE:
+            res = self._repr.repr(args)
+            if len(res) > self.args_max_length:
+                res = res[:self.args_max_length] + '...'
+            return res
+        res = repr(args)
+        if self.args_annotation == ARGS_HASH:
+            return 'args:%s' % hashlib.blake2b(res.encode('utf-8'),
+                                               digest_size=8).hexdigest()
+        return res
+
+    def annotate_args(self, span: Span, args: Any) -> None:
+        annotation = self.format_args(args)
+        if annotation is not None:
+            span.annotate(annotation)
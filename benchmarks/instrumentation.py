@@ -0,0 +1,114 @@
+"""
+Measures the per-call overhead the instrumentation adds to
+Connection.query_one compared with calling the asyncpg connection
+directly. The database is replaced with an in-process connection that
+answers immediately, so only the wrapper cost is measured.
+
+    python benchmarks/instrumentation.py [--calls N] [--json]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from aioapp_pg import (Postgres, Connection,  # noqa: E402
+                       InstrumentationPolicy, ARGS_FULL, ARGS_TRUNCATE)
+
+LARGE_ARGS = (list(range(1000)), 'x' * 10000)
+
+
+class _InstantConnection:
+    """
+    Stands in for asyncpg's connection, answers without I/O
+    """
+    row = (1,)
+
+    async def fetchrow(self, query, *args, timeout=None):
+        return self.row
+
+
+class _Span:
+    """
+    Span with the aioapp interface that does no reporting
+    """
+
+    def __init__(self, sampled: bool) -> None:
+        self.sampled = sampled
+        self.debug = False
+
+    def new_child(self) -> '_Span':
+        return _Span(self.sampled)
+
+    def kind(self, *args):
+        pass
+
+    name = metrics_tag = tag = remote_endpoint = annotate = kind
+
+    def start(self, *args, **kwargs):
+        pass
+
+    def finish(self, *args, **kwargs):
+        pass
+
+
+async def _measure(fn, calls: int) -> float:
+    for _ in range(min(calls, 1000)):
+        await fn()
+    started = time.perf_counter()
+    for _ in range(calls):
+        await fn()
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+async def run(loop: asyncio.AbstractEventLoop, calls: int) -> dict:
+    raw = _InstantConnection()
+    results = {}
+
+    results['raw asyncpg'] = await _measure(
+        lambda: raw.fetchrow('SELECT 1', 1), calls)
+
+    cases = [
+        ('no ctx', InstrumentationPolicy(), None, (1,)),
+        ('unsampled', InstrumentationPolicy(), _Span(False), (1,)),
+        ('unsampled, trace_unsampled',
+         InstrumentationPolicy(trace_unsampled=True), _Span(False), (1,)),
+        ('sampled', InstrumentationPolicy(), _Span(True), (1,)),
+        ('sampled, large args, full',
+         InstrumentationPolicy(args_annotation=ARGS_FULL), _Span(True),
+         LARGE_ARGS),
+        ('sampled, large args, truncate',
+         InstrumentationPolicy(args_annotation=ARGS_TRUNCATE), _Span(True),
+         LARGE_ARGS),
+    ]
+    for name, policy, ctx, args in cases:
+        db = Postgres('postgres://localhost/bench', instrumentation=policy)
+        db.loop = loop
+        conn = Connection(db, raw)  # type: ignore
+        results[name] = await _measure(
+            lambda: conn.query_one(ctx, 'bench', 'SELECT 1', *args), calls)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--json', action='store_true',
+                        help='print machine-readable results')
+    opts = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(loop, opts.calls))
+    if opts.json:
+        print(json.dumps({'unit': 'us/call', 'results': results}))
+        return
+    base = results['raw asyncpg']
+    for name, value in results.items():
+        print('%-32s %8.2f us/call  +%.2f us' % (name, value, value - base))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares json codecs on the jsonb decode/encode path with payloads of
+realistic sizes.
+
+    python benchmarks/json_codecs.py [--number N]
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from aioapp_pg.jsoncodec import available_json_codecs  # noqa: E402
+
+
+def _payload(items: int) -> dict:
+    return {
+        'id': 123456,
+        'tenant': 'tenant-42',
+        'enabled': True,
+        'items': [
+            {'id': i, 'name': 'item %d' % i, 'price': i * 1.25,
+             'tags': ['a', 'b', 'c'], 'meta': {'k': 'v' * 16}}
+            for i in range(items)
+        ],
+    }
+
+
+PAYLOADS = {
+    'small': _payload(1),
+    'medium': _payload(30),
+    'large': _payload(2000),
+}
+
+
+def _legacy_decode(value: bytes):
+    # what Postgres._conn_init used to do for jsonb
+    return json.loads(value[1:].decode('utf-8'))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=0,
+                        help='iterations per measurement (auto if 0)')
+    opts = parser.parse_args()
+
+    codecs = available_json_codecs()
+    print('%-8s %-8s %9s %14s %14s' % (
+        'payload', 'codec', 'bytes', 'decode us/op', 'encode us/op'))
+    for pname, payload in PAYLOADS.items():
+        wire = b'\x01' + json.dumps(payload).encode('utf-8')
+        number = opts.number or max(10, 2000000 // len(wire))
+        timings = [('legacy', lambda: _legacy_decode(wire),
+                    lambda: b'\x01' + json.dumps(payload).encode('utf-8'))]
+        for name, codec in codecs.items():
+            timings.append((
+                name,
+                lambda c=codec: c.loads(memoryview(wire)[1:]),
+                lambda c=codec: b'\x01' + c.dumps(payload)))
+        for name, decode, encode in timings:
+            dec = min(timeit.repeat(decode, number=number, repeat=3))
+            enc = min(timeit.repeat(encode, number=number, repeat=3))
+            print('%-8s %-8s %9d %14.2f %14.2f' % (
+                pname, name, len(wire),
+                dec / number * 1e6, enc / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
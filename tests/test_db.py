@@ -1,6 +1,17 @@
 import asyncio
+import asyncpg
 from aioapp.app import Application
-from aioapp_pg import Postgres, PostgresTracerConfig
+from aioapp_pg import (Postgres, PostgresTracerConfig, ResultCache,
+                       PostgresListener, OVERFLOW_DROP_OLD, DrainingError,
+                       InstrumentationPolicy, ARGS_HASH, Deadline,
+                       DeadlineExceededError, ReadCoalescer,
+                       AdaptivePoolSizer, ConnectionBudget, Bulkheads,
+                       BulkheadTimeoutError, PRIORITY_LOW, PRIORITY_HIGH,
+                       ShardedPostgres, LookupStrategy, HashStrategy,
+                       ExplainSampler, QueryStats, HealthChecker,
+                       HEALTHY, DEGRADED, UNHEALTHY, UnhealthyError,
+                       available_json_codecs)
+from aioapp_pg.sharded import ShardingStrategy
 from aioapp.error import PrepareError
 import pytest
 import string
@@ -146,3 +157,1081 @@ async def test_postgres_health_ok(app: Application, postgres: str,
 
     if res['fut'] is not None:
         res['fut'].cancel()
+
+
+async def test_postgres_query_stream(app, postgres):
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+
+    rows = []
+    async for row in db.query_stream(span, 'test:stream',
+                                     'SELECT generate_series(1, $1::int) '
+                                     'as a', 25, prefetch=10,
+                                     tracer_config=PostgresTracerConfig()):
+        rows.append(row['a'])
+    assert rows == list(range(1, 26))
+
+    sizes = []
+    async with db.connection(span) as conn:
+        async for batch in conn.query_iter(span, 'test:stream',
+                                           'SELECT generate_series(1, 25)',
+                                           prefetch=10, batches=True):
+            sizes.append(len(batch))
+        assert not conn.in_transaction
+    assert sizes == [10, 10, 5]
+
+    stats = db.query_stats()['test:stream']
+    assert stats['calls'] == 2
+    assert stats['rows'] == 50
+    assert stats['bytes'] == 50 * 8
+
+    # an iterator left with break is closed before the connection goes
+    # back to the pool, its implicit transaction rolled back
+    async with db.connection(span) as conn:
+        raw = conn._conn._con
+        async for row in conn.query_iter(span, 'test:stream:break',
+                                         'SELECT generate_series(1, 25)',
+                                         prefetch=10):
+            break
+        assert raw.is_in_transaction()
+    assert not raw.is_in_transaction()
+    stats = db.query_stats()['test:stream:break']
+    assert stats['calls'] == 1
+    assert stats['rows'] == 10
+    res = await db.query_one(span, 'test', 'SELECT 1')
+    assert res[0] == 1
+
+
+async def test_postgres_copy(app, postgres, tmpdir):
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+
+    await db.execute(span, 'test',
+                     'CREATE TABLE %s(id int, name text)' % table_name)
+
+    res = await db.copy_records_to_table(
+        span, 'test:copy', table_name,
+        records=[(i, 'name%d' % i) for i in range(100)],
+        tracer_config=PostgresTracerConfig())
+    assert res == 'COPY 100'
+
+    async def source():
+        yield b'100\tfoo\n'
+        yield b'101\tbar\n'
+
+    res = await db.copy_to_table(span, 'test:copy', table_name,
+                                 source=source())
+    assert res == 'COPY 2'
+
+    path = str(tmpdir.join('out.tsv'))
+    res = await db.copy_from_query(span, 'test:copy',
+                                   'SELECT * FROM %s WHERE id >= $1'
+                                   '' % table_name, 100, output=path)
+    assert res == 'COPY 2'
+    with open(path, 'rb') as f:
+        assert f.read() == b'100\tfoo\n101\tbar\n'
+
+    chunks = []
+    async for data in db.copy_from_query_iter(
+            span, 'test:copy', 'SELECT * FROM %s' % table_name):
+        chunks.append(data)
+    assert b''.join(chunks).count(b'\n') == 102
+
+
+async def test_postgres_execute_many(app, postgres):
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+
+    await db.execute(span, 'test', 'CREATE TABLE %s(id int)' % table_name)
+    res = await db.execute_many(span, 'test:many',
+                                'INSERT INTO %s(id) VALUES($1)' % table_name,
+                                ((i,) for i in range(25)), batch_size=10,
+                                tracer_config=PostgresTracerConfig())
+    assert res == 25
+
+    res = await db.query_one(span, 'test',
+                             'SELECT COUNT(*) FROM %s' % table_name)
+    assert res[0] == 25
+    stats = db.query_stats()['test:many']
+    assert stats['calls'] == 3
+    assert stats['rows'] == 25
+
+
+async def test_postgres_prepared_cache(app, postgres):
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1,
+                  prepared_cache_size=2)
+    app.add('db', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    for i in range(3):
+        res = await db.query_one(span, 'test:cached',
+                                 'SELECT $1::int as a', i)
+        assert res['a'] == i
+    info = db.statement_cache_info()
+    assert info['misses'] == 1
+    assert info['hits'] == 2
+
+    await db.query_one(span, 'test:other1', 'SELECT $1::int', 1)
+    await db.query_one(span, 'test:other2', 'SELECT $1::int', 1)
+    info = db.statement_cache_info()
+    assert info['evictions'] == 1
+    assert info['size'] == 2
+
+    await db.execute(span, 'test', 'CREATE TABLE %s(id int)' % table_name)
+    await db.query_all(span, 'test:tbl', 'SELECT * FROM %s WHERE id > $1'
+                                         '' % table_name, 0)
+    await db.execute(span, 'test',
+                     'ALTER TABLE %s ADD COLUMN name text' % table_name)
+    res = await db.query_all(span, 'test:tbl',
+                             'SELECT * FROM %s WHERE id > $1' % table_name, 0)
+    assert res == []
+    assert db.statement_cache_info()['invalidations'] == 1
+
+
+@pytest.mark.parametrize('json_codec', ['json', 'ujson', 'orjson', 'auto'])
+async def test_postgres_json_codec(app, postgres, json_codec):
+    if json_codec in ('ujson', 'orjson'):
+        # the codec falls back to json when the library is missing
+        pytest.importorskip(json_codec)
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1,
+                  json_codec=json_codec)
+    if json_codec == 'auto':
+        assert db.json_codec.name == next(
+            name for name in ('orjson', 'ujson', 'json')
+            if name in available_json_codecs())
+    else:
+        assert db.json_codec.name == json_codec
+    app.add('db', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    doc = {'a': [1, 2.5, None, True], 'b': {'c': 'строка'}}
+    res = await db.query_one(span, 'test:json',
+                             'SELECT $1::json, $2::jsonb', doc, doc)
+    assert res[0] == doc
+    assert res[1] == doc
+
+
+async def test_postgres_replicas(app, postgres, unused_tcp_port):
+    bad_url = 'postgres://postgres@127.0.0.1:%s/postgres' % unused_tcp_port
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=2,
+                  replica_urls=[postgres, bad_url], replica_eject_time=60)
+    app.add('db', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    async with db.connection(span, readonly=True) as conn:
+        assert conn.endpoint_name == 'replica0'
+        res = await conn.query_one(span, 'test', 'SELECT 1')
+        assert res[0] == 1
+
+    res = await db.query_all(span, 'test', 'SELECT 1', readonly=True)
+    assert res[0][0] == 1
+
+    async with db.xact(span, readonly=True) as conn:
+        assert conn.endpoint_name == 'replica0'
+        assert conn.in_transaction
+
+    async with db.connection(span) as conn:
+        assert conn.endpoint_name == 'primary'
+
+    # expired deadlines and query timeouts do not count against a replica
+    replica = db._replicas[0]
+    timeouts = db.stats()['acquire_timeouts']
+    for _ in range(replica.eject_failures):
+        with Deadline(timeout=0.01):
+            await asyncio.sleep(0.02)
+            with pytest.raises(DeadlineExceededError):
+                await db.query_one(span, 'test', 'SELECT 1', readonly=True)
+        with pytest.raises(asyncio.TimeoutError):
+            await db.query_one(span, 'test', 'SELECT pg_sleep(1)',
+                               readonly=True, timeout=0.05)
+    assert replica.failures == 0
+    assert replica.available(db.loop.time())
+    assert db.stats()['acquire_timeouts'] == timeouts
+
+
+async def test_postgres_replica_fallback_timeout(app, postgres, loop):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1,
+                  replica_urls=[postgres])
+    app.add('db', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    async with db.connection(span, readonly=True) as replica:
+        assert replica.endpoint_name == 'replica0'
+        async with db.connection(span):
+            # the fallback to the primary gets what is left of the
+            # acquire timeout, not the whole of it again
+            start = loop.time()
+            with pytest.raises(asyncio.TimeoutError):
+                async with db.connection(span, readonly=True,
+                                         acquire_timeout=0.3):
+                    pass
+            assert loop.time() - start < 0.45
+
+
+async def test_postgres_result_cache(app, postgres):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1,
+                  result_cache=ResultCache(ttls={'test:cached': 60}))
+    app.add('db', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    query = 'SELECT $1::int as a, clock_timestamp() as ts'
+    res1 = await db.query_one(span, 'test:cached', query, 1)
+    res2 = await db.query_one(span, 'test:cached', query, 1)
+    assert res1['ts'] == res2['ts']
+    res3 = await db.query_one(span, 'test:cached', query, 2)
+    assert res3['a'] == 2
+
+    res4 = await db.query_one(span, 'test:uncached', query, 1)
+    assert res4['ts'] != res1['ts']
+
+    assert db.invalidate_cache(prefix='test:') == 2
+    res5 = await db.query_one(span, 'test:cached', query, 1)
+    assert res5['ts'] != res1['ts']
+    info = db.result_cache.info()
+    assert info['hits'] == 1
+    assert info['entries'] == 1
+
+
+async def test_postgres_listener(app, postgres):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1)
+    listener = PostgresListener(postgres, queue_size=2,
+                                overflow=OVERFLOW_DROP_OLD)
+    app.add('db', db)
+    app.add('listener', listener)
+    await app.run_prepare()
+    await listener.start()
+    span = _create_span(app)
+
+    sub = await listener.subscribe('test_channel')
+    for i in range(3):
+        await db.execute(span, 'test', "SELECT pg_notify('test_channel', $1)",
+                         str(i))
+    await asyncio.sleep(0.1)
+
+    assert sub.dropped == 1
+    assert (await sub.get()).payload == '1'
+    assert (await sub.get()).payload == '2'
+    await listener.health(span)
+
+    await sub.close()
+    assert [n async for n in sub] == []
+    await listener.stop()
+
+
+async def test_postgres_stats(app, postgres):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1)
+    app.add('db', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    async with db.connection(span):
+        stats = db.stats()
+        assert stats['in_use'] == 1
+        assert stats['idle'] == 0
+        with pytest.raises(asyncio.TimeoutError):
+            async with db.connection(span, acquire_timeout=0.1):
+                pass
+
+    await db.query_one(span, 'test', 'SELECT 1')
+    stats = db.stats()
+    assert stats['acquires'] == 2
+    assert stats['acquire_timeouts'] == 1
+    assert stats['in_use'] == 0
+    assert stats['connections_created'] == 1
+    assert stats['acquire_wait']['count'] == 2
+
+    metrics = {}
+    db.export_stats(lambda name, value, labels: metrics.setdefault(
+        name, value))
+    assert metrics['postgres_acquires_total'] == 2
+    assert metrics['postgres_acquire_wait_seconds_count'] == 2
+
+
+async def test_postgres_stop_drain(app, postgres, loop):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=2,
+                  stop_timeout=0.5, stop_cancel_timeout=5)
+    app.add('db', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    async def slow():
+        await db.execute(span, 'test', 'SELECT pg_sleep(30)')
+
+    async def fast():
+        async with db.connection(span) as conn:
+            await asyncio.sleep(0.2)
+            await conn.execute(span, 'test', 'SELECT 1')
+
+    slow_task = asyncio.ensure_future(slow(), loop=loop)
+    fast_task = asyncio.ensure_future(fast(), loop=loop)
+    await asyncio.sleep(0.1)
+
+    started = loop.time()
+    await db.stop()
+    assert loop.time() - started < 5
+
+    await fast_task
+    # the query is cancelled, not the task running it
+    with pytest.raises(asyncpg.exceptions.QueryCanceledError):
+        await slow_task
+    with pytest.raises(DrainingError):
+        await db.query_one(span, 'test', 'SELECT 1')
+
+
+async def test_postgres_stop_drain_queued(app, postgres, loop):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1,
+                  stop_timeout=5)
+    app.add('db', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    async def hold():
+        async with db.connection(span):
+            await asyncio.sleep(0.3)
+
+    hold_task = asyncio.ensure_future(hold(), loop=loop)
+    await asyncio.sleep(0.05)
+    # waits for the pool when stop() begins
+    queued_task = asyncio.ensure_future(
+        db.query_one(span, 'test', 'SELECT 1'), loop=loop)
+    await asyncio.sleep(0.05)
+
+    await db.stop()
+    await hold_task
+    with pytest.raises(DrainingError):
+        await queued_task
+    assert db.stats()['in_use'] == 0
+
+
+class _RecordingSpan:
+    """
+    Span keeping everything the component puts into it
+    """
+
+    def __init__(self, sampled=True):
+        self.sampled = sampled
+        self.debug = False
+        self.children = []
+        self.names = []
+        self.tags = {}
+        self.metrics_tags = {}
+        self.annotations = []
+        self.started = False
+        self.finished = False
+        self.exception = None
+
+    def new_child(self):
+        child = _RecordingSpan(self.sampled)
+        self.children.append(child)
+        return child
+
+    def kind(self, kind):
+        pass
+
+    def name(self, name):
+        self.names.append(name)
+
+    def remote_endpoint(self, name):
+        pass
+
+    def metrics_tag(self, name, value):
+        self.metrics_tags[name] = value
+
+    def tag(self, name, value):
+        self.tags[name] = value
+
+    def annotate(self, text):
+        self.annotations.append(text)
+
+    def start(self):
+        self.started = True
+
+    def finish(self, exception=None):
+        self.finished = True
+        self.exception = exception
+
+
+class _RecordingTracerConfig(PostgresTracerConfig):
+    def __init__(self):
+        self.calls = []
+
+    def on_acquire_start(self, ctx):
+        self.calls.append(('acquire_start', ctx))
+
+    def on_acquire_end(self, ctx, err):
+        self.calls.append(('acquire_end', ctx, err))
+
+    def on_query_start(self, ctx, id, query, args, timeout):
+        self.calls.append(('query_start', ctx, id, query, args))
+
+    def on_query_end(self, ctx, err, result):
+        self.calls.append(('query_end', ctx, err, result))
+
+    def on_query_batch(self, ctx, batch_no, rows):
+        self.calls.append(('query_batch', ctx, batch_no, len(rows)))
+
+
+async def test_postgres_instrumentation(app, postgres):
+    policy = InstrumentationPolicy(trace_unsampled=True,
+                                   args_annotation=ARGS_HASH,
+                                   fold_acquire=True)
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1,
+                  instrumentation=policy)
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+
+    assert policy.format_args((1, 'a')) == policy.format_args((1, 'a'))
+    assert policy.format_args((1, 'a')) != policy.format_args((2, 'a'))
+    truncated = InstrumentationPolicy(args_max_length=10)
+    assert len(truncated.format_args(('x' * 1000,))) < 100
+
+    async with db.connection(span) as conn:
+        res = await conn.query_one(span, 'test', 'SELECT $1::int', 1)
+        assert res[0] == 1
+    res = await db.query_all(span, 'test', 'SELECT $1::text', 'x' * 1000)
+    assert res[0][0] == 'x' * 1000
+
+    with pytest.raises(UserWarning):
+        InstrumentationPolicy(args_annotation='unknown')
+
+    # folded acquire, hashed arguments
+    root = _RecordingSpan()
+    config = _RecordingTracerConfig()
+    async with db.connection(root, tracer_config=config) as conn:
+        await conn.query_one(root, 'test:one', 'SELECT $1::int', 1,
+                             tracer_config=config)
+    query_span, = root.children
+    assert query_span.names == ['db:test:one']
+    assert query_span.metrics_tags['query_id'] == 'test:one'
+    assert 'acquire_time' in query_span.tags
+    assert query_span.annotations == [policy.format_args((1,))]
+    assert query_span.annotations[0].startswith('args:')
+    assert query_span.started and query_span.finished
+    assert query_span.exception is None
+    assert [c[0] for c in config.calls] == ['query_start', 'query_end']
+    assert config.calls[0][1:] == (query_span, 'test:one',
+                                   'SELECT $1::int', (1,))
+    assert config.calls[1][2] is None
+    assert config.calls[1][3][0] == 1
+
+    # acquire spans, truncated arguments, errors and batches
+    db.instrumentation = InstrumentationPolicy(args_max_length=10)
+    root = _RecordingSpan()
+    config = _RecordingTracerConfig()
+    await db.query_all(root, 'test:long', 'SELECT $1::text', 'x' * 1000,
+                       tracer_config=config)
+    acquire_span, query_span = root.children
+    assert acquire_span.names == ['db:Acquire']
+    assert acquire_span.tags['endpoint'] == 'primary'
+    assert 'acquire_time' not in query_span.tags
+    annotation, = query_span.annotations
+    assert annotation.endswith('...')
+    assert len(annotation) == 10 + 3
+    assert [c[0] for c in config.calls] == [
+        'acquire_start', 'acquire_end', 'query_start', 'query_end']
+    assert config.calls[0][1] is acquire_span
+    assert config.calls[2][1] is query_span
+
+    root = _RecordingSpan()
+    config = _RecordingTracerConfig()
+    with pytest.raises(asyncpg.exceptions.UndefinedTableError):
+        await db.query_one(root, 'test:missing', 'SELECT * FROM nowhere',
+                           tracer_config=config)
+    query_span = root.children[-1]
+    assert isinstance(query_span.exception,
+                      asyncpg.exceptions.UndefinedTableError)
+    assert isinstance(config.calls[-1][2],
+                      asyncpg.exceptions.UndefinedTableError)
+
+    root = _RecordingSpan()
+    config = _RecordingTracerConfig()
+    rows = [row async for row in db.query_stream(
+        root, 'test:stream', 'SELECT generate_series(1, 25)', prefetch=10,
+        tracer_config=config)]
+    assert len(rows) == 25
+    query_span = root.children[-1]
+    assert query_span.tags['rows'] == '25'
+    assert [c[2:] for c in config.calls if c[0] == 'query_batch'] == [
+        (1, 10), (2, 10), (3, 5)]
+    assert config.calls[-1][:4] == ('query_end', query_span, None, 25)
+
+    # unsampled parents get no spans and no hooks
+    root = _RecordingSpan(sampled=False)
+    config = _RecordingTracerConfig()
+    await db.query_one(root, 'test:unsampled', 'SELECT 1',
+                       tracer_config=config)
+    assert root.children == []
+    assert config.calls == []
+
+
+async def test_postgres_deadline(app, postgres, loop):
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+
+    started = loop.time()
+    with Deadline(timeout=0.5):
+        with pytest.raises(asyncio.TimeoutError):
+            await db.execute(span, 'test', 'SELECT pg_sleep(10)')
+    assert loop.time() - started < 5
+
+    with Deadline(timeout=0.01):
+        await asyncio.sleep(0.05)
+        with pytest.raises(DeadlineExceededError):
+            await db.query_one(span, 'test', 'SELECT 1')
+
+    with Deadline(timeout=60):
+        res = await db.query_one(span, 'test', 'SELECT 1', timeout=10)
+        assert res[0] == 1
+
+    # a cancelled task cancels its query on the server
+    marker = rndstr(20, string.ascii_lowercase)
+    task = asyncio.ensure_future(db.execute(
+        span, 'test', "SELECT pg_sleep(30), '%s'" % marker), loop=loop)
+    await asyncio.sleep(0.5)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await asyncio.sleep(0.5)
+    res = await db.query_one(
+        span, 'test', "SELECT count(*) FROM pg_stat_activity "
+                      "WHERE state = 'active' AND query LIKE $1",
+        "%%pg_sleep(30), '%s'%%" % marker)
+    assert res[0] == 0
+
+
+async def test_postgres_coalesce(app, postgres, loop):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=5,
+                  coalescer=ReadCoalescer(ids=['coalesced']))
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+
+    async def read(id):
+        return await db.query_all(span, id,
+                                  'SELECT $1::int AS a, pg_sleep(0.3)', 1)
+
+    acquires = db.stats()['acquires']
+    res = await asyncio.gather(*[read('coalesced') for _ in range(10)],
+                               loop=loop)
+    assert all(r[0]['a'] == 1 for r in res)
+    assert res[0] is not res[1]
+    assert db.stats()['acquires'] == acquires + 1
+    info = db.coalescer.info()
+    assert info['flights'] == 1
+    assert info['coalesced'] == 9
+    assert info['in_flight'] == 0
+
+    # a follower giving up does not affect the others
+    tasks = [asyncio.ensure_future(read('coalesced'), loop=loop)
+             for _ in range(3)]
+    await asyncio.sleep(0.1)
+    tasks[0].cancel()
+    res = await asyncio.gather(*tasks[1:], loop=loop)
+    assert all(r[0]['a'] == 1 for r in res)
+
+    # the shared read does not run out of the deadline of its leader
+    async def read_with_deadline():
+        with Deadline(timeout=0.1):
+            return await read('coalesced')
+
+    leader = asyncio.ensure_future(read_with_deadline(), loop=loop)
+    await asyncio.sleep(0.05)
+    follower = asyncio.ensure_future(read('coalesced'), loop=loop)
+    with pytest.raises(asyncio.TimeoutError):
+        await leader
+    res = await follower
+    assert res[0]['a'] == 1
+    assert db.coalescer.info()['in_flight'] == 0
+
+    acquires = db.stats()['acquires']
+    await asyncio.gather(*[read('other') for _ in range(3)], loop=loop)
+    assert db.stats()['acquires'] == acquires + 3
+
+
+async def test_postgres_loader(app, postgres, loop):
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+    await db.execute(span, 'test',
+                     'CREATE TABLE %s(id int PRIMARY KEY, name text)'
+                     '' % table_name)
+    await db.execute(span, 'test',
+                     "INSERT INTO %s SELECT g, 'name' || g "
+                     "FROM generate_series(1, 10) g" % table_name)
+
+    loader = db.register_loader(
+        'user_by_id',
+        'SELECT id, name FROM %s WHERE id = ANY($1::int[])' % table_name,
+        max_batch_size=4)
+
+    keys = [3, 1, 2, 3, 42, 5, 6, 7, 8]
+    res = await asyncio.gather(*[db.load(span, 'user_by_id', key)
+                                 for key in keys], loop=loop)
+    assert [r['id'] if r else None for r in res] == \
+        [3, 1, 2, 3, None, 5, 6, 7, 8]
+    assert res[0]['name'] == 'name3'
+    # 8 distinct keys in batches of 4
+    assert loader.info()['batches'] == 2
+    assert loader.info()['keys'] == 8
+
+    res = await db.load_many(span, 'user_by_id', [10, 9])
+    assert [r['id'] for r in res] == [10, 9]
+    assert loader.info()['batches'] == 3
+
+    with pytest.raises(UserWarning):
+        await db.load(span, 'unknown', 1)
+
+    # the batch does not run out of the deadline of the caller that
+    # opened it, which still gives up in time
+    db.register_loader(
+        'slow_user_by_id',
+        'SELECT id, name FROM %s, pg_sleep(0.3) WHERE id = ANY($1::int[])'
+        '' % table_name)
+
+    async def load_with_deadline(key):
+        with Deadline(timeout=0.1):
+            return await db.load(span, 'slow_user_by_id', key)
+
+    start = loop.time()
+    res = await asyncio.gather(load_with_deadline(1),
+                               db.load(span, 'slow_user_by_id', 2),
+                               loop=loop, return_exceptions=True)
+    assert isinstance(res[0], asyncio.TimeoutError)
+    assert res[1]['id'] == 2
+    assert loop.time() - start >= 0.3
+
+
+async def test_postgres_run_in_xact(app, postgres, loop):
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+    await db.execute(span, 'test',
+                     'CREATE TABLE %s(id int PRIMARY KEY, v int)'
+                     '' % table_name)
+    await db.execute(span, 'test',
+                     'INSERT INTO %s VALUES (1, 0)' % table_name)
+
+    both_read = asyncio.Event(loop=loop)
+    reads = []
+
+    async def increment(conn):
+        res = await conn.query_one(span, 'test',
+                                   'SELECT v FROM %s WHERE id = 1'
+                                   '' % table_name)
+        reads.append(res[0])
+        if len(reads) == 2:
+            both_read.set()
+        await both_read.wait()
+        await conn.execute(span, 'test',
+                           'UPDATE %s SET v = $1 WHERE id = 1' % table_name,
+                           res[0] + 1)
+        return res[0] + 1
+
+    res = await asyncio.gather(db.run_in_xact(span, increment),
+                               db.run_in_xact(span, increment),
+                               loop=loop)
+    assert sorted(res) == [1, 2]
+    res = await db.query_one(span, 'test',
+                             'SELECT v FROM %s WHERE id = 1' % table_name)
+    assert res[0] == 2
+    stats = db.stats()
+    assert stats['xact_retries'] >= 1
+    assert stats['xact_attempts'] == 2 + stats['xact_retries']
+
+    async def fail(conn):
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        await db.run_in_xact(span, fail)
+
+
+async def test_postgres_adaptive_pool(app, postgres, loop):
+    budget = ConnectionBudget(3)
+    sizer = AdaptivePoolSizer(min_size=1, max_size=4, grow_step=1,
+                              interval=0.05, cooldown=0.3, budget=budget)
+    db = Postgres(postgres, sizer=sizer)
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+
+    async def busy():
+        for _ in range(4):
+            await db.execute(span, 'test', 'SELECT pg_sleep(0.1)')
+
+    await asyncio.gather(*[busy() for _ in range(6)], loop=loop)
+    stats = db.stats()
+    assert stats['sizing']['resizes'] >= 1
+    # grown, but not over the budget
+    assert stats['sizing']['limit'] == 3
+    assert stats['in_use'] == 0
+
+    await asyncio.sleep(1.5)
+    assert db.stats()['sizing']['limit'] == 1
+    history = db.stats()['sizing']['history']
+    assert history[0]['reason'].startswith('grow')
+    assert history[-1]['reason'].startswith('shrink')
+
+    metrics = {}
+    db.export_stats(lambda name, value, labels: metrics.setdefault(
+        name, value))
+    assert metrics['postgres_pool_limit'] == 1
+
+
+async def test_postgres_warmup(app, postgres):
+    db = Postgres(postgres, pool_min_size=3, pool_max_size=5,
+                  prepared_cache_size=10, warmup_query='SELECT 1')
+    db.register_statement('hot', 'SELECT $1::int')
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+
+    info = db.warmup_info
+    assert info['connections'] == 3
+    assert info['statements'] == 1
+    assert info['failed'] == 0
+    assert db.statement_cache_info()['size'] == 3
+
+    misses = db.statement_cache_info()['misses']
+    res = await db.query_one(span, 'hot', 'SELECT $1::int', 1)
+    assert res[0] == 1
+    assert db.statement_cache_info()['misses'] == misses
+
+
+async def test_postgres_warmup_asyncpg_cache(app, postgres):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1)
+    db.register_statement('hot', 'SELECT $1::int')
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+
+    assert db.warmup_info['failed'] == 0
+    async with db.connection(span) as conn:
+        assert len(conn._conn._con._stmt_cache) == 1
+        res = await conn.query_one(span, 'hot', 'SELECT $1::int', 1)
+        assert res[0] == 1
+        # served from the statement prepared by the warm-up
+        assert len(conn._conn._con._stmt_cache) == 1
+
+
+async def test_postgres_bulkheads(app, postgres, loop):
+    bulkheads = Bulkheads({'report:*': 2, 'report:daily': 1})
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=5,
+                  bulkheads=bulkheads)
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+
+    assert bulkheads.get('report:weekly') is bulkheads.get('report:monthly')
+    assert bulkheads.get('report:daily') is not \
+        bulkheads.get('report:weekly')
+    assert bulkheads.get('user_by_id') is None
+
+    async def report(id):
+        await db.execute(span, id, 'SELECT pg_sleep(0.3)')
+
+    started = loop.time()
+    await asyncio.gather(*[report('report:weekly') for _ in range(4)],
+                         loop=loop)
+    assert loop.time() - started >= 0.55
+
+    # the reports do not take the connections of other queries
+    tasks = [asyncio.ensure_future(report('report:weekly'), loop=loop)
+             for _ in range(4)]
+    await asyncio.sleep(0.05)
+    started = loop.time()
+    await db.query_one(span, 'user_by_id', 'SELECT 1')
+    assert loop.time() - started < 0.2
+    await asyncio.gather(*tasks, loop=loop)
+
+    async with db.connection(span, id='report:daily'):
+        with pytest.raises(BulkheadTimeoutError):
+            async with db.connection(span, id='report:daily',
+                                     acquire_timeout=0.1):
+                pass
+
+    stats = db.stats()['bulkheads']
+    assert stats['report:*']['acquires'] == 8
+    assert stats['report:*']['in_use'] == 0
+    assert stats['report:daily']['timeouts'] == 1
+
+
+async def test_postgres_priority(app, postgres, loop):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1,
+                  priority_aging=100)
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+    served = []
+
+    async def query(name, priority):
+        await db.query_one(span, 'test', 'SELECT 1', priority=priority)
+        served.append(name)
+
+    async with db.connection(span):
+        tasks = []
+        for name, priority in (('low1', PRIORITY_LOW), ('low2', PRIORITY_LOW),
+                               ('normal', 0), ('high', PRIORITY_HIGH)):
+            tasks.append(asyncio.ensure_future(query(name, priority),
+                                               loop=loop))
+            await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks, loop=loop)
+    assert served == ['high', 'normal', 'low1', 'low2']
+
+    stats = db.stats()['acquire_wait_by_priority']
+    assert stats[PRIORITY_LOW]['count'] == 2
+    assert stats[PRIORITY_HIGH]['count'] == 1
+
+
+async def test_postgres_bulkhead_priority_aging(app, postgres, loop):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=5,
+                  bulkheads=Bulkheads({'report:*': 1}), priority_aging=0.1)
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+    served = []
+
+    async def query(name, priority):
+        await db.query_one(span, 'report:' + name, 'SELECT 1',
+                           priority=priority)
+        served.append(name)
+
+    async with db.connection(span, id='report:hold'):
+        low = asyncio.ensure_future(query('low', PRIORITY_LOW), loop=loop)
+        # 0.4s of waiting are worth 4 levels, more than the 2 between
+        # low and high
+        await asyncio.sleep(0.4)
+        high = asyncio.ensure_future(query('high', PRIORITY_HIGH),
+                                     loop=loop)
+        await asyncio.sleep(0.01)
+    await asyncio.gather(low, high, loop=loop)
+    assert served == ['low', 'high']
+
+
+async def test_postgres_xact_batch(app, postgres):
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+    await db.execute(span, 'test',
+                     'CREATE TABLE %s(id int PRIMARY KEY)' % table_name)
+
+    res = await db.xact_batch(span, 'test', [
+        ('INSERT INTO %s VALUES (1)' % table_name, ()),
+        ('INSERT INTO %s VALUES (2);' % table_name, ()),
+    ])
+    assert res == ['INSERT 0 1', 'INSERT 0 1']
+    res = await db.xact_batch(span, 'test', [
+        ('INSERT INTO %s VALUES ($1)' % table_name, (3,)),
+        ('UPDATE %s SET id = id + 10 WHERE id < $1' % table_name, (3,)),
+        ('DELETE FROM %s WHERE id = 0' % table_name, ()),
+    ], isolation_level='serializable')
+    assert res == ['INSERT 0 1', 'UPDATE 2', 'DELETE 0']
+
+    for args in ((), (4,)):
+        async with db.connection(span) as conn:
+            with pytest.raises(asyncpg.exceptions.UniqueViolationError):
+                await conn.xact_batch(span, 'test', [
+                    ('INSERT INTO %s VALUES (%s)'
+                     '' % (table_name, '$1' if args else '4'), args),
+                    ('INSERT INTO %s VALUES (3)' % table_name, ()),
+                ])
+            assert not conn.in_transaction
+            res = await conn.query_all(span, 'test',
+                                       'SELECT id FROM %s ORDER BY id'
+                                       '' % table_name)
+            assert [r[0] for r in res] == [3, 11, 12]
+
+    assert await db.xact_batch(span, 'test', []) == []
+
+
+async def test_sharded_postgres(app, postgres):
+    db = ShardedPostgres(
+        {'s1': postgres, 's2': postgres},
+        strategy=LookupStrategy({'a': 's1', 'b': 's2'},
+                                fallback=HashStrategy()),
+        shard_timeout=5, connect_max_attempts=10)
+    span = _create_span(app)
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+
+    assert db.shard_name('a') == 's1'
+    assert db.shard_name('b') == 's2'
+    assert db.shard_name(42) == db.shard_name(42)
+    res = await db.query_one(span, 'b', 'test', 'SELECT $1::int AS a', 1)
+    assert res['a'] == 1
+
+    res = await db.query_all_shards(span, 'test',
+                                    'SELECT $1::int AS a', 2)
+    assert not res.partial
+    assert [r['a'] for r in res] == [2, 2]
+    assert list(res.by_shard) == ['s1', 's2']
+
+    res = await db.query_all_shards(span, 'test', 'SELECT pg_sleep(1)',
+                                    shard_timeout=0.1, shards=['s2'])
+    assert res.partial
+    assert isinstance(res.errors['s2'], asyncio.TimeoutError)
+    assert await db.shard_health(span) == {'s1': None, 's2': None}
+
+
+async def test_sharded_postgres_result_cache(app, postgres):
+    with pytest.raises(UserWarning):
+        ShardedPostgres({'s1': postgres, 's2': postgres},
+                        result_cache=ResultCache(default_ttl=60))
+    cache = ResultCache(default_ttl=60)
+    with pytest.raises(UserWarning):
+        ShardedPostgres({'s1': postgres, 's2': postgres},
+                        shard_kwargs={'s1': {'result_cache': cache},
+                                      's2': {'result_cache': cache}})
+    with pytest.raises(TypeError):
+        ShardingStrategy()
+
+    db = ShardedPostgres(
+        {'s1': postgres, 's2': postgres},
+        strategy=LookupStrategy({'a': 's1', 'b': 's2'}),
+        connect_max_attempts=10,
+        shard_kwargs={'s1': {'result_cache': ResultCache(default_ttl=60)},
+                      's2': {'result_cache': ResultCache(default_ttl=60)}})
+    span = _create_span(app)
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    # both shards use the same server here, the table is filled between
+    # the reads so a result cached by one shard is told apart
+    await db.execute(span, 'a', 'test',
+                     'CREATE TABLE %s(v int)' % table_name)
+    query = 'SELECT count(*) AS c FROM %s' % table_name
+    assert (await db.query_one(span, 'a', 'count', query))['c'] == 0
+    await db.execute(span, 'a', 'test',
+                     'INSERT INTO %s VALUES (1)' % table_name)
+    # the cache of s1 must not answer for s2
+    assert (await db.query_one(span, 'b', 'count', query))['c'] == 1
+    assert (await db.query_one(span, 'a', 'count', query))['c'] == 0
+
+
+async def test_postgres_explain(app, postgres):
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    changes = []
+    explain = ExplainSampler(thresholds={'slow': 0.0, 'analyzed': 0.0},
+                             analyze_ids=['analyzed'], min_interval=0,
+                             id_interval=0,
+                             on_plan_change=lambda old, new: changes.append(
+                                 (old.fingerprint, new.fingerprint)))
+    db = Postgres(postgres, connect_max_attempts=10, explain=explain)
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+    await db.execute(span, 'test',
+                     'CREATE TABLE %s(id int PRIMARY KEY, v text)'
+                     '' % table_name)
+    await db.execute(span, 'test',
+                     'INSERT INTO %s SELECT i, i::text '
+                     'FROM generate_series(1, 1000) i' % table_name)
+    await db.execute(span, 'test', 'ANALYZE %s' % table_name)
+
+    query = 'SELECT * FROM %s WHERE id %s $1' % (table_name, '%s')
+    await db.query_all(span, 'slow', query % '>', 0)
+    await db.query_all(span, 'slow', query % '=', 1)
+    await db.query_one(span, 'analyzed', query % '=', 1)
+    await db.query_one(span, 'ignored', query % '=', 1)
+    for _ in range(100):
+        if explain.captured + explain.errors >= 3:
+            break
+        await asyncio.sleep(0.05)
+
+    assert explain.errors == 0
+    plans = explain.store.plans('slow')
+    assert [p.plan[0]['Plan']['Node Type'] for p in plans] == [
+        'Seq Scan', 'Index Scan']
+    assert changes == [(plans[0].fingerprint, plans[1].fingerprint)]
+    analyzed = explain.store.last('analyzed')
+    assert analyzed.analyze
+    assert 'Actual Rows' in analyzed.plan[0]['Plan']
+    assert explain.store.last('ignored') is None
+    assert db.stats()['explain']['plans']['slow']['changes'] == 1
+
+
+async def test_postgres_query_stats(app, postgres):
+    table_name = 'tbl_' + rndstr(20, string.ascii_lowercase + string.digits)
+    db = Postgres(postgres, connect_max_attempts=10,
+                  query_stats=QueryStats(max_ids=4, slow_threshold=0.1))
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+    await db.execute(span, 'create',
+                     'CREATE TABLE %s(id int, v text)' % table_name)
+    await db.execute(span, 'insert',
+                     'INSERT INTO %s SELECT i, $1 '
+                     'FROM generate_series(1, 10) i' % table_name, 'abcd')
+    for _ in range(3):
+        await db.query_all(span, 'select',
+                           'SELECT id, v FROM %s' % table_name)
+    with pytest.raises(asyncpg.exceptions.UndefinedTableError):
+        await db.query_one(span, 'missing', 'SELECT * FROM nowhere')
+    await db.execute(span, 'sleep', 'SELECT pg_sleep(0.2)')
+    await db.query_one(span, 'overflow', 'SELECT 1')
+
+    stats = db.query_stats()
+    assert stats['insert']['rows'] == 10
+    assert stats['select']['calls'] == 3
+    assert stats['select']['rows'] == 30
+    assert stats['select']['bytes'] == 3 * 10 * (8 + 4)
+    assert stats['select']['latency']['count'] == 3
+    assert stats['missing']['errors'] == 1
+    assert 'overflow' not in stats
+    assert stats['(other)']['calls'] == 2
+    slow = db._query_stats.take_slow()
+    assert [item[0] for item in slow] == ['(other)']
+    assert slow[0][2] >= 0.2
+
+
+async def test_postgres_health_status(app, postgres):
+    db = Postgres(postgres, pool_min_size=1, pool_max_size=1,
+                  connect_max_attempts=10,
+                  health_checker=HealthChecker(cache_ttl=0, min_calls=1))
+    app.add('db', db)
+    await app.run_prepare()
+    await db.start()
+    span = _create_span(app)
+
+    assert (await db.health_status(span)).status == HEALTHY
+    async with db.connection(span):
+        # the pool is exhausted, health does not wait for it
+        status = await asyncio.wait_for(db.health_status(span), 2)
+        assert status.status == HEALTHY
+        with pytest.raises(asyncio.TimeoutError):
+            async with db.connection(span, acquire_timeout=0.1):
+                pass
+    with pytest.raises(asyncpg.exceptions.UndefinedTableError):
+        await db.query_one(span, 'missing', 'SELECT * FROM nowhere')
+    status = await db.health_status(span)
+    assert status.status == DEGRADED
+    assert '1 acquire timeouts' in status.reasons
+    assert '1 of 1 calls failed' in status.reasons
+    await db.health(span)
+
+    await db.stop()
+    status = await db.health_status(span)
+    assert status.status == UNHEALTHY
+    assert status.reasons == ['stopping']
+    with pytest.raises(UnhealthyError):
+        await db.health(span)